@@ -5,7 +5,7 @@ from flask_cors import CORS
 
 db = SQLAlchemy()
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
 
     # CORS configuration for dashboard integration
@@ -29,19 +29,96 @@ def create_app():
     base_dir = os.path.abspath(os.path.dirname(__file__))
     upload_folder = os.path.join(base_dir, '..', 'uploads')  # uploads folder in BUAS root
 
-    app.config['UPLOAD_FOLDER'] = upload_folder
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///uploads.db'
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', upload_folder)
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'sharded')  # 'sharded' or 'flat' (see storage.py)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///uploads.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLITE_JOURNAL_MODE'] = 'WAL'  # Readers don't block the writer (see sqlite_tuning.py)
+    app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'  # Safe with WAL; skips an fsync per commit
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = 30000  # Wait this long for a write lock before "database is locked"
+    app.config['SQLITE_CACHE_SIZE_KB'] = 64 * 1024  # Page cache per connection
+    app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024  # Bytes of the database file to memory-map
     app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
-    
+    app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024  # Bytes per write on the streaming upload path
+    app.config['UPLOAD_SESSION_TTL'] = 24 * 60 * 60  # Seconds before an idle resumable upload is discarded
+    app.config['UPLOAD_SESSION_RETENTION'] = 30 * 24 * 60 * 60  # Seconds a finalized session is kept, so finalizing again returns its upload
+    app.config['DASHBOARD_RECENT_UPLOADS'] = 5  # Uploads embedded per device in /api/dashboard-data
+    app.config['METADATA_BATCH_SIZE'] = 100  # Metadata records committed per transaction
+    app.config['METADATA_FLUSH_INTERVAL'] = 1.0  # Max seconds a record waits for its batch
+    app.config['LOCATION_BATCH_SIZE'] = 500  # GPS fixes appended per transaction
+    app.config['LOCATION_FLUSH_INTERVAL'] = 1.0  # Max seconds a fix waits before it is stored
+    app.config['LOCATION_MAX_PENDING'] = 50000  # Buffered fixes before /api/location answers 503
+    app.config['TELEMETRY_BULK_MAX_RECORDS'] = 10000  # Records accepted per /api/telemetry/bulk request
+    app.config['TRACK_DEFAULT_POINTS'] = 1000  # Points per /api/devices/<id>/track response unless max_points is given
+    app.config['TRACK_MAX_POINTS'] = 5000
+    app.config['GEO_MAX_RADIUS_M'] = 100000  # Largest radius accepted by /api/geo/radius
+    app.config['DEVICE_CACHE_TTL'] = 300  # Seconds a cached Device may be served without rereading it
+    app.config['ACTIVE_SESSION_REFRESH_SECONDS'] = 1.0  # How often other processes' session changes are picked up
+    app.config['MEDIA_PROCESSING'] = os.environ.get('MEDIA_PROCESSING', '1') != '0'  # Queue transcoding/previews/peaks after uploads
+    app.config['TRANSCODE_CODEC'] = 'aac'  # Post-upload processing on the Celery 'media' queue (see media.py)
+    app.config['TRANSCODE_BITRATE'] = '64k'
+    app.config['TRANSCODE_EXTENSION'] = '.m4a'
+    app.config['PREVIEW_BITRATE'] = '24k'  # Mono preview generated for every recording
+    app.config['TRANSCODE_KEEP_ORIGINALS'] = os.environ.get('TRANSCODE_KEEP_ORIGINALS', '1') != '0'
+    app.config['FFMPEG_BINARY'] = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+    app.config['FFPROBE_BINARY'] = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+    app.config['MEDIA_TIMEOUT'] = 600  # Seconds before one ffmpeg run is killed
+    app.config['PEAKS_SAMPLE_RATE'] = 8000  # Waveform peaks (see peaks.py): decode rate
+    app.config['PEAKS_SAMPLES_PER_PEAK'] = 64  # Finest level: 125 peaks per second
+    app.config['PEAKS_LEVELS'] = 5
+    app.config['PEAKS_LEVEL_FACTOR'] = 4  # Each level is this many times coarser
+    app.config['PEAKS_TARGET_COUNT'] = 2000  # Default level: the finest with at most this many peaks
+    app.config['FILE_SERVE_MODE'] = os.environ.get('FILE_SERVE_MODE', 'flask')  # 'flask', 'x-accel' or 'x-sendfile' (see downloads.py)
+    app.config['FILE_SERVE_INTERNAL_PREFIX'] = '/protected-uploads/'  # nginx internal location aliased to UPLOAD_FOLDER
+    app.config['UPLOAD_CACHE_MAX_AGE'] = 3600  # Cache-Control max-age for downloaded recordings
+    app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', '32'))  # Threads running Flask views under asgi.py (see app/asgi.py)
+    app.config['ASGI_SPOOL_BYTES'] = 1024 * 1024  # Request bodies larger than this are buffered on disk before the view runs
+    app.config['ASGI_SEND_CHUNK'] = 256 * 1024  # Bytes per read when asgi.py streams a file
+    app.config['ADMIN_USERNAME'] = os.environ.get('ADMIN_USERNAME', 'admin')  # First operator, created on an empty operator table (see auth.py)
+    app.config['ADMIN_PASSWORD'] = os.environ.get('ADMIN_PASSWORD', 'supersecret')
+    app.config['AUTH_CREDENTIAL_CACHE_TTL'] = 300  # Seconds a verified password is trusted without rehashing
+    app.config['AUTH_TOKEN_CACHE_TTL'] = 60  # Seconds a verified API token is trusted without a lookup (bounds revocation delay)
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'  # /api/metrics and its request/query hooks (see metrics.py)
+    app.config['METRICS_PROFILING'] = os.environ.get('METRICS_PROFILING', '0') == '1'  # Allow ?profile=1 sampling profiles
+    app.config['PROFILE_SLOW_MS'] = int(os.environ.get('PROFILE_SLOW_MS', '0'))  # With profiling on: keep a profile of every request slower than this
+    app.config['PROFILE_SAMPLE_INTERVAL'] = 0.005  # Seconds between stack samples
+    app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+    app.config['EVENT_BACKEND'] = os.environ.get('EVENT_BACKEND', 'memory')  # 'memory' or 'redis' (see events.py)
+    app.config['EVENT_REDIS_URL'] = os.environ.get('EVENT_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'))
+    app.config['EVENT_QUEUE_SIZE'] = 1000  # Events buffered per dashboard before it is resynced
+    app.config['EVENT_KEEPALIVE_SECONDS'] = 15  # SSE comment sent when idle, keeps proxies from timing out
+    app.config['EVENT_MAX_STREAMS'] = int(os.environ.get('EVENT_MAX_STREAMS', '8'))  # Open dashboard streams per gunicorn worker; more get 503 and poll
+    app.config['RESPONSE_CACHE_GZIP'] = True  # Pre-compress cached dashboard responses (see http_cache.py)
+    app.config['RESPONSE_CACHE_GZIP_MIN_BYTES'] = 1024
+
+    # Overrides for tests, benchmarks and alternative deployments
+    if config:
+        app.config.update(config)
+
     # Ensure upload directory exists
-    os.makedirs(upload_folder, exist_ok=True)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
     db.init_app(app)
 
-    # Create tables if they don't exist
+    # Create tables if they don't exist (models must be imported first),
+    # then bring existing tables up to date
+    from . import models
+    from .migrations import run_migrations
+    from .summary import ensure_summaries
+    from .sqlite_tuning import configure_sqlite
+    from .http_cache import ensure_data_version
+    from .geo import ensure_spatial_index
+    from .metrics import init_metrics
+    from .auth import ensure_default_operator
     with app.app_context():
+        configure_sqlite(db.engine, app.config)
+        init_metrics(app, db.engine)
         db.create_all()
+        run_migrations(db.engine)
+        app.extensions['spatial_index'] = ensure_spatial_index(db.engine)
+        ensure_data_version()
+        ensure_summaries()
+        ensure_default_operator()
 
     from .routes import routes
     app.register_blueprint(routes)
@@ -0,0 +1,423 @@
+"""
+ASGI serving mode.
+
+Under gunicorn's sync workers, every connection owns a worker for as long
+as it is open. That includes a phone trickling a recording up over 3G, a
+listener seeking through a download, and a dashboard holding the event
+stream. AsgiBridge runs the same Flask app behind an event loop (see
+asgi.py in the project root), so only the part of a request that does
+real work occupies a thread:
+
+    request bodies   are received on the event loop, kept in memory up to
+                     ASGI_SPOOL_BYTES and then written with async file I/O
+                     to UPLOAD_FOLDER/.incoming, hashed on the way. The
+                     raw-body upload route takes that file over as the
+                     stored recording (dedupe.receive_body), so it is
+                     written once. The route runs once the whole body has
+                     arrived, in a pool of ASGI_THREADS threads.
+                     The SQLAlchemy connection pool is sized to match,
+                     so a thread never waits for a connection.
+    downloads        the routes answer with X-Sendfile (FILE_SERVE_MODE,
+                     see downloads.py), and the bridge streams the file
+                     from the event loop with async reads. It answers
+                     Range/206/416, If-Range, If-None-Match and
+                     If-Modified-Since itself, as nginx would.
+    /api/dashboard/stream
+                     is served natively. One broker subscription per
+                     process feeds an asyncio queue per dashboard, so a
+                     thousand open dashboards cost a thousand queues, not
+                     a thousand threads. Authorization and snapshots still
+                     come from the Flask code.
+
+Everything else is plain WSGI and behaves exactly as under gunicorn.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import queue
+import sys
+import threading
+import uuid
+from email.utils import formatdate
+
+import anyio
+from anyio import to_thread
+from flask import request
+from werkzeug.http import parse_range_header, parse_date, quote_etag, unquote_etag
+
+from .auth import authorized
+from .dedupe import incoming_dir, SPOOLED_BODY
+from .events import get_broker, format_sse
+
+STREAM_PATH = '/api/dashboard/stream'
+
+
+def build_environ(scope, body, content_length):
+    """WSGI environ for an ASGI http scope whose body has already been received."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(content_length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+            continue  # The body is complete now; CONTENT_LENGTH above is exact
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class _EventFanout:
+    """One broker subscription per process, relayed to an asyncio.Queue per dashboard."""
+
+    def __init__(self, flask_app, loop):
+        self.flask_app = flask_app
+        self.loop = loop
+        self.queue_size = flask_app.config['EVENT_QUEUE_SIZE']
+        self.clients = {}  # asyncio.Queue -> overflowed flag
+        self._subscription = None
+        self._thread = None
+
+    def _ensure_relay(self):
+        if self._thread is None:
+            self._subscription = get_broker(self.flask_app).subscribe()
+            self._thread = threading.Thread(target=self._relay, name='asgi-event-relay', daemon=True)
+            self._thread.start()
+
+    def _relay(self):
+        while True:
+            try:
+                event = self._subscription.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self._subscription.overflowed:
+                self._subscription.overflowed = False
+                self.loop.call_soon_threadsafe(self._overflow_all)
+            self.loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event):
+        for client in self.clients:
+            try:
+                client.put_nowait(event)
+            except asyncio.QueueFull:
+                self.clients[client] = True
+
+    def _overflow_all(self):
+        for client in self.clients:
+            self.clients[client] = True
+
+    def subscribe(self):
+        self._ensure_relay()
+        client = asyncio.Queue(maxsize=self.queue_size)
+        self.clients[client] = False
+        return client
+
+    def unsubscribe(self, client):
+        self.clients.pop(client, None)
+
+    def take_overflow(self, client):
+        overflowed = self.clients.get(client, False)
+        if overflowed:
+            self.clients[client] = False
+        return overflowed
+
+
+class AsgiBridge:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        self.spool_bytes = config['ASGI_SPOOL_BYTES']
+        self.send_chunk = config['ASGI_SEND_CHUNK']
+        self.max_body = config['MAX_CONTENT_LENGTH']
+        self.threads = config['ASGI_THREADS']
+        self._limiter = None
+        self._fanout = None
+
+    # ------------------------------------------------------------ plumbing
+
+    @property
+    def limiter(self):
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self.threads)
+        return self._limiter
+
+    async def run_sync(self, func, *args):
+        return await to_thread.run_sync(func, *args, limiter=self.limiter)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == STREAM_PATH and scope['method'] == 'GET':
+                await self._dashboard_stream(scope, receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._fanout = _EventFanout(self.flask_app, asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _simple(send, status, body=b'', headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode()), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    async def _until_disconnect(receive, cancel_scope):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                cancel_scope.cancel()
+                return
+
+    # -------------------------------------------------------- request body
+
+    async def _receive_body(self, receive):
+        """Returns (file object, length, spooled), or None if the body exceeded MAX_CONTENT_LENGTH.
+
+        `spooled` is (path, length, sha256) when the body went to disk, else None.
+        """
+        body = io.BytesIO()
+        spooled = None
+        digest = hashlib.sha256()
+        length = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise anyio.get_cancelled_exc_class()()
+                chunk = message.get('body', b'')
+                length += len(chunk)
+                if self.max_body and length > self.max_body:
+                    await self._discard_spool(spooled)
+                    return None
+                if chunk:
+                    digest.update(chunk)
+                    if spooled is None and length > self.spool_bytes:
+                        # Big body: write it where the upload routes store recordings
+                        path = os.path.join(incoming_dir(self.flask_app), f"{uuid.uuid4().hex}.asgi")
+                        spooled = await anyio.open_file(path, 'w+b')
+                        await spooled.write(body.getvalue())
+                        body = None
+                    if spooled is not None:
+                        await spooled.write(chunk)
+                    else:
+                        body.write(chunk)
+                if not message.get('more_body', False):
+                    break
+        except BaseException:
+            await self._discard_spool(spooled)
+            raise
+
+        if spooled is None:
+            body.seek(0)
+            return body, length, None
+        await spooled.aclose()
+        # Other routes read it through this handle; the file goes after the request
+        return open(spooled.name, 'rb'), length, (spooled.name, length, digest.hexdigest())
+
+    @staticmethod
+    async def _discard_spool(spooled):
+        if spooled is not None:
+            await spooled.aclose()
+            if os.path.exists(spooled.name):
+                os.remove(spooled.name)
+
+    # ---------------------------------------------------------------- WSGI
+
+    def _call_wsgi(self, environ):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+            return lambda data: None  # write() is not supported; Flask never uses it
+
+        result = self.flask_app(environ, start_response)
+        iterator = iter(result)
+        first = next(iterator, None)  # Runs lazy views up to their first chunk
+        return started['status'], started['headers'], result, iterator, first
+
+    async def _wsgi(self, scope, receive, send):
+        received = await self._receive_body(receive)
+        if received is None:
+            await self._simple(send, 413, b'Request body too large')
+            return
+        body, length, spooled = received
+        try:
+            environ = build_environ(scope, body, length)
+            if spooled is not None:
+                environ[SPOOLED_BODY] = spooled
+            status, headers, result, iterator, first = await self.run_sync(self._call_wsgi, environ)
+        finally:
+            body.close()
+            # Unless the route took the file over (dedupe.receive_body renames it)
+            if spooled is not None and os.path.exists(spooled[0]):
+                os.remove(spooled[0])
+
+        try:
+            sendfile = next((value for name, value in headers if name.lower() == 'x-sendfile'), None)
+            if sendfile is not None:
+                headers = [(n, v) for n, v in headers
+                           if n.lower() not in ('x-sendfile', 'content-length')]
+                await self._send_file(scope, receive, send, sendfile, status, headers)
+                return
+
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(n.lower().encode('latin-1'), v.encode('latin-1')) for n, v in headers]})
+            chunk = first
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run_sync(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await self.run_sync(result.close)
+
+    # ----------------------------------------------------------- downloads
+
+    async def _send_file(self, scope, receive, send, path, status, headers):
+        try:
+            stat = await anyio.Path(path).stat()
+        except OSError:
+            await self._simple(send, 404, b'Not Found')
+            return
+        if status != 200:
+            await self._simple(send, status)
+            return
+
+        size = stat.st_size
+        etag = quote_etag(f"{stat.st_mtime_ns:x}-{size:x}")
+        last_modified = formatdate(int(stat.st_mtime), usegmt=True)
+        request_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        headers = [(n.lower().encode('latin-1'), v.encode('latin-1')) for n, v in headers]
+        headers += [(b'accept-ranges', b'bytes'), (b'etag', etag.encode()),
+                    (b'last-modified', last_modified.encode())]
+
+        if_none_match = request_headers.get('if-none-match')
+        if_modified_since = parse_date(request_headers.get('if-modified-since'))
+        if (if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')])) \
+                or (not if_none_match and if_modified_since and int(stat.st_mtime) <= if_modified_since.timestamp()):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        start, stop = 0, size
+        rng = parse_range_header(request_headers.get('range'))
+        if_range = request_headers.get('if-range')
+        if rng is not None and if_range and unquote_etag(if_range)[0] != unquote_etag(etag)[0] \
+                and if_range != last_modified:
+            rng = None  # The client's copy is stale: send the whole file
+        if rng is not None:
+            bounds = rng.range_for_length(size)
+            if bounds is None:
+                await send({'type': 'http.response.start', 'status': 416,
+                            'headers': headers + [(b'content-range', f"bytes */{size}".encode()),
+                                                  (b'content-length', b'0')]})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            start, stop = bounds
+            status = 206
+            headers.append((b'content-range', f"bytes {start}-{stop - 1}/{size}".encode()))
+        headers.append((b'content-length', str(stop - start).encode()))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(self._until_disconnect, receive, tasks.cancel_scope)
+            async with await anyio.open_file(path, 'rb') as f:
+                await f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = await f.read(min(self.send_chunk, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            tasks.cancel_scope.cancel()
+
+    # ------------------------------------------------------ dashboard feed
+
+    def _open_stream(self, environ):
+        from .routes import _build_dashboard_payload
+        with self.flask_app.request_context(environ):
+            if (request.authorization or request.args.get('access_token')) \
+                    and not authorized(allow_query_token=True):
+                return None
+            return format_sse('snapshot', _build_dashboard_payload())
+
+    def _snapshot(self):
+        from .routes import _build_dashboard_payload
+        with self.flask_app.app_context():
+            return format_sse('snapshot', _build_dashboard_payload())
+
+    async def _dashboard_stream(self, scope, receive, send):
+        environ = build_environ(scope, io.BytesIO(), 0)
+        snapshot = await self.run_sync(self._open_stream, environ)
+        if snapshot is None:
+            await self._simple(send, 401, b'Unauthorized',
+                               [(b'www-authenticate', b'Basic realm="Login Required"')])
+            return
+
+        if self._fanout is None:
+            # Servers without lifespan support
+            self._fanout = _EventFanout(self.flask_app, asyncio.get_running_loop())
+        client = self._fanout.subscribe()
+        keepalive = self.flask_app.config['EVENT_KEEPALIVE_SECONDS']
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({'type': 'http.response.body', 'body': snapshot.encode(), 'more_body': True})
+            async with anyio.create_task_group() as tasks:
+                tasks.start_soon(self._until_disconnect, receive, tasks.cancel_scope)
+                while True:
+                    if self._fanout.take_overflow(client):
+                        # This client fell behind and missed events: resync it
+                        message = await self.run_sync(self._snapshot)
+                    else:
+                        try:
+                            event_type, data = await asyncio.wait_for(client.get(), keepalive)
+                            message = format_sse(event_type, data)
+                        except asyncio.TimeoutError:
+                            message = ": keepalive\n\n"
+                    await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+        finally:
+            self._fanout.unsubscribe(client)
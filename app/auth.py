@@ -0,0 +1,235 @@
+"""
+Operator and device authentication.
+
+Protected routes accept two kinds of credentials:
+
+    Basic <username:password>    an Operator. Passwords are stored as
+                                 werkzeug scrypt hashes, which take about
+                                 0.1 s to check by design. A successful
+                                 check is cached for AUTH_CREDENTIAL_CACHE_TTL,
+                                 keyed by an HMAC of the credentials under a
+                                 per-process random key, so a dashboard that
+                                 polls every 2 s pays that cost once.
+    Bearer buas_<id>.<secret>    an ApiToken issued to an operator or a
+                                 device. The secret is 256 random bits, so a
+                                 plain SHA-256 of it is stored: there is
+                                 nothing to brute-force and nothing to
+                                 stretch. Verified tokens are cached for
+                                 AUTH_TOKEN_CACHE_TTL.
+
+Revoking a token or changing a password drops the cached entries in this
+process at once; other processes stop accepting the old credential within
+the TTL.
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import current_app, g, request
+from werkzeug.security import generate_password_hash, check_password_hash
+from . import db
+from .models import Operator, ApiToken
+
+TOKEN_PREFIX = 'buas_'
+TOKEN_KINDS = ('operator', 'device')
+
+# Cache keys are HMACs under this, so the cache never holds anything reusable
+_CACHE_KEY = os.urandom(32)
+
+
+class VerifiedCache:
+    """LRU of verified credentials, each trusted for `ttl` seconds."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            verified_at, value = entry
+            if time.monotonic() - verified_at > ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credential_cache = VerifiedCache()
+token_cache = VerifiedCache()
+
+_dummy_hash = None
+
+
+def _principal(kind, subject, token_id=None):
+    return {'kind': kind, 'subject': subject, 'token_id': token_id}
+
+
+# --------------------------------------------------------------- passwords
+
+def set_password(username, password):
+    """Create the operator or replace its password, and commit."""
+    operator = Operator.query.filter_by(username=username).first()
+    if operator is None:
+        operator = Operator(username=username, password_hash='')
+        db.session.add(operator)
+    operator.password_hash = generate_password_hash(password)
+    db.session.commit()
+    credential_cache.clear()
+    return operator
+
+
+def ensure_default_operator():
+    """Seed the first operator from ADMIN_USERNAME/ADMIN_PASSWORD on an empty table."""
+    if Operator.query.first() is None:
+        config = current_app.config
+        set_password(config['ADMIN_USERNAME'], config['ADMIN_PASSWORD'])
+
+
+def verify_password(username, password):
+    """Principal for valid operator credentials, or None."""
+    if not username or password is None:
+        return None
+    key = hmac.new(_CACHE_KEY, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+    principal = credential_cache.get(key, current_app.config['AUTH_CREDENTIAL_CACHE_TTL'])
+    if principal is not None:
+        return principal
+
+    global _dummy_hash
+    operator = Operator.query.filter_by(username=username).first()
+    if operator is None:
+        # Same cost as a wrong password, so usernames can't be probed by timing
+        _dummy_hash = _dummy_hash or generate_password_hash(secrets.token_hex(16))
+        check_password_hash(_dummy_hash, password)
+        return None
+    if not check_password_hash(operator.password_hash, password):
+        return None
+
+    principal = _principal('operator', operator.username)
+    credential_cache.put(key, principal)
+    return principal
+
+
+# ------------------------------------------------------------------ tokens
+
+def _hash_secret(secret):
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def issue_token(kind, subject, name=None, expires_in=None):
+    """Create and commit a token. Returns (token string, ApiToken); the string is not stored."""
+    if kind not in TOKEN_KINDS:
+        raise ValueError(f"kind must be one of {TOKEN_KINDS}")
+    if not subject:
+        raise ValueError("subject is required")
+    token_id = secrets.token_hex(8)
+    secret = secrets.token_urlsafe(32)
+    row = ApiToken(
+        id=token_id,
+        secret_hash=_hash_secret(secret),
+        kind=kind,
+        subject=subject,
+        name=name,
+        expires_at=datetime.utcnow() + timedelta(seconds=expires_in) if expires_in else None
+    )
+    db.session.add(row)
+    db.session.commit()
+    return f"{TOKEN_PREFIX}{token_id}.{secret}", row
+
+
+def revoke_token(token_id):
+    """Mark a token revoked. Returns False if there is no such active token."""
+    row = db.session.get(ApiToken, token_id)
+    if row is None or row.revoked_at is not None:
+        return False
+    row.revoked_at = datetime.utcnow()
+    db.session.commit()
+    token_cache.invalidate(token_id)
+    return True
+
+
+def verify_token(token):
+    """Principal for a valid, unexpired, unrevoked token, or None."""
+    if not token or not token.startswith(TOKEN_PREFIX) or '.' not in token:
+        return None
+    token_id, secret = token[len(TOKEN_PREFIX):].split('.', 1)
+
+    entry = token_cache.get(token_id, current_app.config['AUTH_TOKEN_CACHE_TTL'])
+    if entry is None:
+        row = db.session.get(ApiToken, token_id)
+        if row is None or row.revoked_at is not None:
+            return None
+        entry = {
+            'secret_hash': row.secret_hash,
+            'expires_at': row.expires_at,
+            'principal': _principal(row.kind, row.subject, row.id),
+        }
+        token_cache.put(token_id, entry)
+
+    if entry['expires_at'] is not None and entry['expires_at'] <= datetime.utcnow():
+        return None
+    if not hmac.compare_digest(_hash_secret(secret), entry['secret_hash']):
+        return None
+    return entry['principal']
+
+
+def serialize_token(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'subject': row.subject,
+        'name': row.name,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'expires_at': row.expires_at.isoformat() if row.expires_at else None,
+        'revoked_at': row.revoked_at.isoformat() if row.revoked_at else None,
+    }
+
+
+# ---------------------------------------------------------------- requests
+
+def current_principal(allow_query_token=False):
+    """Who sent this request (Basic or Bearer; ?access_token= if allowed), or None."""
+    if 'principal' in g:
+        return g.principal
+    principal = None
+    auth = request.authorization
+    if auth is not None and auth.type == 'basic':
+        principal = verify_password(auth.username, auth.password)
+    elif auth is not None and auth.type == 'bearer':
+        principal = verify_token(auth.token)
+    elif allow_query_token and request.args.get('access_token'):
+        # EventSource and <audio> can't set headers
+        principal = verify_token(request.args['access_token'])
+    if principal is not None:
+        g.principal = principal
+    return principal
+
+
+def authorized(*kinds, allow_query_token=False):
+    """The request's principal if it is one of `kinds` (default: operators), else None."""
+    principal = current_principal(allow_query_token)
+    if principal is None or principal['kind'] not in (kinds or ('operator',)):
+        return None
+    return principal
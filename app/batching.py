@@ -0,0 +1,134 @@
+import atexit
+import threading
+import time
+
+
+class BatchFull(Exception):
+    """The writer already holds max_pending records that could not be written yet."""
+
+
+class BatchWriter:
+    """Buffer records in memory and hand them to `handler` in groups.
+
+    A batch is flushed when it reaches `flush_size` records or when the
+    oldest buffered record is `flush_interval` seconds old, whichever comes
+    first. `handler(records)` runs inside an app context on the writer's
+    own thread, never on the thread that called add(), and is expected to
+    commit the whole batch in one transaction.
+
+    Records are held only in process memory until flushed, so a hard crash
+    can lose at most one interval's worth. A caller that must not lose its
+    record (a Celery task acked late) passes wait=True to add(), which
+    returns only once the record's batch has been handled. A handler that
+    saves what it can may return {index: exception} for the records of
+    the batch it could not write; each goes to that record's waiter.
+
+    With requeue=True, a batch whose handler raised goes back to the front
+    of the buffer and is tried again an interval later, for callers that
+    have already answered their clients. add() then raises BatchFull once
+    `max_pending` records are waiting, rather than buffer without bound
+    while the database is down.
+    """
+
+    def __init__(self, app, handler, flush_size=100, flush_interval=1.0, name='batch-writer',
+                 requeue=False, max_pending=None):
+        self.app = app
+        self.handler = handler
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self.requeue = requeue
+        self.max_pending = max_pending
+
+        self._buffer = []
+        self._oldest = None
+        self._handled = threading.Event()  # Set once the current buffer's batch is written
+        self._error = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()  # Set when the buffer is full
+        self._retry_at = 0.0  # No flush from the thread before this, after a failed one
+        self._thread = None
+        atexit.register(self.flush)
+
+    def add(self, record, wait=False):
+        """Buffer one record; with wait=True, block until its batch is written.
+
+        A waiting caller gets the handler's exception if its batch failed,
+        or the one reported for its own record.
+        """
+        with self._lock:
+            if self.max_pending is not None and len(self._buffer) >= self.max_pending:
+                raise BatchFull(f"{self.name} has {len(self._buffer)} records waiting")
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            index = len(self._buffer)
+            self._buffer.append(record)
+            if len(self._buffer) >= self.flush_size:
+                self._wake.set()
+            handled, error = self._handled, self._error
+            self._ensure_thread()
+        if wait:
+            handled.wait()
+            if 'exception' in error:
+                raise error['exception']
+            if index in error.get('failed', {}):
+                raise error['failed'][index]
+
+    def flush(self):
+        """Write out everything buffered so far. Returns the number of records."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer, self._oldest = self._buffer, [], None
+                handled, error = self._handled, self._error
+                self._handled, self._error = threading.Event(), {}
+            if not records:
+                handled.set()
+                return 0
+            try:
+                with self.app.app_context():
+                    error['failed'] = self.handler(records) or {}
+            except Exception as e:
+                if self.requeue:
+                    self._put_back(records)
+                error['exception'] = e
+                raise
+            finally:
+                handled.set()
+            return len(records)
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def _put_back(self, records):
+        # Ahead of anything added meanwhile, and not retried before another interval
+        with self._lock:
+            self._buffer[:0] = records
+            self._oldest = time.monotonic()
+            self._retry_at = self._oldest + self.flush_interval
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                oldest = self._oldest
+            if oldest is None:
+                self._wake.wait(self.flush_interval)
+            else:
+                self._wake.wait(max(0.0, oldest + self.flush_interval - time.monotonic()))
+            self._wake.clear()
+            with self._lock:
+                now = time.monotonic()
+                due = self._oldest is not None and now >= self._retry_at and (
+                    len(self._buffer) >= self.flush_size or now - self._oldest >= self.flush_interval
+                )
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.app.logger.error(f"{self.name} flush failed: {e}")
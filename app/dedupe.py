@@ -0,0 +1,170 @@
+"""
+Content-addressed recordings and idempotent upload retries.
+
+Devices on flaky networks retry uploads, and each retry used to store
+another copy of the same audio under a new filename, with a new Upload
+row. Two things stop that:
+
+    content addressing   upload bodies are hashed while they stream to
+                         UPLOAD_FOLDER/.incoming, then stored once per
+                         SHA-256 at blobs/ab/cd/<sha256><ext>. Every
+                         Upload with that content points its storage_path
+                         at the same file, and the Blob row counts them.
+                         The file goes when the last reference is released.
+    Idempotency-Key      a device may send this header with an upload. A
+                         retry with a key the device has already used gets
+                         the original record back, and nothing is written.
+
+Public filenames don't change, so /api/uploads/<filename>, metadata
+sidecars and media processing work as before.
+"""
+import glob
+import os
+import uuid
+from datetime import datetime
+from sqlalchemy import delete, select, update
+from werkzeug.utils import secure_filename
+from . import db
+from .models import Blob, Upload
+from .storage import get_storage
+from .ingest import stream_to_file, UploadTooLarge, ChecksumMismatch, DEFAULT_CHUNK_SIZE
+from .metrics import count_ingested
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 100  # Upload.idempotency_key
+SPOOLED_BODY = 'buas.spooled_body'  # environ key: (path, size, sha256) of a body asgi.py already wrote
+
+
+def incoming_dir(app=None):
+    path = os.path.join(get_storage(app).root, '.incoming')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def receive(stream, max_bytes=None, chunk_size=DEFAULT_CHUNK_SIZE, expected_sha256=None):
+    """Stream a body to a temporary file, hashing it on the way.
+
+    Returns (temp_path, size, sha256); pass them to store().
+    """
+    temp_path = os.path.join(incoming_dir(), uuid.uuid4().hex)
+    size, digest = stream_to_file(stream, temp_path, max_bytes, chunk_size, expected_sha256)
+    return temp_path, size, digest
+
+
+def receive_body(request, max_bytes=None, chunk_size=DEFAULT_CHUNK_SIZE, expected_sha256=None):
+    """receive() for a raw request body.
+
+    Under asgi.py a large body has already been written to .incoming and
+    hashed as it arrived; that file is taken over instead of copied again.
+    """
+    spooled = request.environ.pop(SPOOLED_BODY, None)
+    if spooled is None:
+        return receive(request.stream, max_bytes, chunk_size, expected_sha256)
+    path, size, digest = spooled
+    if max_bytes is not None and size > max_bytes:
+        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+    if expected_sha256 and expected_sha256.lower() != digest:
+        raise ChecksumMismatch(expected_sha256, digest)
+    # Renamed, so the bridge knows it is no longer its file to delete
+    temp_path = os.path.join(incoming_dir(), uuid.uuid4().hex)
+    os.replace(path, temp_path)
+    count_ingested(size)
+    return temp_path, size, digest
+
+
+def _insert():
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(Blob)
+
+
+def _add_reference(digest, relative, size):
+    statement = _insert()
+    if statement is not None:
+        # One statement, so concurrent uploads of the same content can't both insert
+        db.session.execute(
+            statement.values(sha256=digest, storage_path=relative, size_bytes=size,
+                             ref_count=1, created_at=datetime.utcnow())
+            .on_conflict_do_update(index_elements=['sha256'], set_={'ref_count': Blob.ref_count + 1})
+        )
+        return
+    blob = db.session.get(Blob, digest)
+    if blob is None:
+        db.session.add(Blob(sha256=digest, storage_path=relative, size_bytes=size, ref_count=1))
+    else:
+        blob.ref_count += 1
+
+
+def store(temp_path, size, digest, filename):
+    """Move a received file into content-addressed storage and stage a reference.
+
+    If the content is already stored, the temporary file is simply dropped.
+    Runs in the caller's transaction; returns the storage_path for the
+    Upload row (`filename` only supplies the extension). If that
+    transaction is rolled back, call discard_unreferenced().
+    """
+    storage = get_storage()
+    try:
+        candidate = storage.blob_relative_path(digest, os.path.splitext(secure_filename(filename))[1].lower())
+        # Reference first: the write keeps discard_unreferenced() in other
+        # requests from deleting the file between the check below and our commit
+        _add_reference(digest, candidate, size)
+        relative = db.session.execute(select(Blob.storage_path).where(Blob.sha256 == digest)).scalar_one()
+        full = storage.path(relative)
+        if os.path.exists(full):
+            os.remove(temp_path)
+        else:
+            # New content, or content whose file was released
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            os.replace(temp_path, full)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return relative
+
+
+def release(digest):
+    """Drop one committed reference to stored content; the caller commits.
+
+    The Blob row goes with the last reference. After the commit, call
+    discard_unreferenced() to delete the files if nothing claimed the
+    content in the meantime.
+    """
+    db.session.execute(update(Blob).where(Blob.sha256 == digest).values(ref_count=Blob.ref_count - 1))
+    db.session.execute(delete(Blob).where(Blob.sha256 == digest, Blob.ref_count <= 0))
+
+
+def discard_unreferenced(digest, relative):
+    """Delete stored content nothing references any more, and commit.
+
+    Used after release() has been committed, and after a store() whose
+    transaction was rolled back (the reference went with it). The blob
+    goes together with everything media.py derived from it, unless a
+    committed Blob still claims the content.
+    """
+    # A write first, so a concurrent store() can't claim the file between the check and the delete
+    db.session.execute(delete(Blob).where(Blob.sha256 == digest, Blob.ref_count <= 0))
+    claimed = db.session.execute(select(Blob.sha256).where(Blob.sha256 == digest)).first()
+    if claimed is None:
+        stem = os.path.splitext(get_storage().path(relative))[0]
+        for path in glob.glob(glob.escape(stem) + '.*'):
+            os.remove(path)
+    db.session.commit()
+
+
+def find_retry(device_id, key):
+    """The device's Upload created with this Idempotency-Key, or None."""
+    if not key:
+        return None
+    return Upload.query.filter_by(device_id=device_id, idempotency_key=key).first()
+
+
+def stored_size(upload):
+    """Size of the content as uploaded (size_bytes describes the served, possibly transcoded, file)."""
+    blob = db.session.get(Blob, upload.sha256) if upload.sha256 else None
+    return blob.size_bytes if blob is not None else upload.size_bytes
@@ -0,0 +1,182 @@
+"""
+Device registry.
+
+Every Upload row references a Device. Devices are created on first contact
+(registration, upload or location fix) and read through a process-local
+LRU cache with a TTL, so the per-upload existence check and the dashboard's
+per-device lookups normally never reach the database. Writes invalidate
+the cached entry; the TTL bounds staleness for writes made by other
+processes.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import case, or_, select, update
+from . import db
+from .models import Device
+from .http_cache import bump_data_version
+
+
+class DeviceCache:
+    """LRU of device snapshots (plain dicts), each valid for `ttl` seconds."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, device_id, ttl):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None:
+                return None
+            loaded_at, device = entry
+            if time.monotonic() - loaded_at > ttl:
+                del self._entries[device_id]
+                return None
+            self._entries.move_to_end(device_id)
+            return device
+
+    def put(self, device_id, device):
+        with self._lock:
+            self._entries[device_id] = (time.monotonic(), device)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, device_id, **values):
+        """Apply a write to a cached entry without resetting its age."""
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                self._entries[device_id] = (entry[0], {**entry[1], **values})
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+device_cache = DeviceCache()
+
+
+def _snapshot(device):
+    return {
+        'device_id': device.device_id,
+        'name': device.name,
+        'registered_at': device.registered_at,
+        'last_seen': device.last_seen,
+        'latitude': device.latitude,
+        'longitude': device.longitude,
+        'position_at': device.position_at,
+        'status': device.status,
+    }
+
+
+def get_device(device_id):
+    """Cached snapshot of a device, or None if it is not registered."""
+    ttl = current_app.config['DEVICE_CACHE_TTL']
+    device = device_cache.get(device_id, ttl)
+    if device is None:
+        with db.session.no_autoflush:
+            row = db.session.get(Device, device_id, populate_existing=True)
+        if row is None:
+            return None
+        device = _snapshot(row)
+        device_cache.put(device_id, device)
+    return device
+
+
+def _insert_ignore():
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(Device).on_conflict_do_nothing(index_elements=['device_id'])
+
+
+def ensure_device(device_id, name=None):
+    """Make sure a Device row exists before rows referencing it are flushed.
+
+    Runs in the caller's transaction. A cache hit costs no query at all.
+    """
+    if get_device(device_id) is not None:
+        return
+
+    # Pending Upload rows must not be flushed ahead of their Device
+    with db.session.no_autoflush:
+        statement = _insert_ignore()
+        if statement is not None:
+            db.session.execute(statement.values(
+                device_id=device_id, name=name, registered_at=datetime.utcnow(), status='idle'
+            ))
+        elif db.session.get(Device, device_id) is None:
+            device = Device(device_id=device_id, name=name, registered_at=datetime.utcnow(), status='idle')
+            db.session.add(device)
+            db.session.flush([device])
+
+
+def register_device(device_id, name=None):
+    """Create or rename a device and commit. Returns its snapshot."""
+    ensure_device(device_id, name)
+    if name:
+        db.session.execute(
+            update(Device).where(Device.device_id == device_id).values(name=name)
+            .execution_options(synchronize_session=False)
+        )
+    bump_data_version()
+    db.session.commit()
+    device_cache.invalidate(device_id)
+    return get_device(device_id)
+
+
+def touch_device(device_id, when, latitude=None, longitude=None):
+    """Advance a device's last_seen, and its position if given, in the caller's transaction.
+
+    A position only replaces one reported earlier, so fixes and uploads
+    arriving out of order leave the newest in place.
+    """
+    is_newer = or_(Device.last_seen.is_(None), Device.last_seen <= when)
+    values = {'last_seen': case((is_newer, when), else_=Device.last_seen)}
+    located = latitude is not None and longitude is not None
+    if located:
+        is_newer_position = or_(Device.position_at.is_(None), Device.position_at <= when)
+        values['latitude'] = case((is_newer_position, latitude), else_=Device.latitude)
+        values['longitude'] = case((is_newer_position, longitude), else_=Device.longitude)
+        values['position_at'] = case((is_newer_position, when), else_=Device.position_at)
+    db.session.execute(
+        update(Device).where(Device.device_id == device_id).values(**values)
+        .execution_options(synchronize_session=False)
+    )
+
+    # Keep the entry warm so the next upload from this device is still a cache hit
+    cached = device_cache.get(device_id, current_app.config['DEVICE_CACHE_TTL'])
+    if cached is not None:
+        changes = {}
+        if cached['last_seen'] is None or cached['last_seen'] <= when:
+            changes['last_seen'] = when
+        if located and (cached['position_at'] is None or cached['position_at'] <= when):
+            changes.update(latitude=latitude, longitude=longitude, position_at=when)
+        if changes:
+            device_cache.update(device_id, **changes)
+
+
+def known_positions():
+    """{device_id: (latitude, longitude, position_at)} of every device with a known position.
+
+    Read from the table, not the cache: callers build responses cached per
+    data version, which other processes' writes advance.
+    """
+    rows = db.session.execute(
+        select(Device.device_id, Device.latitude, Device.longitude, Device.position_at)
+        .where(Device.latitude.isnot(None), Device.longitude.isnot(None))
+    )
+    return {row.device_id: (row.latitude, row.longitude, row.position_at) for row in rows}
@@ -0,0 +1,60 @@
+"""
+Serving stored recordings.
+
+FILE_SERVE_MODE picks who streams the bytes once Flask has looked the
+file up:
+
+    'flask'       send_file from the worker. Range (206/416), If-Range,
+                  If-None-Match and If-Modified-Since are answered here,
+                  but the worker is busy for the whole transfer.
+    'x-accel'     nginx: an empty response with X-Accel-Redirect pointing
+                  at FILE_SERVE_INTERNAL_PREFIX + the path below
+                  UPLOAD_FOLDER. nginx serves it from its internal location
+                  with sendfile, including ranges and conditional requests,
+                  and the worker is free as soon as the headers are out.
+    'x-sendfile'  the same for Apache/lighttpd, with the absolute path.
+                  asgi.py understands it too and streams the file from
+                  its event loop (see app/asgi.py).
+
+Stored files are named by content hash, so every mode names the download
+after the public filename instead (Content-Disposition).
+"""
+import mimetypes
+import os
+from urllib.parse import quote
+from flask import current_app, send_file, Response
+from .storage import get_storage
+
+MODES = ('flask', 'x-accel', 'x-sendfile')
+
+
+def public_download_name(public_name, filepath, suffix=''):
+    """The public filename, with the extension of the file actually served (a transcode may differ)."""
+    return f"{os.path.splitext(public_name)[0]}{suffix}{os.path.splitext(filepath)[1]}"
+
+
+def send_stored_file(filepath, download_name=None):
+    """Response for a file below UPLOAD_FOLDER, served according to FILE_SERVE_MODE."""
+    config = current_app.config
+    mode = config['FILE_SERVE_MODE']
+    max_age = config['UPLOAD_CACHE_MAX_AGE']
+    download_name = download_name or os.path.basename(filepath)
+    mimetype = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+
+    if mode == 'flask':
+        return send_file(filepath, mimetype=mimetype, download_name=download_name,
+                         conditional=True, etag=True, max_age=max_age)
+
+    response = Response(mimetype=mimetype)
+    response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(download_name)}"
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+
+    if mode == 'x-accel':
+        relative = os.path.relpath(filepath, get_storage().root).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = config['FILE_SERVE_INTERNAL_PREFIX'] + quote(relative)
+    elif mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = filepath
+    else:
+        raise ValueError(f"Unknown FILE_SERVE_MODE {mode!r}; expected one of {MODES}")
+    return response
@@ -0,0 +1,144 @@
+"""
+Dashboard change feed.
+
+Write paths publish small delta events (a new upload, a device being seen,
+a location change) and /api/dashboard/stream fans them out to every
+connected dashboard over Server-Sent Events. Each web process keeps one
+set of subscriber queues; with EVENT_BACKEND='redis' each process also
+holds a single Redis pub/sub subscription, so events published by Celery
+workers or other gunicorn workers reach every dashboard.
+"""
+import json
+import queue
+import threading
+from flask import current_app
+
+CHANNEL = 'buas:dashboard-events'
+
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        # Set when events were dropped; the stream resyncs with a fresh snapshot
+        self.overflowed = False
+
+
+class MemoryBroker:
+    """Fan events out to subscribers within this process."""
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, limit=None):
+        """A new Subscription, or None if `limit` subscribers are already connected."""
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event_type, data):
+        self._deliver(event_type, data)
+
+    def _deliver(self, event_type, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait((event_type, data))
+            except queue.Full:
+                subscription.overflowed = True
+
+
+class RedisBroker(MemoryBroker):
+    """Publish through Redis so every process sees every event.
+
+    One listener thread per process relays the channel to local subscribers.
+    """
+
+    def __init__(self, url, queue_size=1000):
+        super().__init__(queue_size)
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+
+    def subscribe(self, limit=None):
+        self._ensure_listener()
+        return super().subscribe(limit)
+
+    def publish(self, event_type, data):
+        self._redis.publish(CHANNEL, json.dumps({'type': event_type, 'data': data}))
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='dashboard-events', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        for message in pubsub.listen():
+            try:
+                event = json.loads(message['data'])
+                self._deliver(event['type'], event['data'])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker(app=None):
+    global _broker
+    app = app or current_app
+    with _broker_lock:
+        if _broker is None:
+            if app.config['EVENT_BACKEND'] == 'redis':
+                _broker = RedisBroker(app.config['EVENT_REDIS_URL'], app.config['EVENT_QUEUE_SIZE'])
+            else:
+                _broker = MemoryBroker(app.config['EVENT_QUEUE_SIZE'])
+    return _broker
+
+
+def publish(event_type, data):
+    """Publish an event; failures are logged, never raised into a write path."""
+    try:
+        get_broker().publish(event_type, data)
+    except Exception as e:
+        current_app.logger.warning(f"Failed to publish {event_type} event: {e}")
+
+
+def publish_upload(upload):
+    """Announce a committed Upload: the upload itself, the device, and its location."""
+    from .pagination import serialize_upload
+
+    publish('upload', {'device_id': upload.device_id, 'upload': serialize_upload(upload)})
+    publish('device_seen', {'device_id': upload.device_id, 'last_seen': upload.timestamp.isoformat()})
+    publish_location(upload)
+
+
+def publish_location(upload):
+    if upload.latitude is not None and upload.longitude is not None:
+        publish('location', {
+            'device_id': upload.device_id,
+            'lat': upload.latitude,
+            'lng': upload.longitude,
+            'timestamp': upload.timestamp.isoformat()
+        })
+
+
+def format_sse(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,231 @@
+"""
+Spatial queries over device positions.
+
+On SQLite every location_fix and located upload row is mirrored into an
+R*Tree virtual table (location_fix_rtree, upload_rtree) by triggers, so
+bounding-box and radius searches touch only the rows in the area instead
+of scanning both tables. The triggers keep the index current for every
+write path, batched or not. On other databases, or a SQLite build without
+the R*Tree module, the same queries fall back to plain range filters.
+
+Nearest-device lookups use last known positions, kept on the device rows
+and indexed the same way (device_rtree, keyed by rowid): the search box
+grows until it holds enough devices, so it never reads every device.
+"""
+import math
+from flask import current_app
+from sqlalchemy import text, DateTime, Integer, String, Float
+from . import db
+from .devices import known_positions
+
+EARTH_RADIUS_M = 6371000.0
+METRES_PER_DEGREE = 111320.0
+
+# (rtree table, source table, timestamp column)
+SPATIAL_TABLES = [
+    ('location_fix_rtree', 'location_fix', 'recorded_at'),
+    ('upload_rtree', 'upload', 'timestamp'),
+]
+# (rtree table, source table, integer key) of every index the triggers maintain
+INDEXED_TABLES = [(rtree, source, 'id') for rtree, source, _ in SPATIAL_TABLES] + [
+    ('device_rtree', 'device', 'rowid'),
+]
+NEAREST_START_RADIUS_M = 1000.0
+
+
+def ensure_spatial_index(engine):
+    """Create the R*Tree tables and triggers if missing, (re)indexing existing rows.
+
+    Returns True when the index is available.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    try:
+        with engine.begin() as conn:
+            for rtree, source, key in INDEXED_TABLES:
+                existing = set(conn.execute(
+                    text("SELECT name FROM sqlite_master WHERE name IN (:table, :trigger)"),
+                    {'table': rtree, 'trigger': f"{rtree}_insert"}
+                ).scalars())
+                if len(existing) == 2:
+                    if key == 'rowid':
+                        _resync_rowid_index(conn, rtree, source)
+                    continue
+
+                # A rebuilt source table loses its triggers; re-index it from scratch
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {rtree}_insert"))
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {rtree}_update"))
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {rtree}_delete"))
+                conn.execute(text(f"DROP TABLE IF EXISTS {rtree}"))
+                conn.execute(text(f"CREATE VIRTUAL TABLE {rtree} USING rtree(id, min_lat, max_lat, min_lng, max_lng)"))
+                conn.execute(text(
+                    f"INSERT INTO {rtree} SELECT {key}, latitude, latitude, longitude, longitude FROM {source} "
+                    f"WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {rtree}_insert AFTER INSERT ON {source} "
+                    f"WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN "
+                    f"INSERT INTO {rtree} VALUES (new.{key}, new.latitude, new.latitude, new.longitude, new.longitude); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {rtree}_update AFTER UPDATE OF latitude, longitude ON {source} BEGIN "
+                    f"DELETE FROM {rtree} WHERE id = old.{key}; "
+                    f"INSERT INTO {rtree} SELECT new.{key}, new.latitude, new.latitude, new.longitude, new.longitude "
+                    f"WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL; END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {rtree}_delete AFTER DELETE ON {source} BEGIN "
+                    f"DELETE FROM {rtree} WHERE id = old.{key}; END"
+                ))
+                print(f"Created spatial index {rtree}")
+    except Exception as e:
+        print(f"Spatial index unavailable, falling back to range scans: {e}")
+        return False
+    return True
+
+
+def _resync_rowid_index(conn, rtree, source):
+    """Refill an index keyed by rowid if it no longer matches its table.
+
+    device has no INTEGER PRIMARY KEY, so a VACUUM may renumber its rowids
+    under the index. Rows only, no DDL, so processes starting together
+    don't trip over each other's triggers.
+    """
+    located = conn.execute(text(
+        f"SELECT COUNT(*) FROM {source} WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+    )).scalar()
+    # The R*Tree stores 32-bit boxes that enclose each point
+    matching = conn.execute(text(
+        f"SELECT COUNT(*) FROM {rtree} r JOIN {source} s ON s.rowid = r.id "
+        f"WHERE r.min_lat <= s.latitude AND s.latitude <= r.max_lat "
+        f"AND r.min_lng <= s.longitude AND s.longitude <= r.max_lng"
+    )).scalar()
+    indexed = conn.execute(text(f"SELECT COUNT(*) FROM {rtree}")).scalar()
+    if located == matching == indexed:
+        return
+    conn.execute(text(f"DELETE FROM {rtree}"))
+    conn.execute(text(
+        f"INSERT INTO {rtree} SELECT rowid, latitude, latitude, longitude, longitude FROM {source} "
+        f"WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+    ))
+    print(f"Re-indexed {rtree}")
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lng, radius_m):
+    """(min_lat, min_lng, max_lat, max_lng) enclosing a circle."""
+    dlat = radius_m / METRES_PER_DEGREE
+    dlng = radius_m / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return max(lat - dlat, -90.0), max(lng - dlng, -180.0), min(lat + dlat, 90.0), min(lng + dlng, 180.0)
+
+
+def _use_rtree(use_index):
+    if use_index is None:
+        return current_app.extensions.get('spatial_index', False)
+    return use_index
+
+
+def _points_sql(columns, use_index, start, end):
+    """UNION ALL of fixes and located uploads in :min_lat..:max_lat x :min_lng..:max_lng."""
+    parts = []
+    for rtree, source, ts in SPATIAL_TABLES:
+        select_list = columns.format(ts=f"s.{ts}")
+        if use_index:
+            # R*Tree coordinates are 32-bit floats, so recheck the exact values
+            sql = (f"SELECT {select_list} FROM {rtree} r JOIN {source} s ON s.id = r.id "
+                   f"WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat "
+                   f"AND r.max_lng >= :min_lng AND r.min_lng <= :max_lng AND ")
+        else:
+            sql = f"SELECT {select_list} FROM {source} s WHERE "
+        sql += "s.latitude BETWEEN :min_lat AND :max_lat AND s.longitude BETWEEN :min_lng AND :max_lng"
+        if start is not None:
+            sql += f" AND s.{ts} >= :start"
+        if end is not None:
+            sql += f" AND s.{ts} <= :end"
+        parts.append(sql)
+    return " UNION ALL ".join(parts)
+
+
+def devices_in_bbox(min_lat, min_lng, max_lat, max_lng, start=None, end=None, use_index=None):
+    """Devices with positions inside the box: [{device_id, points, last_seen}], latest first."""
+    inner = _points_sql("s.device_id AS device_id, {ts} AS ts", _use_rtree(use_index), start, end)
+    query = text(
+        f"SELECT device_id, COUNT(*) AS points, MAX(ts) AS last_seen FROM ({inner}) "
+        f"GROUP BY device_id ORDER BY last_seen DESC"
+    ).columns(device_id=String, points=Integer, last_seen=DateTime)
+    rows = db.session.execute(query, {
+        'min_lat': min_lat, 'min_lng': min_lng, 'max_lat': max_lat, 'max_lng': max_lng,
+        'start': start, 'end': end
+    })
+    return [{'device_id': r.device_id, 'points': r.points, 'last_seen': r.last_seen} for r in rows]
+
+
+def devices_in_radius(lat, lng, radius_m, start=None, end=None, use_index=None):
+    """Devices with positions within radius_m: [{device_id, points, last_seen, distance_m}], nearest first."""
+    min_lat, min_lng, max_lat, max_lng = radius_bbox(lat, lng, radius_m)
+    inner = _points_sql("s.device_id AS device_id, {ts} AS ts, s.latitude AS lat, s.longitude AS lng",
+                        _use_rtree(use_index), start, end)
+    query = text(inner).columns(device_id=String, ts=DateTime, lat=Float, lng=Float)
+    rows = db.session.execute(query, {
+        'min_lat': min_lat, 'min_lng': min_lng, 'max_lat': max_lat, 'max_lng': max_lng,
+        'start': start, 'end': end
+    })
+
+    # The box is a superset of the circle; keep exact matches only
+    devices = {}
+    for row in rows:
+        distance = haversine_m(lat, lng, row.lat, row.lng)
+        if distance > radius_m:
+            continue
+        device = devices.setdefault(row.device_id, {
+            'device_id': row.device_id, 'points': 0, 'last_seen': row.ts, 'distance_m': distance
+        })
+        device['points'] += 1
+        device['last_seen'] = max(device['last_seen'], row.ts)
+        device['distance_m'] = min(device['distance_m'], distance)
+    return sorted(devices.values(), key=lambda d: d['distance_m'])
+
+
+def _indexed_positions(lat, lng, limit):
+    """{device_id: (lat, lng, position_at)} from device_rtree, enough to hold the `limit` nearest."""
+    radius = NEAREST_START_RADIUS_M
+    query = text(
+        "SELECT d.device_id, d.latitude, d.longitude, d.position_at FROM device_rtree r "
+        "JOIN device d ON d.rowid = r.id "
+        "WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat "
+        "AND r.max_lng >= :min_lng AND r.min_lng <= :max_lng"
+    ).columns(device_id=String, latitude=Float, longitude=Float, position_at=DateTime)
+    while True:
+        min_lat, min_lng, max_lat, max_lng = radius_bbox(lat, lng, radius)
+        rows = db.session.execute(query, {
+            'min_lat': min_lat, 'min_lng': min_lng, 'max_lat': max_lat, 'max_lng': max_lng
+        }).all()
+        # Only devices inside the circle are known to beat everything outside the box
+        within = sum(1 for r in rows if haversine_m(lat, lng, r.latitude, r.longitude) <= radius)
+        if within >= limit or radius >= math.pi * EARTH_RADIUS_M:
+            return {r.device_id: (r.latitude, r.longitude, r.position_at) for r in rows}
+        radius *= 4
+
+
+def nearest_devices(lat, lng, limit=10, use_index=None):
+    """Devices closest to a point by last known position: [{device_id, lat, lng, last_seen, distance_m}]."""
+    if _use_rtree(use_index):
+        known = _indexed_positions(lat, lng, limit)
+    else:
+        known = known_positions()
+
+    devices = [
+        {'device_id': device_id, 'lat': p_lat, 'lng': p_lng, 'last_seen': seen,
+         'distance_m': haversine_m(lat, lng, p_lat, p_lng)}
+        for device_id, (p_lat, p_lng, seen) in known.items()
+    ]
+    devices.sort(key=lambda d: d['distance_m'])
+    return devices[:limit]
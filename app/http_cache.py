@@ -0,0 +1,118 @@
+"""
+Conditional GET and response caching for polled endpoints.
+
+DataVersion holds one counter, bumped in the same transaction as every
+Upload write. Polled endpoints use it as their ETag: an unchanged
+version answers 304 without building anything, and a changed version is
+built once per process and served from the cache (optionally pre-gzipped)
+until the next write. Last-Modified is sent for information only: the
+version can change several times within its one-second resolution, so
+If-Modified-Since never earns a 304.
+"""
+import gzip
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app, request, Response
+from sqlalchemy import update
+from . import db
+from .models import DataVersion
+
+VERSION_ROW_ID = 1
+
+
+def ensure_data_version():
+    if db.session.get(DataVersion, VERSION_ROW_ID) is None:
+        db.session.add(DataVersion(id=VERSION_ROW_ID, version=0, updated_at=datetime.utcnow()))
+        db.session.commit()
+
+
+def bump_data_version():
+    """Mark dashboard data as changed; runs in the caller's transaction."""
+    db.session.execute(
+        update(DataVersion)
+        .where(DataVersion.id == VERSION_ROW_ID)
+        .values(version=DataVersion.version + 1, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def current_data_version():
+    """(version, updated_at) as last committed."""
+    row = db.session.execute(
+        db.select(DataVersion.version, DataVersion.updated_at).where(DataVersion.id == VERSION_ROW_ID)
+    ).first()
+    return (row.version, row.updated_at) if row else (0, datetime.utcnow())
+
+
+class ResponseCache:
+    """Small LRU of serialized bodies keyed by (key, version)."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, key, version, body, gzipped, headers):
+        with self._lock:
+            self._entries[key] = (version, body, gzipped, headers)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache()
+
+
+def cached_json_response(key, build):
+    """Serve build()'s JSON for `key`, honouring If-None-Match.
+
+    `build` returns the payload, or (payload, extra_headers). It is only
+    called when this process has no body for the current data version.
+    """
+    version, updated_at = current_data_version()
+    etag = f"{zlib.crc32(key.encode('utf-8')):08x}-{version}"
+    last_modified = updated_at.replace(microsecond=0)
+
+    # Every response carries an ETag, so If-Modified-Since is never needed
+    # (and its whole seconds could hide a newer version)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        cached = response_cache.get(key, version)
+        if cached is None:
+            payload = build()
+            headers = {}
+            if isinstance(payload, tuple):
+                payload, headers = payload
+            body = json.dumps(payload).encode('utf-8')
+            gzipped = None
+            if current_app.config['RESPONSE_CACHE_GZIP'] and len(body) >= current_app.config['RESPONSE_CACHE_GZIP_MIN_BYTES']:
+                gzipped = gzip.compress(body, compresslevel=6)
+            response_cache.put(key, version, body, gzipped, headers)
+        else:
+            body, gzipped, headers = cached
+
+        if gzipped is not None and 'gzip' in request.accept_encodings:
+            response = Response(gzipped, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(body, mimetype='application/json')
+        response.headers.update(headers)
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Let clients keep the body but revalidate on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,70 @@
+import hashlib
+import os
+from .metrics import count_ingested
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, expected, actual):
+        super().__init__(f"Checksum mismatch: expected {expected}, got {actual}")
+        self.actual = actual
+
+
+def copy_stream(stream, out, max_bytes=None, chunk_size=DEFAULT_CHUNK_SIZE, digest=None):
+    """Copy `stream` into the open file `out` chunk by chunk.
+
+    Raises UploadTooLarge as soon as more than `max_bytes` have been read.
+    Returns the number of bytes copied.
+    """
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+        if digest is not None:
+            digest.update(chunk)
+        out.write(chunk)
+    count_ingested(size)
+    return size
+
+
+def file_sha256(filepath, chunk_size=DEFAULT_CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stream_to_file(stream, filepath, max_bytes=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                   expected_sha256=None):
+    """Copy a request body stream to `filepath` one chunk at a time.
+
+    The body is written to `filepath + '.part'` and renamed into place once
+    complete (and, if given, once `expected_sha256` matches), so readers
+    never see a truncated recording and nothing is copied twice.
+    Returns (size_in_bytes, sha256_hexdigest).
+    """
+    part_path = filepath + '.part'
+    digest = hashlib.sha256()
+
+    try:
+        with open(part_path, 'wb') as out:
+            size = copy_stream(stream, out, max_bytes, chunk_size, digest)
+        if expected_sha256 and expected_sha256.lower() != digest.hexdigest():
+            raise ChecksumMismatch(expected_sha256, digest.hexdigest())
+        os.replace(part_path, filepath)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return size, digest.hexdigest()
@@ -0,0 +1,166 @@
+"""
+Listening sessions.
+
+A device is either idle or listening. start_listening opens a
+ListeningSession (starting an already listening device returns its open
+session), stop_listening closes it, and every upload recorded in between
+is linked to the session through Upload.session_id.
+
+The open sessions are mirrored in ActiveSessions, an in-memory map keyed
+by device, so the dashboard status and the per-upload session lookup are
+dictionary reads. Writes in this process update the map directly; writes
+from other processes are picked up through the data version, checked at
+most every ACTIVE_SESSION_REFRESH_SECONDS.
+"""
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import Device, ListeningSession
+from .devices import ensure_device, device_cache
+from .http_cache import bump_data_version, current_data_version
+from .events import publish
+
+
+class NotListening(Exception):
+    """stop_listening for a device without an open session."""
+
+
+class ActiveSessions:
+    """device_id -> {'session_id', 'device_id', 'started_at'} for every open session."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        interval = current_app.config['ACTIVE_SESSION_REFRESH_SECONDS']
+        with self._lock:
+            if time.monotonic() - self._checked < interval:
+                return
+        version, _ = current_data_version()
+        with self._lock:
+            fresh = version == self._version
+            self._checked = time.monotonic()
+        if fresh:
+            return
+        sessions = {
+            s.device_id: _snapshot(s)
+            for s in ListeningSession.query.filter(ListeningSession.stopped_at.is_(None))
+        }
+        with self._lock:
+            self._sessions, self._version = sessions, version
+
+    def get(self, device_id):
+        self._refresh()
+        with self._lock:
+            return self._sessions.get(device_id)
+
+    def all(self):
+        self._refresh()
+        with self._lock:
+            return sorted(self._sessions.values(), key=lambda s: s['started_at'])
+
+    def opened(self, session):
+        with self._lock:
+            self._sessions[session['device_id']] = session
+
+    def closed(self, device_id):
+        with self._lock:
+            self._sessions.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions, self._version, self._checked = {}, None, 0.0
+
+
+active_sessions = ActiveSessions()
+
+
+def _snapshot(session):
+    return {
+        'session_id': session.id,
+        'device_id': session.device_id,
+        'started_at': session.started_at,
+    }
+
+
+def _set_device_status(device_id, status):
+    db.session.execute(
+        update(Device).where(Device.device_id == device_id).values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _open_session(device_id):
+    return ListeningSession.query.filter_by(device_id=device_id, stopped_at=None).first()
+
+
+def start_listening(device_id):
+    """Open a session for the device, or return the one already open. Returns (snapshot, created)."""
+    existing = _open_session(device_id)
+    if existing is not None:
+        return _snapshot(existing), False
+
+    now = datetime.utcnow()
+    ensure_device(device_id)
+    session = ListeningSession(
+        id=f"session_{device_id}_{now.strftime('%Y%m%d_%H%M%S_%f')}",
+        device_id=device_id,
+        started_at=now
+    )
+    db.session.add(session)
+    _set_device_status(device_id, 'listening')
+    bump_data_version()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process opened one first
+        db.session.rollback()
+        return _snapshot(_open_session(device_id)), False
+
+    snapshot = _snapshot(session)
+    active_sessions.opened(snapshot)
+    device_cache.invalidate(device_id)
+    publish('session', {
+        'device_id': device_id,
+        'session_id': session.id,
+        'status': 'listening',
+        'session_start': now.isoformat()
+    })
+    return snapshot, True
+
+
+def stop_listening(device_id):
+    """Close the device's open session. Returns the closed session row; raises NotListening."""
+    session = _open_session(device_id)
+    if session is None:
+        raise NotListening(device_id)
+
+    session.stopped_at = datetime.utcnow()
+    _set_device_status(device_id, 'idle')
+    bump_data_version()
+    db.session.commit()
+
+    active_sessions.closed(device_id)
+    device_cache.invalidate(device_id)
+    publish('session', {
+        'device_id': device_id,
+        'session_id': session.id,
+        'status': 'idle',
+        'session_start': None
+    })
+    return session
+
+
+def current_session_id(device_id):
+    """Open session of a device, for tagging uploads; a dictionary lookup in the common case."""
+    # Called while the caller's Upload is still pending; don't flush it early
+    with db.session.no_autoflush:
+        session = active_sessions.get(device_id)
+    return session['session_id'] if session else None
@@ -0,0 +1,124 @@
+"""
+Location history and last known positions.
+
+/api/location hands each fix to a BatchWriter, which appends whole batches
+to the location_fix table in one transaction, so frequent GPS pings do not
+cost a commit each. The same transaction moves each device's last known
+position on its device row (devices.touch_device), the one place that
+position is kept; the dashboard and nearest-device searches read it there.
+"""
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import insert
+from . import db
+from .models import LocationFix
+from .batching import BatchWriter
+from .http_cache import bump_data_version
+from .events import publish
+from .devices import ensure_device, touch_device
+
+_location_batcher = None
+
+
+def parse_fix_time(value):
+    """Device timestamp (ISO 8601, epoch seconds or epoch milliseconds) as naive UTC."""
+    if value is None or value == '':
+        return datetime.utcnow()
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp: {value}")
+    if isinstance(value, (int, float)):
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"Invalid timestamp: {value}")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    raise ValueError(f"Invalid timestamp: {value}")
+
+
+def validate_fix(device_id, latitude, longitude, timestamp=None, accuracy=None):
+    """Check one fix and return it as a location_fix row dict; raises ValueError."""
+    if not device_id:
+        raise ValueError('phone_id is required')
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+        accuracy = float(accuracy) if accuracy is not None else None
+    except (TypeError, ValueError):
+        raise ValueError('latitude, longitude and accuracy must be numbers')
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError('latitude or longitude out of range')
+    return {
+        'device_id': device_id,
+        'recorded_at': parse_fix_time(timestamp),
+        'latitude': latitude,
+        'longitude': longitude,
+        'accuracy': accuracy,
+    }
+
+
+def _latest_per_device(rows):
+    latest = {}
+    for row in rows:
+        if row['device_id'] not in latest or row['recorded_at'] >= latest[row['device_id']]['recorded_at']:
+            latest[row['device_id']] = row
+    return latest
+
+
+def stage_fixes(rows):
+    """Insert fixes and move device positions in the caller's transaction."""
+    db.session.execute(insert(LocationFix), rows)
+    for device_id, row in _latest_per_device(rows).items():
+        ensure_device(device_id)
+        touch_device(device_id, row['recorded_at'], row['latitude'], row['longitude'])
+    bump_data_version()
+
+
+def fixes_committed(rows):
+    """Tell live dashboards about staged fixes once they are committed."""
+    for row in _latest_per_device(rows).values():
+        publish('location', {
+            'device_id': row['device_id'],
+            'lat': row['latitude'],
+            'lng': row['longitude'],
+            'timestamp': row['recorded_at'].isoformat()
+        })
+
+
+def _flush_locations(rows):
+    """Append a batch of fixes in one transaction."""
+    try:
+        stage_fixes(rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Failed to store {len(rows)} location fixes: {e}")
+        raise
+    fixes_committed(rows)
+
+
+def get_location_batcher():
+    """Per-process BatchWriter feeding _flush_locations."""
+    global _location_batcher
+    if _location_batcher is None:
+        app = current_app._get_current_object()
+        _location_batcher = BatchWriter(
+            app,
+            _flush_locations,
+            flush_size=app.config['LOCATION_BATCH_SIZE'],
+            flush_interval=app.config['LOCATION_FLUSH_INTERVAL'],
+            name='location-batcher',
+            # Clients already have their 200; a failed batch is kept and tried again
+            requeue=True,
+            max_pending=app.config['LOCATION_MAX_PENDING']
+        )
+    return _location_batcher
+
+
+def record_fix(row):
+    """Queue one validated fix for the next batch; raises BatchFull while fixes can't be stored."""
+    get_location_batcher().add(row)
@@ -0,0 +1,198 @@
+"""
+Post-upload audio processing.
+
+Runs on the Celery 'media' queue (tasks.process_upload_media), never in a
+web worker. Each recording is probed once with ffprobe; uncompressed or
+oversized recordings are transcoded to TRANSCODE_CODEC at
+TRANSCODE_BITRATE, and every recording gets a low-bitrate mono preview
+next to it, plus waveform peaks (peaks.py). Duration, size and codec are
+stored on the Upload row.
+
+The public filename never changes: storage_path is repointed at the
+transcoded file, so /api/uploads/<filename> serves the compact version.
+The original stays where it was (original_path) unless
+TRANSCODE_KEEP_ORIGINALS is off; then the transcode is stored as content
+of its own, the upload's reference to the original is released, and the
+original goes once no other upload shares it. Uploads with identical
+content share one stored file (dedupe.py), so only the first of them is
+processed; the others copy its results.
+"""
+import json
+import os
+import subprocess
+import uuid
+from datetime import datetime
+from flask import current_app
+from .storage import get_storage
+from .ingest import file_sha256
+from .dedupe import incoming_dir, store, release
+
+# Formats worth re-encoding regardless of bitrate
+LOSSLESS_CODECS = ('flac', 'alac', 'wavpack', 'ape')
+
+
+class MediaError(RuntimeError):
+    pass
+
+
+def _run(args):
+    timeout = current_app.config['MEDIA_TIMEOUT']
+    try:
+        result = subprocess.run(args, capture_output=True, timeout=timeout)
+    except FileNotFoundError:
+        raise MediaError(f"{args[0]} not found; install ffmpeg on media workers")
+    except subprocess.TimeoutExpired:
+        raise MediaError(f"{args[0]} took longer than {timeout}s")
+    if result.returncode != 0:
+        raise MediaError(result.stderr.decode(errors='replace').strip()[-500:])
+    return result.stdout
+
+
+def probe(path):
+    """{'duration', 'codec', 'bit_rate'} of the first audio stream."""
+    output = _run([
+        current_app.config['FFPROBE_BINARY'], '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name,bit_rate:format=duration,bit_rate', '-of', 'json', path
+    ])
+    info = json.loads(output or b'{}')
+    stream = (info.get('streams') or [{}])[0]
+    fmt = info.get('format') or {}
+    bit_rate = stream.get('bit_rate') or fmt.get('bit_rate')
+    duration = fmt.get('duration')
+    return {
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'codec': stream.get('codec_name'),
+        'bit_rate': int(bit_rate) if bit_rate not in (None, 'N/A') else None,
+    }
+
+
+def encode(source, target, codec, bitrate, mono=False):
+    """Encode source into target (format from its extension), replacing it atomically."""
+    stem, ext = os.path.splitext(target)
+    partial = f"{stem}.part{ext}"
+    args = [current_app.config['FFMPEG_BINARY'], '-nostdin', '-y', '-v', 'error', '-i', source,
+            '-vn', '-threads', '1', '-c:a', codec, '-b:a', bitrate]
+    if mono:
+        args += ['-ac', '1']
+    try:
+        _run(args + [partial])
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def _bits_per_second(bitrate):
+    value = str(bitrate).lower()
+    return int(float(value[:-1]) * 1000) if value.endswith('k') else int(value)
+
+
+def needs_transcode(info):
+    codec = info['codec'] or ''
+    if codec.startswith('pcm_') or codec in LOSSLESS_CODECS:
+        return True
+    # Already compressed: only worth it when far above the target bitrate
+    target = _bits_per_second(current_app.config['TRANSCODE_BITRATE'])
+    return bool(info['bit_rate']) and info['bit_rate'] > 2 * target
+
+
+def _sibling(path, suffix):
+    stem = os.path.splitext(path)[0]
+    candidate = f"{stem}{suffix}{current_app.config['TRANSCODE_EXTENSION']}"
+    if os.path.abspath(candidate) == os.path.abspath(path):
+        candidate = f"{stem}.transcoded{suffix}{current_app.config['TRANSCODE_EXTENSION']}"
+    return candidate
+
+
+def process_upload(upload, source, created):
+    """Transcode and preview one recording and update its row; the caller commits.
+
+    With TRANSCODE_KEEP_ORIGINALS off, the transcode is stored as content
+    of its own and the upload is moved onto it, releasing its reference to
+    the original in the same transaction: other uploads may still share
+    that original. Content added to storage is appended to `created` as
+    (sha256, storage_path) as soon as it exists, so the caller can discard
+    it if the commit fails. Returns the released original as (sha256,
+    storage_path) for discard_unreferenced() after the commit - sha256 is
+    None for a file stored before content addressing - or None.
+    """
+    config = current_app.config
+    storage = get_storage()
+    info = probe(source)
+    served = source
+    base = source  # Preview and peaks are named after the stored file they belong to
+    transcode = None
+    released = None
+
+    try:
+        if needs_transcode(info):
+            if config['TRANSCODE_KEEP_ORIGINALS']:
+                served = _sibling(source, '')
+                encode(source, served, config['TRANSCODE_CODEC'], config['TRANSCODE_BITRATE'])
+                upload.original_path = os.path.relpath(source, storage.root)
+                upload.storage_path = os.path.relpath(served, storage.root)
+            else:
+                transcode = os.path.join(incoming_dir(), f"{uuid.uuid4().hex}{config['TRANSCODE_EXTENSION']}")
+                encode(source, transcode, config['TRANSCODE_CODEC'], config['TRANSCODE_BITRATE'])
+                digest = file_sha256(transcode)
+                base = storage.path(storage.blob_relative_path(digest, config['TRANSCODE_EXTENSION']))
+                os.makedirs(os.path.dirname(base), exist_ok=True)
+                created.append((digest, os.path.relpath(base, storage.root)))
+                served = transcode
+            transcoded = probe(served)
+            info = {**transcoded, 'duration': transcoded['duration'] or info['duration']}
+
+        preview = _sibling(base, '.preview')
+        encode(served, preview, config['TRANSCODE_CODEC'], config['PREVIEW_BITRATE'], mono=True)
+
+        # Decoded once more for the waveform; the compact file is the cheaper one to read
+        from .peaks import build_peaks
+        peaks = f"{os.path.splitext(base)[0]}.peaks"
+        build_peaks(served, peaks)
+
+        upload.size_bytes = os.path.getsize(served)
+        if transcode is not None:
+            # Last, so the Blob rows are only written once the slow work is done
+            relative = store(transcode, upload.size_bytes, digest, transcode)
+            transcode = None
+            released = (upload.sha256, os.path.relpath(source, storage.root))
+            if upload.sha256:
+                release(upload.sha256)
+            upload.sha256 = digest
+            upload.storage_path = relative
+            upload.original_path = None
+    finally:
+        if transcode is not None and os.path.exists(transcode):
+            os.remove(transcode)
+
+    upload.preview_path = os.path.relpath(preview, storage.root)
+    upload.peaks_path = os.path.relpath(peaks, storage.root)
+    upload.duration = info['duration']
+    upload.codec = info['codec']
+    upload.processed_at = datetime.utcnow()
+    return released
+
+
+def processed_duplicate(upload):
+    """Another Upload with the same content whose processing has finished, or None."""
+    from .models import Upload
+
+    if not upload.sha256:
+        return None
+    return (
+        Upload.query
+        .filter(Upload.sha256 == upload.sha256, Upload.id != upload.id, Upload.processed_at.isnot(None))
+        .first()
+    )
+
+
+def copy_processed(upload, done):
+    """Point the upload at the files already made for `done`; the caller commits.
+
+    `done` still references the same content (an upload moved onto its own
+    transcode no longer matches), so the files it serves stay as long as
+    this upload's reference does.
+    """
+    for column in ('storage_path', 'original_path', 'preview_path', 'peaks_path', 'duration', 'size_bytes', 'codec'):
+        setattr(upload, column, getattr(done, column))
+    upload.processed_at = datetime.utcnow()
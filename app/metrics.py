@@ -0,0 +1,428 @@
+"""
+Metrics and request profiling.
+
+A small in-process registry of counters, gauges and histograms, rendered
+in the Prometheus text format at /api/metrics. Collected:
+
+    buas_http_request_duration_seconds   per route/method/status (to the
+                                          response headers, so streamed
+                                          bodies are not included)
+    buas_ingested_bytes_total            request bodies stored, per route
+    buas_db_queries_total / _seconds     every SQL statement, per route
+                                          ('background' outside requests)
+    buas_db_queries_per_request          histogram, per route
+    buas_task_duration_seconds           Celery tasks, per task/state
+    buas_queue_depth                     Celery queues (Redis broker) and
+                                          in-process batch writers, read at
+                                          scrape time
+    buas_errors_total                    failures the routes report and
+                                          otherwise only print
+
+Values live in the process that recorded them: under gunicorn each worker
+has its own, so scrape the workers individually or run one. Celery
+workers export theirs on METRICS_WORKER_PORT (see start_worker_exporter).
+
+With METRICS_PROFILING on, an authorized request with ?profile=1 (or an
+X-Profile: 1 header) is sampled every PROFILE_SAMPLE_INTERVAL seconds.
+With PROFILE_SLOW_MS set, every request is sampled and those that took
+longer are kept. Profiles are written as folded stacks (flamegraph.pl,
+speedscope) to PROFILE_DIR, and the X-Profile response header names the
+file.
+"""
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from datetime import datetime
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+CELERY_QUEUES = ('celery', 'media')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelnames, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labelnames, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, key, extra)} {value:.17g}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value set directly, or read from `collect()` -> {label tuple: value} at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        return [(self.name, self.labelnames, key, None, value) for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        out = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                out.append((f"{self.name}_bucket", self.labelnames, key, ('le', f"{bound:g}"), cumulative))
+            out.append((f"{self.name}_bucket", self.labelnames, key, ('le', '+Inf'), count))
+            out.append((f"{self.name}_sum", self.labelnames, key, None, total))
+            out.append((f"{self.name}_count", self.labelnames, key, None, count))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        blocks = []
+        for metric in self._metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # One broken collector must not take the whole scrape down
+                blocks.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return '\n'.join(blocks) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'buas_http_request_duration_seconds', 'Time to produce a response', ('method', 'route', 'status')))
+requests_in_flight = registry.register(Gauge(
+    'buas_http_requests_in_flight', 'Requests currently being handled'))
+ingested_bytes = registry.register(Counter(
+    'buas_ingested_bytes_total', 'Request body bytes received by ingest routes', ('route',)))
+db_queries = registry.register(Counter(
+    'buas_db_queries_total', 'SQL statements executed', ('route',)))
+db_seconds = registry.register(Counter(
+    'buas_db_query_seconds_total', 'Time spent executing SQL statements', ('route',)))
+db_queries_per_request = registry.register(Histogram(
+    'buas_db_queries_per_request', 'SQL statements per request', ('route',), QUERY_COUNT_BUCKETS))
+task_duration = registry.register(Histogram(
+    'buas_task_duration_seconds', 'Celery task run time', ('task', 'state')))
+errors = registry.register(Counter(
+    'buas_errors_total', 'Failures handled (and printed) by the routes', ('where',)))
+
+
+def count_error(where):
+    errors.inc(where=where)
+
+
+def count_ingested(nbytes):
+    """Attribute stored body bytes to the current request (streaming bodies have no Content-Length)."""
+    if has_request_context():
+        g.metrics_ingested = g.get('metrics_ingested', 0) + nbytes
+
+
+# ------------------------------------------------------------ queue depth
+
+_redis = None
+_redis_retry_at = 0.0
+BROKER_RETRY_SECONDS = 30  # After a failed LLEN, skip the broker for this long so scrapes stay fast
+
+
+def _celery_queue_depths():
+    global _redis, _redis_retry_at
+    broker = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+    if not broker.startswith('redis') or time.monotonic() < _redis_retry_at:
+        return {}
+    try:
+        if _redis is None:
+            import redis
+            _redis = redis.Redis.from_url(broker, socket_timeout=0.5, socket_connect_timeout=0.5)
+        return {(f"celery:{name}",): _redis.llen(name) for name in CELERY_QUEUES}
+    except Exception:
+        _redis_retry_at = time.monotonic() + BROKER_RETRY_SECONDS
+        return {}
+
+
+def _batcher_depths():
+    depths = {}
+    from . import locations
+    if locations._location_batcher is not None:
+        depths[('batch:locations',)] = locations._location_batcher.pending()
+    try:
+        from . import tasks
+    except ImportError:
+        return depths
+    if tasks._metadata_batcher is not None:
+        depths[('batch:metadata',)] = tasks._metadata_batcher.pending()
+    return depths
+
+
+def _queue_depths():
+    depths = _batcher_depths()
+    depths.update(_celery_queue_depths())
+    return depths
+
+
+registry.register(Gauge('buas_queue_depth', 'Items waiting in a queue', ('queue',), collect=_queue_depths))
+
+
+# --------------------------------------------------------------- profiler
+
+class SamplingProfiler:
+    """Samples one thread's stack every `interval` seconds into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = _Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+
+def _profile_mode():
+    """None, 'explicit' (an authorized ?profile=1) or 'slow' (kept only past PROFILE_SLOW_MS)."""
+    config = current_app.config
+    if not config['METRICS_PROFILING']:
+        return None
+    if request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1':
+        from .auth import authorized
+        if authorized():
+            return 'explicit'
+    return 'slow' if config['PROFILE_SLOW_MS'] else None
+
+
+def _save_profile(folded, route, elapsed):
+    folder = current_app.config['PROFILE_DIR']
+    os.makedirs(folder, exist_ok=True)
+    slug = ''.join(c if c.isalnum() else '_' for c in route).strip('_') or 'root'
+    name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S_%f')}_{slug}_{elapsed * 1000:.0f}ms.folded"
+    with open(os.path.join(folder, name), 'w') as f:
+        f.write(folded)
+    return name
+
+
+# ------------------------------------------------------------------ hooks
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+    requests_in_flight.inc()
+    mode = _profile_mode()
+    if mode:
+        g.metrics_profile_mode = mode
+        g.metrics_profiler = SamplingProfiler(
+            threading.get_ident(), current_app.config['PROFILE_SAMPLE_INTERVAL']).start()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = _route()
+    requests_in_flight.inc(-1)
+    request_duration.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    db_queries_per_request.observe(g.pop('metrics_queries', 0), route=route)
+
+    if request.method in ('POST', 'PUT'):
+        nbytes = g.pop('metrics_ingested', None)
+        if nbytes is None:
+            nbytes = request.content_length or 0
+        if nbytes:
+            ingested_bytes.inc(nbytes, route=route)
+
+    profiler = g.pop('metrics_profiler', None)
+    if profiler is not None:
+        folded = profiler.stop()
+        if g.pop('metrics_profile_mode') == 'explicit' or elapsed * 1000 >= current_app.config['PROFILE_SLOW_MS']:
+            response.headers['X-Profile'] = _save_profile(folded, route, elapsed)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['metrics_query_started'].pop()
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'metrics_queries' in g:
+        g.metrics_queries += 1
+        route = _route()
+    else:
+        route = 'background'
+    db_queries.inc(route=route)
+    db_seconds.inc(elapsed, route=route)
+
+
+def _handle_error(exception_context):
+    # Failed statements never reach after_cursor_execute
+    started = exception_context.connection.info.get('metrics_query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def init_metrics(app, engine):
+    """Install the request hooks on `app` and the query hooks on its engine."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+# ----------------------------------------------------------------- celery
+
+_task_started = {}
+
+
+def _task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        task_duration.observe(time.perf_counter() - started, task=task.name, state=state or 'UNKNOWN')
+
+
+def start_worker_exporter(port, host='127.0.0.1'):
+    """Serve this process's metrics over plain HTTP (for Celery worker processes).
+
+    There is no authentication, so it listens on loopback unless `host` says otherwise.
+    """
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def exporter(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [registry.render().encode()]
+
+    # Each prefork child takes the next free port
+    for candidate in range(port, port + 64):
+        try:
+            server = make_server(host, candidate, exporter, handler_class=QuietHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+        return candidate
+    return None
+
+
+try:
+    from celery.signals import task_prerun, task_postrun, worker_process_init
+
+    task_prerun.connect(_task_prerun, weak=False)
+    task_postrun.connect(_task_postrun, weak=False)
+
+    @worker_process_init.connect(weak=False)
+    def _export_worker_metrics(**kwargs):
+        port = os.environ.get('METRICS_WORKER_PORT')
+        if port:
+            start_worker_exporter(int(port), os.environ.get('METRICS_WORKER_HOST', '127.0.0.1'))
+except ImportError:
+    pass
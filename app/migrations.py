@@ -0,0 +1,229 @@
+"""
+Minimal versioned schema migrations.
+
+db.create_all() creates missing tables but never alters existing ones, so
+anything that changes a table already present in a deployed uploads.db
+goes here as a numbered step. Steps must be idempotent: on a fresh
+database create_all has usually done the work already.
+"""
+from sqlalchemy import inspect, text
+
+
+def _dedupe_upload_filenames(conn):
+    """Merge Upload rows that share a filename into the oldest one.
+
+    Before the metadata task learned to update the existing row, every
+    metadata post inserted a second row for the same audio file.
+    """
+    duplicates = conn.execute(text(
+        "SELECT filename FROM upload GROUP BY filename HAVING COUNT(*) > 1"
+    )).scalars().all()
+
+    merged_columns = ('metadata_file', 'start_time', 'end_time', 'latitude', 'longitude')
+    for filename in duplicates:
+        rows = conn.execute(
+            text(f"SELECT id, {', '.join(merged_columns)} FROM upload WHERE filename = :f ORDER BY id"),
+            {'f': filename}
+        ).fetchall()
+        keep_id = rows[0][0]
+
+        # Oldest row wins, with gaps filled from the newest row that has a value
+        merged = {}
+        for index, column in enumerate(merged_columns, start=1):
+            values = [row[index] for row in rows if row[index] not in (None, '')]
+            merged[column] = values[-1] if values else rows[0][index]
+
+        conn.execute(
+            text(f"UPDATE upload SET {', '.join(f'{c} = :{c}' for c in merged_columns)} WHERE id = :id"),
+            {**merged, 'id': keep_id}
+        )
+        conn.execute(
+            text("DELETE FROM upload WHERE filename = :f AND id != :id"),
+            {'f': filename, 'id': keep_id}
+        )
+
+    # Counts in the per-device summary are now stale
+    if duplicates and 'device_summary' in inspect(conn).get_table_names():
+        conn.execute(text("DELETE FROM device_summary"))
+
+
+def _add_upload_indexes(conn):
+    _dedupe_upload_filenames(conn)
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_upload_device_id_timestamp ON upload (device_id, timestamp)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_upload_timestamp ON upload (timestamp)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_upload_filename ON upload (filename)"))
+
+
+def _add_upload_storage_path(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    if 'storage_path' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN storage_path VARCHAR(300)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_upload_metadata_file ON upload (metadata_file)"))
+
+
+def _add_device_registry(conn):
+    """Create a Device for every device_id seen so far and make Upload reference it."""
+    from .models import Device, Upload
+
+    Device.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        "INSERT INTO device (device_id, registered_at, last_seen, status) "
+        "SELECT device_id, MIN(timestamp), MAX(timestamp), 'idle' FROM upload "
+        "WHERE device_id NOT IN (SELECT device_id FROM device) GROUP BY device_id"
+    ))
+    # Summaries are usually still empty here; step 8 fills positions from the history
+    if 'device_summary' in inspect(conn).get_table_names() and \
+            'latitude' in {c['name'] for c in inspect(conn).get_columns('device_summary')}:
+        conn.execute(text(
+            "UPDATE device SET "
+            "latitude = (SELECT latitude FROM device_summary s WHERE s.device_id = device.device_id), "
+            "longitude = (SELECT longitude FROM device_summary s WHERE s.device_id = device.device_id) "
+            "WHERE latitude IS NULL"
+        ))
+
+    if any(fk['referred_table'] == 'device' for fk in inspect(conn).get_foreign_keys('upload')):
+        return
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text(
+            "ALTER TABLE upload ADD CONSTRAINT fk_upload_device "
+            "FOREIGN KEY (device_id) REFERENCES device (device_id)"
+        ))
+        return
+
+    # SQLite cannot add a constraint in place: rebuild the table from the model
+    old_columns = {c['name'] for c in inspect(conn).get_columns('upload')}
+    columns = ', '.join(c.name for c in Upload.__table__.columns if c.name in old_columns)
+    old_indexes = [ix['name'] for ix in inspect(conn).get_indexes('upload')]
+    conn.execute(text("ALTER TABLE upload RENAME TO upload_old"))
+    for name in old_indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    Upload.__table__.create(conn)
+    conn.execute(text(f"INSERT INTO upload ({columns}) SELECT {columns} FROM upload_old"))
+    conn.execute(text("DROP TABLE upload_old"))
+
+
+def _add_upload_session_id(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    if 'session_id' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN session_id VARCHAR(64) REFERENCES listening_session (id)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_upload_session_id_timestamp ON upload (session_id, timestamp)"
+    ))
+
+
+def _add_upload_media_columns(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    for name, ddl in (
+        ('duration', 'FLOAT'),
+        ('size_bytes', 'BIGINT'),
+        ('codec', 'VARCHAR(32)'),
+        ('preview_path', 'VARCHAR(300)'),
+        ('original_path', 'VARCHAR(300)'),
+        ('processed_at', 'DATETIME'),
+    ):
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE upload ADD COLUMN {name} {ddl}"))
+
+
+def _add_upload_peaks_path(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    if 'peaks_path' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN peaks_path VARCHAR(300)"))
+
+
+def _add_upload_content_columns(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    if 'sha256' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN sha256 VARCHAR(64)"))
+    if 'idempotency_key' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN idempotency_key VARCHAR(100)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_upload_sha256 ON upload (sha256)"))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_upload_device_id_idempotency_key "
+        "ON upload (device_id, idempotency_key)"
+    ))
+
+
+def _backfill_device_positions(conn):
+    """Give every device its last known position from location_fix and located uploads.
+
+    Step 3 copied positions from device_summary, which on most databases
+    was still empty at that point (ensure_summaries runs after the
+    migrations), and the summary columns are gone now: the device row is
+    the only place a position is kept.
+    """
+    columns = {c['name'] for c in inspect(conn).get_columns('device')}
+    if 'position_at' not in columns:
+        conn.execute(text("ALTER TABLE device ADD COLUMN position_at DATETIME"))
+
+    tables = inspect(conn).get_table_names()
+    # A database create_all hasn't completed has no history to take positions from
+    latest = [] if 'location_fix' not in tables else conn.execute(text(
+        "SELECT device_id, latitude, longitude, at FROM ("
+        "SELECT device_id, latitude, longitude, at, "
+        "ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY at DESC) AS n FROM ("
+        "SELECT device_id, latitude, longitude, recorded_at AS at FROM location_fix "
+        "UNION ALL "
+        "SELECT device_id, latitude, longitude, timestamp AS at FROM upload "
+        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL)) WHERE n = 1"
+    )).fetchall()
+    if latest:
+        conn.execute(
+            text("UPDATE device SET latitude = :latitude, longitude = :longitude, position_at = :at "
+                 "WHERE device_id = :device_id"),
+            [row._asdict() for row in latest]
+        )
+
+    summary_columns = {c['name'] for c in inspect(conn).get_columns('device_summary')} \
+        if 'device_summary' in tables else set()
+    for name in ('latitude', 'longitude'):
+        if name in summary_columns:
+            conn.execute(text(f"ALTER TABLE device_summary DROP COLUMN {name}"))
+
+
+def _add_upload_metadata_path(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('upload')]
+    if 'metadata_path' not in columns:
+        conn.execute(text("ALTER TABLE upload ADD COLUMN metadata_path VARCHAR(300)"))
+
+
+# (version, description, step) - append only, never renumber
+MIGRATIONS = [
+    (1, 'upload indexes and unique filename', _add_upload_indexes),
+    (2, 'upload storage_path', _add_upload_storage_path),
+    (3, 'device registry and upload foreign key', _add_device_registry),
+    (4, 'upload session_id', _add_upload_session_id),
+    (5, 'upload media columns', _add_upload_media_columns),
+    (6, 'upload peaks_path', _add_upload_peaks_path),
+    (7, 'upload sha256 and idempotency_key', _add_upload_content_columns),
+    (8, 'device positions from location history', _backfill_device_positions),
+    (9, 'upload metadata_path', _add_upload_metadata_path),
+]
+
+
+def current_version(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def run_migrations(engine):
+    """Apply every pending migration, each in its own transaction.
+
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {'v': number})
+        print(f"Applied migration {number}: {description}")
+        applied.append(number)
+
+    return applied
@@ -3,11 +3,151 @@ from datetime import datetime
 
 class Upload(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(100), nullable=False)
+    device_id = db.Column(db.String(100), db.ForeignKey('device.device_id'), nullable=False)
     filename = db.Column(db.String(200), nullable=False)
     metadata_file = db.Column(db.String(200), nullable=True)
+    metadata_path = db.Column(db.String(300))  # Sidecar relative to UPLOAD_FOLDER; NULL = next to storage_path
     start_time = db.Column(db.BigInteger)
     end_time = db.Column(db.BigInteger)
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    storage_path = db.Column(db.String(300), nullable=True)  # Relative to UPLOAD_FOLDER; NULL = flat legacy file
+    session_id = db.Column(db.String(64), db.ForeignKey('listening_session.id'), nullable=True)  # Recorded during this session
+    duration = db.Column(db.Float)  # Seconds; the media columns are filled in by media.py
+    size_bytes = db.Column(db.BigInteger)  # Size of the file served for this upload
+    codec = db.Column(db.String(32))
+    preview_path = db.Column(db.String(300))  # Low-bitrate preview, relative to UPLOAD_FOLDER
+    original_path = db.Column(db.String(300))  # Retained original when the served file was transcoded
+    peaks_path = db.Column(db.String(300))  # Waveform peaks file (see peaks.py)
+    processed_at = db.Column(db.DateTime)
+    sha256 = db.Column(db.String(64))  # Content digest; the stored file is the Blob with this sha256
+    idempotency_key = db.Column(db.String(100))  # Client's Idempotency-Key, unique per device (see dedupe.py)
+
+    # Keep in sync with the CREATE INDEX statements in migrations.py
+    __table_args__ = (
+        db.Index('ix_upload_device_id_timestamp', 'device_id', 'timestamp'),
+        db.Index('ix_upload_timestamp', 'timestamp'),
+        db.Index('ix_upload_filename', 'filename', unique=True),
+        db.Index('ix_upload_metadata_file', 'metadata_file'),
+        db.Index('ix_upload_session_id_timestamp', 'session_id', 'timestamp'),
+        db.Index('ix_upload_sha256', 'sha256'),
+        db.Index('ix_upload_device_id_idempotency_key', 'device_id', 'idempotency_key', unique=True),
+    )
+
+
+class Blob(db.Model):
+    """Recording content stored once, shared by every Upload with the same sha256 (see dedupe.py)"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    storage_path = db.Column(db.String(300), nullable=False)  # Relative to UPLOAD_FOLDER
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Upload rows pointing at it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DeviceSummary(db.Model):
+    """One row per device, kept in step with Upload inserts (see summary.py)"""
+    device_id = db.Column(db.String(100), primary_key=True)
+    latest_filename = db.Column(db.String(200), nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    upload_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UploadSession(db.Model):
+    """A resumable upload in progress; received bytes live in a .part file (see resumable.py)"""
+    id = db.Column(db.String(32), primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    original_name = db.Column(db.String(200), nullable=False)
+    expected_size = db.Column(db.BigInteger)
+    expected_sha256 = db.Column(db.String(64))
+    status = db.Column(db.String(16), nullable=False, default='open')  # open | complete
+    filename = db.Column(db.String(200))  # Final Upload filename once complete
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class DataVersion(db.Model):
+    """Single-row counter bumped on every Upload write (see http_cache.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class LocationFix(db.Model):
+    """One GPS fix reported through /api/location (see locations.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)  # When the device took the fix
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    accuracy = db.Column(db.Float)  # Metres, if the device reports it
+
+    __table_args__ = (
+        db.Index('ix_location_fix_device_id_recorded_at', 'device_id', 'recorded_at'),
+    )
+
+
+class DeviceEvent(db.Model):
+    """A telemetry event (battery, connectivity, app state...) reported by a device"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.Text)  # JSON payload, as sent
+
+    __table_args__ = (
+        db.Index('ix_device_event_device_id_recorded_at', 'device_id', 'recorded_at'),
+    )
+
+
+class Device(db.Model):
+    """A registered phone; reads go through the cache in devices.py"""
+    device_id = db.Column(db.String(100), primary_key=True)
+    name = db.Column(db.String(200))
+    registered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime)
+    # Last known position, from the newest GPS fix or located upload; kept
+    # nowhere else (see devices.touch_device) and indexed by device_rtree
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    position_at = db.Column(db.DateTime)  # When the device reported that position
+    status = db.Column(db.String(20), nullable=False, default='idle')
+
+
+class ListeningSession(db.Model):
+    """One start/stop listening cycle of a device (see listening.py)"""
+    id = db.Column(db.String(64), primary_key=True)
+    device_id = db.Column(db.String(100), db.ForeignKey('device.device_id'), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    stopped_at = db.Column(db.DateTime)  # NULL while active
+
+    __table_args__ = (
+        db.Index('ix_listening_session_device_id_started_at', 'device_id', 'started_at'),
+        # At most one active session per device, even across processes
+        db.Index('ix_listening_session_active', 'device_id', unique=True,
+                 sqlite_where=db.text('stopped_at IS NULL'), postgresql_where=db.text('stopped_at IS NULL')),
+    )
+
+
+class Operator(db.Model):
+    """A dashboard user; passwords are stored as werkzeug (scrypt) hashes (see auth.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(100), nullable=False, unique=True)
+    password_hash = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ApiToken(db.Model):
+    """A bearer token for an operator or a device; only a SHA-256 of its secret is stored"""
+    id = db.Column(db.String(16), primary_key=True)  # Public part of the token
+    secret_hash = db.Column(db.String(64), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # operator | device
+    subject = db.Column(db.String(100), nullable=False)  # Operator username or device_id
+    name = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime)  # NULL = never
+    revoked_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_api_token_kind_subject', 'kind', 'subject'),
+    )
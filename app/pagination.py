@@ -0,0 +1,64 @@
+from datetime import datetime
+from sqlalchemy import and_, or_
+from .models import Upload
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(upload):
+    """Opaque keyset cursor pointing just past `upload` in (timestamp, id) order."""
+    return f"{upload.timestamp.isoformat()}_{upload.id}"
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError on a malformed cursor."""
+    timestamp, _, upload_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(upload_id)
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE):
+    """Clamp a ?limit= query value to [1, MAX_PAGE_SIZE]. Raises ValueError."""
+    if value is None or value == '':
+        return default
+    return max(1, min(int(value), MAX_PAGE_SIZE))
+
+
+def paginate_uploads(query, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Return (uploads, next_cursor) for one page, newest first.
+
+    Uses keyset pagination on (timestamp, id) so every page costs the same
+    regardless of how deep into the history it is.
+    """
+    if after:
+        ts, upload_id = decode_cursor(after)
+        query = query.filter(or_(
+            Upload.timestamp < ts,
+            and_(Upload.timestamp == ts, Upload.id < upload_id)
+        ))
+
+    # Fetch one extra row to learn whether another page exists
+    rows = (
+        query
+        .order_by(Upload.timestamp.desc(), Upload.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1]) if len(rows) > limit else None
+    return page, next_cursor
+
+
+def serialize_upload(upload):
+    return {
+        'id': upload.id,
+        'filename': upload.filename,
+        'metadata_file': upload.metadata_file or '',
+        'timestamp': upload.timestamp.isoformat(),
+        'url': f'/api/uploads/{upload.filename}',
+        'duration': upload.duration,
+        'size_bytes': upload.size_bytes,
+        'codec': upload.codec,
+        'preview_url': f'/api/uploads/{upload.filename}/preview' if upload.preview_path else None,
+        'peaks_url': f'/api/uploads/{upload.filename}/peaks' if upload.peaks_path else None
+    }
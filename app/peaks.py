@@ -0,0 +1,136 @@
+"""
+Waveform peaks.
+
+The media worker decodes each recording once (ffmpeg, mono, PEAKS_SAMPLE_RATE)
+and stores min/max pairs at several zoom levels in a small binary file
+next to it. /api/uploads/<filename>/peaks?level= serves one level straight
+out of a memory map, so a dashboard can draw a waveform from a few KB
+instead of downloading the recording.
+
+File layout (little-endian):
+    b'BPK1', uint32 sample_rate, uint16 level_count, uint16 reserved
+    level_count x (uint32 samples_per_peak, uint32 peak_count, uint64 offset)
+    per level: peak_count x (int8 min, int8 max)
+Level 0 is the finest; each following level is PEAKS_LEVEL_FACTOR times coarser.
+"""
+import mmap
+import os
+import struct
+import subprocess
+from array import array
+from flask import current_app
+from .media import MediaError
+
+MAGIC = b'BPK1'
+HEADER = struct.Struct('<4sIHH')
+LEVEL = struct.Struct('<IIQ')
+
+
+def _to_int8(value):
+    return max(-128, min(127, value >> 8))
+
+
+def _decode_bins(source, sample_rate, samples_per_peak):
+    """Yield (min, max) per bin of samples_per_peak samples, decoding as a stream."""
+    config = current_app.config
+    process = subprocess.Popen(
+        [config['FFMPEG_BINARY'], '-nostdin', '-v', 'error', '-i', source,
+         '-vn', '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    chunk_bytes = samples_per_peak * 2 * 4096
+    leftover = b''
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            data = leftover + data
+            usable = len(data) - len(data) % (samples_per_peak * 2)
+            samples = array('h')
+            samples.frombytes(data[:usable])
+            leftover = data[usable:]
+            for start in range(0, len(samples), samples_per_peak):
+                window = samples[start:start + samples_per_peak]
+                yield min(window), max(window)
+        if len(leftover) >= 2:
+            samples = array('h')
+            samples.frombytes(leftover[:len(leftover) - len(leftover) % 2])
+            yield min(samples), max(samples)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        if process.wait(timeout=config['MEDIA_TIMEOUT']) != 0:
+            raise MediaError(stderr.decode(errors='replace').strip()[-500:])
+
+
+def _coarsen(peaks, factor):
+    """Merge every `factor` (min, max) pairs of a flat int8 array into one."""
+    merged = array('b')
+    step = factor * 2
+    for start in range(0, len(peaks), step):
+        window = peaks[start:start + step]
+        merged.append(min(window[0::2]))
+        merged.append(max(window[1::2]))
+    return merged
+
+
+def build_peaks(source, target):
+    """Decode source and write its peaks file to target (atomically)."""
+    config = current_app.config
+    sample_rate = config['PEAKS_SAMPLE_RATE']
+    samples_per_peak = config['PEAKS_SAMPLES_PER_PEAK']
+
+    finest = array('b')
+    for low, high in _decode_bins(source, sample_rate, samples_per_peak):
+        finest.append(_to_int8(low))
+        finest.append(_to_int8(high))
+
+    levels = [(samples_per_peak, finest)]
+    for _ in range(config['PEAKS_LEVELS'] - 1):
+        previous_spp, previous = levels[-1]
+        levels.append((previous_spp * config['PEAKS_LEVEL_FACTOR'],
+                       _coarsen(previous, config['PEAKS_LEVEL_FACTOR'])))
+
+    offset = HEADER.size + LEVEL.size * len(levels)
+    table = []
+    for spp, peaks in levels:
+        table.append(LEVEL.pack(spp, len(peaks) // 2, offset))
+        offset += len(peaks)
+
+    partial = f"{target}.part"
+    with open(partial, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, sample_rate, len(levels), 0))
+        out.write(b''.join(table))
+        for _, peaks in levels:
+            out.write(peaks.tobytes())
+    os.replace(partial, target)
+
+
+def read_levels(mapped):
+    """[(samples_per_peak, peak_count, offset)] and the sample rate of a mapped peaks file."""
+    magic, sample_rate, count, _ = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a peaks file')
+    return sample_rate, [LEVEL.unpack_from(mapped, HEADER.size + i * LEVEL.size) for i in range(count)]
+
+
+def pick_level(levels, target_peaks):
+    """Finest level with at most target_peaks peaks (the coarsest if none is that small)."""
+    for index, (_, count, _) in enumerate(levels):
+        if count <= target_peaks:
+            return index
+    return len(levels) - 1
+
+
+def read_peaks(path, level=None):
+    """(sample_rate, samples_per_peak, level, body bytes) for one level of a peaks file."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        sample_rate, levels = read_levels(mapped)
+        if level is None:
+            level = pick_level(levels, current_app.config['PEAKS_TARGET_COUNT'])
+        if not 0 <= level < len(levels):
+            raise IndexError(level)
+        spp, count, offset = levels[level]
+        return sample_rate, spp, level, mapped[offset:offset + count * 2]
@@ -0,0 +1,302 @@
+"""
+Resumable uploads for devices on flaky connections.
+
+A device creates a session, PUTs byte ranges (Content-Range) in order,
+asks for the received offset after a dropped connection, and finalizes
+once everything has arrived. Received bytes are appended to
+UPLOAD_FOLDER/.sessions/<session_id>.part, so the offset survives server
+restarts; finalize moves that file into content-addressed storage
+(dedupe.py) and creates the Upload row.
+
+Only one request at a time may write to or finalize a session: each holds
+an exclusive lock on the .part file, and a concurrent one gets SessionBusy
+instead of interleaving its bytes. Finalized sessions are kept for
+UPLOAD_SESSION_RETENTION, so a repeated finalize returns the same Upload.
+"""
+import os
+import re
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_, select, update
+from . import db
+from .models import Upload, UploadSession
+from .summary import record_upload
+from .storage import upload_filename
+from .dedupe import incoming_dir, store, discard_unreferenced
+from .ingest import copy_stream, file_sha256, UploadTooLarge, ChecksumMismatch
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only the single-process development server runs
+    fcntl = None
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class OffsetMismatch(Exception):
+    """A range did not start where the previous one ended."""
+    def __init__(self, offset):
+        super().__init__(f"Expected range starting at byte {offset}")
+        self.offset = offset
+
+
+class IncompleteUpload(Exception):
+    def __init__(self, offset, expected):
+        super().__init__(f"Received {offset} of {expected} bytes")
+        self.offset = offset
+
+
+class RangeLengthMismatch(Exception):
+    """The body was longer or shorter than its Content-Range said."""
+    def __init__(self, expected, received):
+        super().__init__(f"Content-Range announced {expected} bytes, body had {received}")
+
+
+class SessionBusy(Exception):
+    """Another request is writing to or finalizing the session."""
+
+
+class SessionClosed(Exception):
+    """The session was finalized or expired while the request waited."""
+
+
+_busy_sessions = set()  # Without fcntl
+_busy_lock = threading.Lock()
+
+
+def sessions_dir():
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], '.sessions')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def part_path(session):
+    return os.path.join(sessions_dir(), f"{session.id}.part")
+
+
+def received_bytes(session):
+    """Bytes stored so far; the .part file on disk is the source of truth."""
+    try:
+        return os.path.getsize(part_path(session))
+    except FileNotFoundError:
+        return 0
+
+
+@contextmanager
+def session_lock(session):
+    """Hold the session's .part file exclusively, or raise SessionBusy at once."""
+    if fcntl is None:
+        with _busy_lock:
+            if session.id in _busy_sessions:
+                raise SessionBusy()
+            _busy_sessions.add(session.id)
+        try:
+            yield
+        finally:
+            with _busy_lock:
+                _busy_sessions.discard(session.id)
+        return
+
+    try:
+        handle = open(part_path(session), 'rb')
+    except FileNotFoundError:
+        raise SessionClosed()
+    with handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise SessionBusy()
+        yield  # Closing the handle releases the lock
+
+
+def _status(session_id):
+    return db.session.scalar(select(UploadSession.status).where(UploadSession.id == session_id))
+
+
+def parse_content_range(header):
+    """Parse 'bytes start-end/total' into (start, end, total-or-None)."""
+    match = CONTENT_RANGE_RE.match(header.strip())
+    if not match:
+        raise ValueError(f"Invalid Content-Range: {header}")
+    start, end = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if end < start or (total is not None and end >= total):
+        raise ValueError(f"Invalid Content-Range: {header}")
+    return start, end, total
+
+
+def create_session(device_id, original_name, expected_size=None, expected_sha256=None):
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        device_id=device_id,
+        original_name=original_name,
+        expected_size=expected_size,
+        expected_sha256=expected_sha256.lower() if expected_sha256 else None
+    )
+    db.session.add(session)
+    db.session.commit()
+    open(part_path(session), 'wb').close()
+    return session
+
+
+def write_range(session, stream, start, length=None):
+    """Append one range to the session's .part file and return the new offset.
+
+    Ranges must arrive in order: `start` has to equal the current offset,
+    otherwise OffsetMismatch tells the client where to resume from. A body
+    that doesn't match `length` is dropped with RangeLengthMismatch.
+    """
+    session_id = session.id
+    with session_lock(session):
+        # The request holding the lock before may have finalized it
+        if _status(session_id) != 'open':
+            raise SessionClosed()
+        offset = received_bytes(session)
+        if start != offset:
+            raise OffsetMismatch(offset)
+
+        limit = session.expected_size or current_app.config['MAX_CONTENT_LENGTH']
+        remaining = limit - offset
+        if length is not None and length > remaining:
+            raise UploadTooLarge(f"Upload exceeds {limit} bytes")
+
+        path = part_path(session)
+        with open(path, 'r+b') as out:
+            out.seek(offset)
+            try:
+                received = copy_stream(stream, out, max_bytes=remaining if length is None else length,
+                                       chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'])
+                if length is not None and received != length:
+                    raise RangeLengthMismatch(length, received)
+            except UploadTooLarge:
+                out.truncate(offset)
+                if length is not None:
+                    raise RangeLengthMismatch(length, f"more than {length}")
+                raise
+            except RangeLengthMismatch:
+                out.truncate(offset)
+                raise
+
+        session.updated_at = datetime.utcnow()
+        db.session.commit()
+        return received_bytes(session)
+
+
+def _finalized_upload(session):
+    """The Upload of a session another request finalized, once that is committed."""
+    db.session.rollback()
+    if _status(session.id) != 'complete':
+        raise SessionClosed()
+    db.session.refresh(session)
+    return Upload.query.filter_by(filename=session.filename).first()
+
+
+def finalize_session(session):
+    """Move the assembled file into storage and commit its Upload row.
+
+    Returns (upload, created). Finalizing a session again, later or at the
+    same time, returns the original Upload with created False. If the
+    commit fails, nothing is kept and the session can be finalized again.
+    """
+    if session.status == 'complete':
+        return Upload.query.filter_by(filename=session.filename).first(), False
+
+    try:
+        with session_lock(session):
+            return _finalize_locked(session)
+    except SessionClosed:
+        # Its .part file is gone: finalized (or expired) since this request loaded it
+        return _finalized_upload(session), False
+
+
+def _finalize_locked(session):
+    if _status(session.id) != 'open':
+        return _finalized_upload(session), False
+
+    offset = received_bytes(session)
+    if session.expected_size is not None and offset != session.expected_size:
+        raise IncompleteUpload(offset, session.expected_size)
+
+    path = part_path(session)
+    # Ranges arrive over many requests, so the digest is taken once at the end
+    actual = file_sha256(path)
+    if session.expected_sha256 and actual != session.expected_sha256:
+        raise ChecksumMismatch(session.expected_sha256, actual)
+
+    filename = upload_filename(session.device_id, session.original_name)
+    # A link, so the .part file stays until the commit has succeeded
+    temp_path = os.path.join(incoming_dir(), uuid.uuid4().hex)
+    try:
+        os.link(path, temp_path)
+    except OSError:
+        shutil.copyfile(path, temp_path)
+
+    storage_path = None
+    try:
+        storage_path = store(temp_path, offset, actual, filename)
+        upload = Upload(
+            device_id=session.device_id,
+            filename=filename,
+            storage_path=storage_path,
+            metadata_file=None,
+            latitude=None,
+            longitude=None,
+            sha256=actual
+        )
+        db.session.add(upload)
+        record_upload(upload)
+        # Conditional, so of two finalizes on different hosts only one commits
+        claimed = db.session.execute(
+            update(UploadSession)
+            .where(UploadSession.id == session.id, UploadSession.status == 'open')
+            .values(status='complete', filename=filename, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            discard_unreferenced(actual, storage_path)
+            return _finalized_upload(session), False
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        if storage_path is not None:
+            discard_unreferenced(actual, storage_path)
+        raise
+    os.remove(path)
+    return upload, True
+
+
+def expire_stale_sessions(max_age=None):
+    """Delete sessions idle for longer than max_age seconds, with their partial data.
+
+    Finalized sessions are kept for UPLOAD_SESSION_RETENTION instead, and
+    sessions a request is writing to are left alone.
+    """
+    if max_age is None:
+        max_age = current_app.config['UPLOAD_SESSION_TTL']
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=max_age)
+    retention_cutoff = now - timedelta(seconds=current_app.config['UPLOAD_SESSION_RETENTION'])
+
+    stale = UploadSession.query.filter(or_(
+        and_(UploadSession.status == 'open', UploadSession.updated_at < cutoff),
+        and_(UploadSession.status == 'complete', UploadSession.updated_at < retention_cutoff),
+    )).all()
+    expired = 0
+    for session in stale:
+        if session.status == 'open':
+            try:
+                with session_lock(session):
+                    os.remove(part_path(session))
+            except SessionBusy:
+                continue
+            except (SessionClosed, FileNotFoundError):
+                pass
+        db.session.delete(session)
+        expired += 1
+    db.session.commit()
+    return expired
@@ -1,8 +1,30 @@
-from flask import Blueprint, request, jsonify, render_template, current_app, Response, send_from_directory
-from .models import Upload
+from flask import (Blueprint, request, jsonify, render_template, current_app, Response, abort,
+                   stream_with_context, send_from_directory)
+from .models import Upload, DeviceSummary, UploadSession, ListeningSession, ApiToken
+from .summary import record_upload
+from .pagination import paginate_uploads, parse_limit, serialize_upload, decode_cursor
+from .ingest import UploadTooLarge, ChecksumMismatch
+from .dedupe import receive, receive_body, store, discard_unreferenced, find_retry, stored_size, IDEMPOTENCY_KEY_MAX_LENGTH
+from .storage import get_storage, resolve, upload_filename
+from .peaks import read_peaks
+from .downloads import send_stored_file, public_download_name
+from .metrics import registry, count_error
+from .auth import authorized, issue_token, revoke_token, serialize_token
+from .events import get_broker, format_sse, publish_upload
+from .http_cache import cached_json_response
+from .locations import validate_fix, record_fix, parse_fix_time
+from .batching import BatchFull
+from .tracks import device_track, serialize_point
+from .geo import devices_in_bbox, devices_in_radius, nearest_devices
+from .devices import get_device, register_device, known_positions
+from .listening import start_listening as open_listening_session, stop_listening as close_listening_session, active_sessions, NotListening
+from .telemetry import iter_ndjson, split_records, store_records, TooManyRecords
+from .resumable import (create_session, write_range, finalize_session, received_bytes,
+                        parse_content_range, expire_stale_sessions, OffsetMismatch, IncompleteUpload,
+                        RangeLengthMismatch, SessionBusy, SessionClosed)
 # Make tasks import optional
 try:
-    from .tasks import save_upload_task
+    from .tasks import save_upload_task, ingest_metadata_task, process_media_task
     TASKS_AVAILABLE = True
 except ImportError:
     TASKS_AVAILABLE = False
@@ -11,14 +33,19 @@ except ImportError:
         print("Warning: Celery not available, skipping background task")
         pass
 
-from datetime import datetime
-import os
+    ingest_metadata_task = save_upload_task
 
-routes = Blueprint('routes', __name__)
+    def process_media_task(upload_id):
+        pass
 
+from datetime import datetime, timedelta
+import queue
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+import os
 
-def check_auth(username, password):
-    return username == "admin" and password == "supersecret"
+routes = Blueprint('routes', __name__)
 
 
 def authenticate():
@@ -35,40 +62,110 @@ def handle_preflight():
         return response
 
 
+def _upload_committed(upload):
+    """Tell live dashboards about a new recording and queue its media processing"""
+    publish_upload(upload)
+    process_media_task(upload.id)
+
+
+def _idempotency_key():
+    """The upload's Idempotency-Key header, or None; ValueError if it is unusable"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    return key or None
+
+
+def _commit_upload(upload):
+    """Commit a new Upload. Returns (upload, created); a concurrent retry with the same key may have won.
+
+    Any other failure is rolled back and raised: the caller must not report success.
+    """
+    from . import db
+    try:
+        db.session.add(upload)
+        record_upload(upload)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        _discard_stored(upload)
+        original = find_retry(upload.device_id, upload.idempotency_key)
+        if original is None:
+            raise
+        return original, False
+    except Exception:
+        db.session.rollback()
+        _discard_stored(upload)
+        raise
+    _upload_committed(upload)
+    return upload, True
+
+
+def _discard_stored(upload):
+    """Drop the file store() placed for an upload whose commit failed, unless other uploads use it"""
+    try:
+        discard_unreferenced(upload.sha256, upload.storage_path)
+    except Exception as e:
+        print(f"Could not clean up {upload.storage_path}: {e}")
+        count_error('upload_db')
+
+
+def _replay(upload, **fields):
+    """Response to a retried upload: the original record, nothing written"""
+    response = jsonify({
+        'status': 'success',
+        'filename': upload.filename,
+        'file_size': stored_size(upload),
+        'sha256': upload.sha256,
+        'timestamp': upload.timestamp.isoformat(),
+        **fields
+    })
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, 200
+
+
 # ===================== API ROUTES =====================
 
 @routes.route('/api/upload/audio/<device_id>', methods=['POST'])
 def upload_audio(device_id):
     try:
+        try:
+            key = _idempotency_key()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        original = find_retry(device_id, key)
+        if original:
+            return _replay(original, device_id=device_id)
+
         file = request.files.get('file')
         if not file:
             return jsonify({'error': 'No file provided'}), 400
 
-        # Ensure upload directory exists
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        os.makedirs(upload_folder, exist_ok=True)
+        filename = upload_filename(device_id, file.filename)
 
-        filename = f"{device_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-        filepath = os.path.join(upload_folder, filename)
+        # Hash while saving; identical content is stored once
+        temp_path, file_size, checksum = receive(file.stream)
+        storage_path = store(temp_path, file_size, checksum, filename)
         
-        # Save the file
-        file.save(filepath)
-        
-        # Try to save to database, but don't fail if it doesn't work
+        # The upload only counts once its row is committed
         try:
-            from . import db
-            upload = Upload(
+            upload, created = _commit_upload(Upload(
                 device_id=device_id,
                 filename=filename,
+                storage_path=storage_path,
                 metadata_file=None,
                 latitude=None,
-                longitude=None
-            )
-            db.session.add(upload)
-            db.session.commit()
+                longitude=None,
+                sha256=checksum,
+                idempotency_key=key
+            ))
+            if not created:
+                return _replay(upload, device_id=device_id)
             print(f"Successfully saved to database: {device_id} - {filename}")
         except Exception as db_error:
-            print(f"Database error (continuing anyway): {db_error}")
+            print(f"Database error: {db_error}")
+            count_error('upload_db')
+            return jsonify({'error': 'Upload could not be recorded'}), 500
         
         return jsonify({
             'status': 'success',
@@ -79,38 +176,224 @@ def upload_audio(device_id):
         
     except Exception as e:
         print(f"Upload error: {e}")
+        count_error('upload')
+        return jsonify({'error': str(e)}), 500
+
+
+@routes.route('/api/upload/stream/<device_id>', methods=['POST', 'PUT'])
+def upload_audio_stream(device_id):
+    """Upload audio as a raw or chunked request body, written straight to disk"""
+    name = secure_filename(request.args.get('filename') or request.headers.get('X-Filename') or '')
+    if not name:
+        return jsonify({'error': 'filename is required'}), 400
+
+    try:
+        key = _idempotency_key()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # A retry gets its original back before a byte of the body is read
+    original = find_retry(device_id, key)
+    if original:
+        return _replay(original, device_id=device_id)
+
+    try:
+        filename = upload_filename(device_id, name)
+
+        # Never touch request.files/form here: that would spool the whole body
+        try:
+            temp_path, file_size, checksum = receive_body(
+                request,
+                max_bytes=current_app.config['MAX_CONTENT_LENGTH'],
+                chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+                expected_sha256=request.headers.get('X-Content-SHA256')
+            )
+        except (UploadTooLarge, RequestEntityTooLarge):
+            return jsonify({'error': 'File too large'}), 413
+        except ChecksumMismatch as e:
+            return jsonify({'error': 'Checksum mismatch', 'sha256': e.actual}), 400
+        storage_path = store(temp_path, file_size, checksum, filename)
+
+        try:
+            upload, created = _commit_upload(Upload(
+                device_id=device_id,
+                filename=filename,
+                storage_path=storage_path,
+                metadata_file=None,
+                latitude=None,
+                longitude=None,
+                sha256=checksum,
+                idempotency_key=key
+            ))
+            if not created:
+                return _replay(upload, device_id=device_id)
+        except Exception as db_error:
+            print(f"Database error: {db_error}")
+            count_error('upload_db')
+            return jsonify({'error': 'Upload could not be recorded'}), 500
+
+        return jsonify({
+            'status': 'success',
+            'filename': filename,
+            'device_id': device_id,
+            'file_size': file_size,
+            'sha256': checksum,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+
+    except Exception as e:
+        print(f"Upload error: {e}")
+        count_error('upload')
         return jsonify({'error': str(e)}), 500
 
 
+# ---------- Resumable uploads (see resumable.py) ----------
+
+def _session_status(session, status_code=200):
+    offset = received_bytes(session) if session.status == 'open' else session.expected_size
+    response = jsonify({
+        'session_id': session.id,
+        'device_id': session.device_id,
+        'status': session.status,
+        'offset': offset,
+        'size': session.expected_size,
+        'filename': session.filename
+    })
+    response.status_code = status_code
+    if offset is not None:
+        response.headers['Upload-Offset'] = str(offset)
+    return response
+
+
+def _get_upload_session(device_id, session_id):
+    return UploadSession.query.filter_by(id=session_id, device_id=device_id).first()
+
+
+@routes.route('/api/upload/session/<device_id>', methods=['POST'])
+def create_upload_session(device_id):
+    """Start a resumable upload"""
+    data = request.get_json(silent=True) or {}
+    name = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+
+    if not name:
+        return jsonify({'error': 'filename is required'}), 400
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({'error': 'size must be a non-negative integer'}), 400
+    if size is not None and size > current_app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'File too large'}), 413
+
+    # Opportunistic cleanup; the query is on an indexed column
+    expire_stale_sessions()
+
+    session = create_session(device_id, name, size, data.get('sha256'))
+    return _session_status(session, 201)
+
+
+@routes.route('/api/upload/session/<device_id>/<session_id>', methods=['GET', 'HEAD'])
+def upload_session_status(device_id, session_id):
+    """Report how many bytes of a resumable upload have been received"""
+    session = _get_upload_session(device_id, session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return _session_status(session)
+
+
+@routes.route('/api/upload/session/<device_id>/<session_id>', methods=['PUT'])
+def upload_session_chunk(device_id, session_id):
+    """Append a byte range (Content-Range: bytes start-end/total) to a resumable upload"""
+    session = _get_upload_session(device_id, session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+    if session.status != 'open':
+        return jsonify({'error': 'Upload session already finalized'}), 409
+
+    content_range = request.headers.get('Content-Range')
+    try:
+        if content_range:
+            start, end, _ = parse_content_range(content_range)
+            length = end - start + 1
+        else:
+            # No range given: append at the current offset
+            start, length = received_bytes(session), request.content_length
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        write_range(session, request.stream, start, length)
+    except OffsetMismatch:
+        return _session_status(session, 409)
+    except SessionBusy:
+        return jsonify({'error': 'Another request is writing to this upload session'}), 409
+    except SessionClosed:
+        return jsonify({'error': 'Upload session already finalized'}), 409
+    except RangeLengthMismatch as e:
+        return jsonify({'error': str(e)}), 400
+    except (UploadTooLarge, RequestEntityTooLarge):
+        return jsonify({'error': 'File too large'}), 413
+
+    return _session_status(session)
+
+
+@routes.route('/api/upload/session/<device_id>/<session_id>/finalize', methods=['POST'])
+def finalize_upload_session(device_id, session_id):
+    """Complete a resumable upload and record it"""
+    session = _get_upload_session(device_id, session_id)
+    if not session:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    try:
+        upload, created = finalize_session(session)
+    except IncompleteUpload:
+        return _session_status(session, 409)
+    except ChecksumMismatch as e:
+        return jsonify({'error': 'Checksum mismatch', 'sha256': e.actual}), 400
+    except SessionBusy:
+        return jsonify({'error': 'Another request is writing to this upload session'}), 409
+    except SessionClosed:
+        return jsonify({'error': 'Upload session not found'}), 404
+    except Exception as db_error:
+        # Rolled back with nothing kept; the device can finalize again
+        print(f"Database error: {db_error}")
+        count_error('upload_db')
+        return jsonify({'error': 'Upload could not be recorded'}), 500
+
+    if created:
+        _upload_committed(upload)
+
+    return jsonify({
+        'status': 'success',
+        'session_id': session.id,
+        'filename': upload.filename,
+        'device_id': device_id,
+        'timestamp': upload.timestamp.isoformat()
+    }), 200
+
+
 @routes.route('/api/upload/metadata/<device_id>', methods=['POST'])
 def upload_metadata(device_id):
     metadata = request.get_json()
     filename = metadata.get("filename")
-    metadata_filename = f"{device_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_meta.json"
+    metadata_filename = upload_filename(device_id, 'meta.json')
 
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(filepath):
+    filepath = resolve(filename)
+    if not filepath or not os.path.exists(filepath):
         return "Audio file not found", 404
 
-    with open(filepath, 'rb') as f:
-        file_data = f.read()
-
+    # The audio is already on disk; only pass a reference to the worker
     task_data = {
         'filename': filename,
-        'metadata_filename': metadata_filename,
-        'data': file_data
+        'metadata_filename': metadata_filename
     }
     metadata['device_id'] = device_id
 
-    save_upload_task(task_data, metadata)
+    ingest_metadata_task(task_data, metadata)
 
     return 'Metadata queued for saving', 200
 
 
 @routes.route('/api/audio/<device_id>/latest', methods=['GET'])
 def latest_audio(device_id):
-    auth = request.authorization
-    if not auth or not check_auth(auth.username, auth.password):
+    if not authorized():
         return authenticate()
 
     latest = (
@@ -129,75 +412,237 @@ def latest_audio(device_id):
     })
 
 
+@routes.route('/api/devices/<device_id>/uploads', methods=['GET'])
+def device_uploads(device_id):
+    """Page through a device's recordings, newest first"""
+    if not authorized():
+        return authenticate()
+
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        uploads, next_cursor = paginate_uploads(
+            Upload.query.filter_by(device_id=device_id),
+            after=request.args.get('after'),
+            limit=limit
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid after or limit parameter'}), 400
+
+    return jsonify({
+        'device_id': device_id,
+        'uploads': [serialize_upload(u) for u in uploads],
+        'next_cursor': next_cursor
+    })
+
+
+@routes.route('/api/devices/<device_id>/track', methods=['GET'])
+def device_track_view(device_id):
+    """Simplified track of a device over a time window (see tracks.py)"""
+    if not authorized():
+        return authenticate()
+
+    try:
+        end = parse_fix_time(request.args.get('to'))
+        start = parse_fix_time(request.args.get('from')) if request.args.get('from') else end - timedelta(days=1)
+        max_points = int(request.args.get('max_points', current_app.config['TRACK_DEFAULT_POINTS']))
+        if start >= end or not 2 <= max_points <= current_app.config['TRACK_MAX_POINTS']:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid from, to or max_points parameter'}), 400
+
+    def build():
+        points, raw_count = device_track(device_id, start, end, max_points)
+        return {
+            'device_id': device_id,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'raw_points': raw_count,
+            'points': [serialize_point(p) for p in points]
+        }
+
+    # Without `to` the window ends now and slides with every request, so no
+    # data version can vouch for it
+    if not request.args.get('to'):
+        response = jsonify(build())
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    return cached_json_response(
+        f"track/{device_id}?from={start.isoformat()}&to={end.isoformat()}&max_points={max_points}",
+        build
+    )
+
+
+def _float_arg(name, low, high):
+    value = float(request.args[name])
+    if not low <= value <= high:
+        raise ValueError(f"{name} out of range")
+    return value
+
+
+def _time_window_args():
+    start = parse_fix_time(request.args['from']) if request.args.get('from') else None
+    end = parse_fix_time(request.args['to']) if request.args.get('to') else None
+    return start, end
+
+
+def _serialize_geo_device(device):
+    return {**device, 'last_seen': device['last_seen'].isoformat() if device['last_seen'] else None}
+
+
+@routes.route('/api/geo/bbox', methods=['GET'])
+def geo_bbox():
+    """Devices seen inside a bounding box, optionally within a time window"""
+    if not authorized():
+        return authenticate()
+
+    try:
+        min_lat, max_lat = _float_arg('min_lat', -90, 90), _float_arg('max_lat', -90, 90)
+        min_lng, max_lng = _float_arg('min_lng', -180, 180), _float_arg('max_lng', -180, 180)
+        start, end = _time_window_args()
+        if min_lat > max_lat or min_lng > max_lng:
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({'error': 'min_lat, min_lng, max_lat and max_lng are required and must form a box'}), 400
+
+    devices = devices_in_bbox(min_lat, min_lng, max_lat, max_lng, start, end)
+    return jsonify({'devices': [_serialize_geo_device(d) for d in devices]})
+
+
+@routes.route('/api/geo/radius', methods=['GET'])
+def geo_radius():
+    """Devices seen within radius_m metres of a point, nearest first"""
+    if not authorized():
+        return authenticate()
+
+    try:
+        lat, lng = _float_arg('lat', -90, 90), _float_arg('lng', -180, 180)
+        radius_m = _float_arg('radius_m', 0, current_app.config['GEO_MAX_RADIUS_M'])
+        start, end = _time_window_args()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat, lng and radius_m are required'}), 400
+
+    devices = devices_in_radius(lat, lng, radius_m, start, end)
+    return jsonify({'devices': [_serialize_geo_device(d) for d in devices]})
+
+
+@routes.route('/api/geo/nearest', methods=['GET'])
+def geo_nearest():
+    """Devices closest to a point by last known position"""
+    if not authorized():
+        return authenticate()
+
+    try:
+        lat, lng = _float_arg('lat', -90, 90), _float_arg('lng', -180, 180)
+        limit = parse_limit(request.args.get('limit'), default=10)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lng are required'}), 400
+
+    return jsonify({'devices': [_serialize_geo_device(d) for d in nearest_devices(lat, lng, limit)]})
+
+
+@routes.route('/api/sessions/<session_id>/uploads', methods=['GET'])
+def session_uploads(session_id):
+    """Page through the recordings made during one listening session"""
+    if not authorized():
+        return authenticate()
+
+    session = ListeningSession.query.filter_by(id=session_id).first()
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        uploads, next_cursor = paginate_uploads(
+            Upload.query.filter_by(session_id=session_id),
+            after=request.args.get('after'),
+            limit=limit
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid after or limit parameter'}), 400
+
+    return jsonify({
+        'session_id': session.id,
+        'device_id': session.device_id,
+        'started_at': session.started_at.isoformat(),
+        'stopped_at': session.stopped_at.isoformat() if session.stopped_at else None,
+        'uploads': [serialize_upload(u) for u in uploads],
+        'next_cursor': next_cursor
+    })
+
+
+def _build_dashboard_payload():
+    """Dashboard snapshot shared by /api/dashboard-data and the SSE stream"""
+    # Per-device summaries are maintained on insert, so this is O(devices)
+    try:
+        summaries = DeviceSummary.query.order_by(DeviceSummary.last_seen.desc()).all()
+    except Exception as db_error:
+        print(f"Database error: {db_error}")
+        count_error('dashboard_db')
+        summaries = []
+
+    users = []
+    total_recordings = 0
+    recent_limit = current_app.config['DASHBOARD_RECENT_UPLOADS']
+    positions = known_positions()
+    sessions = active_sessions.all()
+    session_by_device = {s['device_id']: s for s in sessions}
+
+    for summary in summaries:
+        total_recordings += summary.upload_count
+        recent, uploads_cursor = paginate_uploads(
+            Upload.query.filter_by(device_id=summary.device_id),
+            limit=recent_limit
+        )
+        # Newest GPS fix or located upload, whichever came last
+        latitude, longitude, _ = positions.get(summary.device_id, (None, None, None))
+        location = {'lat': latitude or 6.5244, 'lng': longitude or 3.3792}
+        device = get_device(summary.device_id) or {}
+        session = session_by_device.get(summary.device_id)
+        users.append({
+            'user_id': summary.device_id,
+            'device_name': device.get('name'),
+            'status': 'listening' if session else 'idle',
+            'location': location,
+            'session_start': session['started_at'].isoformat() if session else None,
+            'current_session_id': session['session_id'] if session else None,
+            'latest_audio': f'/api/uploads/{summary.latest_filename}',
+            'last_seen': summary.last_seen.isoformat(),
+            'upload_count': summary.upload_count,
+            'uploads': [serialize_upload(u) for u in recent],
+            'uploads_cursor': uploads_cursor
+        })
+
+    return {
+        'active_sessions_count': len(sessions),
+        'total_users': len(users),
+        'connection_status': 'connected',
+        'users': users,
+        'active_sessions': [
+            {'session_id': s['session_id'], 'user_id': s['device_id'], 'session_start': s['started_at'].isoformat()}
+            for s in sessions
+        ],
+        'stats': {
+            'total_users': len(users),
+            'active_sessions': len(sessions),
+            'total_recordings': total_recordings
+        },
+        'last_updated': datetime.now().isoformat()
+    }
+
+
 @routes.route('/api/dashboard-data')
 def api_dashboard_data():
     try:
         # Check authentication if provided
-        auth = request.authorization
-        if auth:
-            if not check_auth(auth.username, auth.password):
-                return authenticate()
-
-        # Try to get data from database
-        try:
-            uploads = Upload.query.order_by(Upload.timestamp.desc()).all()
-        except Exception as db_error:
-            print(f"Database error: {db_error}")
-            uploads = []
-
-        device_map = {}
-
-        for upload in uploads:
-            device_id = upload.device_id
-            if device_id not in device_map:
-                device_map[device_id] = {
-                    'user_id': device_id,
-                    'status': 'idle',
-                    'location': {
-                        'lat': getattr(upload, 'latitude', None) or 6.5244,
-                        'lng': getattr(upload, 'longitude', None) or 3.3792
-                    },
-                    'session_start': None,
-                    'current_session_id': None,
-                    'latest_audio': f'/api/uploads/{upload.filename}',
-                    'last_seen': upload.timestamp.isoformat(),
-                    'latest_timestamp': upload.timestamp,  # Keep track for comparison
-                    'uploads': []
-                }
-            else:
-                # Update last_seen if this upload is more recent
-                if upload.timestamp > device_map[device_id]['latest_timestamp']:
-                    device_map[device_id]['last_seen'] = upload.timestamp.isoformat()
-                    device_map[device_id]['latest_audio'] = f'/api/uploads/{upload.filename}'
-                    device_map[device_id]['latest_timestamp'] = upload.timestamp
-            
-            device_map[device_id]['uploads'].append({
-                'filename': upload.filename,
-                'metadata_file': getattr(upload, 'metadata_file', None) or '',
-                'timestamp': upload.timestamp.isoformat()
-            })
-
-        # Clean up temporary timestamp field
-        for device in device_map.values():
-            del device['latest_timestamp']
-
-        users = list(device_map.values())
+        if request.authorization and not authorized():
+            return authenticate()
 
-        return jsonify({
-            'active_sessions_count': 0,
-            'total_users': len(users),
-            'connection_status': 'connected',
-            'users': users,
-            'active_sessions': [],
-            'stats': {
-                'total_users': len(users),
-                'active_sessions': 0,
-                'total_recordings': len(uploads)
-            },
-            'last_updated': datetime.now().isoformat()
-        })
+        # 304 when the client's copy is current; otherwise built once per data version
+        return cached_json_response('dashboard-data', _build_dashboard_payload)
     except Exception as e:
         print(f"Dashboard data error: {e}")
+        count_error('dashboard')
         return jsonify({
             'active_sessions_count': 0,
             'total_users': 0,
@@ -214,9 +659,90 @@ def api_dashboard_data():
         }), 500
 
 
+@routes.route('/api/dashboard/stream')
+def dashboard_stream():
+    """Server-Sent Events: one snapshot, then upload/device_seen/location deltas"""
+    if (request.authorization or request.args.get('access_token')) and not authorized(allow_query_token=True):
+        return authenticate()
+
+    broker = get_broker()
+    # Each open stream holds a worker thread (see gunicorn.conf.py); past the
+    # cap, dashboards fall back to polling instead of starving other requests
+    subscription = broker.subscribe(limit=current_app.config['EVENT_MAX_STREAMS'])
+    if subscription is None:
+        return jsonify({'error': 'Too many open dashboard streams'}), 503, {'Retry-After': '30'}
+    keepalive = current_app.config['EVENT_KEEPALIVE_SECONDS']
+
+    def snapshot():
+        from . import db
+        payload = _build_dashboard_payload()
+        # Don't keep a pooled connection checked out while the stream idles
+        db.session.close()
+        return format_sse('snapshot', payload)
+
+    def stream():
+        try:
+            yield snapshot()
+            while True:
+                if subscription.overflowed:
+                    # This client fell behind and missed events: resync it
+                    subscription.overflowed = False
+                    yield snapshot()
+                try:
+                    event_type, data = subscription.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event_type, data)
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Tell nginx not to buffer the stream
+    })
+
+
 @routes.route('/api/uploads/<filename>')
 def download_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    filepath = resolve(filename)
+    if not filepath or not os.path.isfile(filepath):
+        abort(404)
+    return send_stored_file(filepath, public_download_name(filename, filepath))
+
+
+@routes.route('/api/uploads/<filename>/preview')
+def download_preview(filename):
+    upload = Upload.query.filter_by(filename=filename).first()
+    if not upload or not upload.preview_path:
+        abort(404)
+    filepath = get_storage().path(upload.preview_path)
+    if not os.path.isfile(filepath):
+        abort(404)
+    return send_stored_file(filepath, public_download_name(filename, filepath, '.preview'))
+
+
+@routes.route('/api/uploads/<filename>/peaks')
+def download_peaks(filename):
+    """Waveform min/max pairs (int8) for one zoom level; see peaks.py"""
+    upload = Upload.query.filter_by(filename=filename).first()
+    if not upload or not upload.peaks_path:
+        abort(404)
+    try:
+        level = int(request.args['level']) if request.args.get('level') else None
+        sample_rate, samples_per_peak, level, body = read_peaks(get_storage().path(upload.peaks_path), level)
+    except FileNotFoundError:
+        abort(404)
+    except (ValueError, IndexError):
+        return jsonify({'error': 'Invalid level'}), 400
+
+    return Response(body, mimetype='application/octet-stream', headers={
+        'X-Peaks-Level': str(level),
+        'X-Peaks-Sample-Rate': str(sample_rate),
+        'X-Peaks-Samples-Per-Peak': str(samples_per_peak),
+        'Cache-Control': 'public, max-age=86400',
+        'Access-Control-Expose-Headers': 'X-Peaks-Level, X-Peaks-Sample-Rate, X-Peaks-Samples-Per-Peak'
+    })
 
 
 @routes.route('/api/health')
@@ -228,33 +754,99 @@ def health_check():
     })
 
 
+@routes.route('/api/tokens', methods=['GET', 'POST'])
+def api_tokens():
+    """List tokens, or issue one: {"kind": "device"|"operator", "subject", "name", "expires_in"}"""
+    principal = authorized()
+    if not principal:
+        return authenticate()
+
+    if request.method == 'GET':
+        tokens = ApiToken.query.order_by(ApiToken.created_at.desc()).all()
+        return jsonify({'tokens': [serialize_token(t) for t in tokens]})
+
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind', 'device')
+    # Operators issue their own tokens unless they name someone else
+    subject = data.get('subject') or (principal['subject'] if kind == 'operator' else None)
+    try:
+        expires_in = int(data['expires_in']) if data.get('expires_in') else None
+        token, row = issue_token(kind, subject, name=data.get('name'), expires_in=expires_in)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    # The only time the secret is ever shown
+    return jsonify({**serialize_token(row), 'token': token}), 201
+
+
+@routes.route('/api/tokens/<token_id>', methods=['DELETE'])
+def api_revoke_token(token_id):
+    if not authorized():
+        return authenticate()
+    if not revoke_token(token_id):
+        return jsonify({'error': 'No such active token'}), 404
+    return jsonify({'status': 'revoked', 'id': token_id})
+
+
+@routes.route('/api/metrics')
+def metrics():
+    """Prometheus text exposition of this process's metrics (see metrics.py)"""
+    if not authorized():
+        return authenticate()
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@routes.route('/api/profiles')
+@routes.route('/api/profiles/<name>')
+def request_profiles(name=None):
+    """Saved request profiles (folded stacks), newest first, or one of them"""
+    if not authorized():
+        return authenticate()
+    folder = current_app.config['PROFILE_DIR']
+    if name is not None:
+        return send_from_directory(folder, name, mimetype='text/plain')
+    names = sorted(os.listdir(folder), reverse=True) if os.path.isdir(folder) else []
+    return jsonify({'profiles': names})
+
+
 # ========== OPTIONAL LEGACY ROUTES ==========
 
 @routes.route('/dashboard')
 def dashboard():
-    auth = request.authorization
-    if not auth or not check_auth(auth.username, auth.password):
+    if not authorized():
         return authenticate()
     return render_template('dashboard.html')
 
 
 @routes.route('/dashboard/data')
 def dashboard_data():
-    auth = request.authorization
-    if not auth or not check_auth(auth.username, auth.password):
+    if not authorized():
         return authenticate()
 
-    uploads = Upload.query.order_by(Upload.timestamp.desc()).all()
-    data = [
-        {
-            'device_id': u.device_id,
-            'metadata_file': u.metadata_file,
-            'audio_file': u.filename,
-            'timestamp': u.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        for u in uploads
-    ]
-    return jsonify(data)
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        after = request.args.get('after')
+        if after:
+            decode_cursor(after)
+    except ValueError:
+        return jsonify({'error': 'Invalid after or limit parameter'}), 400
+
+    def build():
+        uploads, next_cursor = paginate_uploads(Upload.query, after=after, limit=limit)
+        data = [
+            {
+                'device_id': u.device_id,
+                'metadata_file': u.metadata_file,
+                'audio_file': u.filename,
+                'timestamp': u.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            for u in uploads
+        ]
+        # Keep the legacy array body; the next page is advertised in a header
+        return data, ({'X-Next-Cursor': next_cursor} if next_cursor else {})
+
+    return cached_json_response(f"dashboard/data?after={after or ''}&limit={limit}", build)
 
 
 # ========== PHONE ENDPOINTS (for dual backend architecture) ==========
@@ -262,20 +854,20 @@ def dashboard_data():
 @routes.route('/api/register', methods=['POST'])
 def register_phone():
     """Register a new phone device"""
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     phone_id = data.get('phone_id')
     device_name = data.get('device_name')
     
     if not phone_id:
         return jsonify({'error': 'phone_id is required'}), 400
     
-    # For now, just acknowledge registration
-    # In a full implementation, you'd store device info in database
+    device = register_device(phone_id, device_name)
     return jsonify({
         'status': 'success',
         'message': f'Phone {phone_id} registered successfully',
         'phone_id': phone_id,
-        'device_name': device_name,
+        'device_name': device['name'],
+        'registered_at': device['registered_at'].isoformat(),
         'timestamp': datetime.now().isoformat()
     }), 200
 
@@ -283,7 +875,7 @@ def register_phone():
 @routes.route('/api/location', methods=['POST'])
 def update_location():
     """Update phone location"""
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     phone_id = data.get('phone_id')
     latitude = data.get('latitude')
     longitude = data.get('longitude')
@@ -291,9 +883,21 @@ def update_location():
     
     if not phone_id or latitude is None or longitude is None:
         return jsonify({'error': 'phone_id, latitude, and longitude are required'}), 400
-    
-    # For now, just acknowledge location update
-    # In a full implementation, you'd store location in database
+
+    try:
+        fix = validate_fix(phone_id, latitude, longitude, timestamp, data.get('accuracy'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Buffered and written with the next batch (see locations.py)
+    try:
+        record_fix(fix)
+    except BatchFull as e:
+        print(f"Location buffer full: {e}")
+        count_error('location_buffer')
+        response = jsonify({'error': 'Location storage is unavailable, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
     return jsonify({
         'status': 'success',
         'message': f'Location updated for phone {phone_id}',
@@ -304,11 +908,48 @@ def update_location():
     }), 200
 
 
+@routes.route('/api/telemetry/bulk', methods=['POST'])
+def bulk_telemetry():
+    """Store a batch of location fixes and events in one transaction (see telemetry.py)"""
+    default_device = request.args.get('phone_id')
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        records = iter_ndjson(request.stream)
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            default_device = data.get('phone_id') or default_device
+            data = data.get('records')
+        if not isinstance(data, list):
+            return jsonify({'error': 'Expected a list of records or {"records": [...]}'}), 400
+        records = data
+
+    try:
+        fixes, events, rejected = split_records(
+            records, default_device, current_app.config['TELEMETRY_BULK_MAX_RECORDS']
+        )
+    except TooManyRecords as e:
+        return jsonify({'error': str(e)}), 413
+
+    try:
+        store_records(fixes, events)
+    except Exception as e:
+        print(f"Bulk telemetry error: {e}")
+        count_error('telemetry')
+        return jsonify({'error': 'Failed to store records'}), 500
+
+    return jsonify({
+        'status': 'success',
+        'locations': len(fixes),
+        'events': len(events),
+        'rejected': rejected
+    }), 200
+
+
 @routes.route('/api/upload-audio', methods=['POST'])
 def upload_audio_endpoint():
-    """Upload audio file with authentication"""
-    auth = request.authorization
-    if not auth or not check_auth(auth.username, auth.password):
+    """Upload audio file with authentication (an operator, or the phone's own device token)"""
+    principal = authorized('operator', 'device')
+    if not principal:
         return authenticate()
     
     phone_id = request.form.get('phone_id')
@@ -316,39 +957,44 @@ def upload_audio_endpoint():
     
     if not phone_id:
         return jsonify({'error': 'phone_id is required'}), 400
+    if principal['kind'] == 'device' and principal['subject'] != phone_id:
+        return jsonify({'error': 'Token is not valid for this phone_id'}), 403
+    
+    try:
+        key = _idempotency_key()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    original = find_retry(phone_id, key)
+    if original:
+        return _replay(original, message='Audio uploaded successfully', phone_id=phone_id)
     
     if not audio_file:
         return jsonify({'error': 'audio file is required'}), 400
     
     try:
-        # Get file size before saving
-        audio_file.seek(0, 2)  # Seek to end
-        file_size = audio_file.tell()
-        audio_file.seek(0)  # Reset to beginning
-        
-        # Save the audio file
-        filename = f"{phone_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{audio_file.filename}"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        
-        # Ensure upload directory exists
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-        
-        audio_file.save(filepath)
+        # Save the audio file, hashing it on the way; identical content is stored once
+        filename = upload_filename(phone_id, audio_file.filename)
+        temp_path, file_size, checksum = receive(audio_file.stream)
+        storage_path = store(temp_path, file_size, checksum, filename)
         
         # Create upload record in database with error handling
         try:
-            from . import db
-            upload = Upload(
+            upload, created = _commit_upload(Upload(
                 device_id=phone_id,
                 filename=filename,
+                storage_path=storage_path,
                 metadata_file='',  # Will be updated when metadata is uploaded
                 latitude=None,  # Could be extracted from metadata later
-                longitude=None
-            )
-            db.session.add(upload)
-            db.session.commit()
+                longitude=None,
+                sha256=checksum,
+                idempotency_key=key
+            ))
+            if not created:
+                return _replay(upload, message='Audio uploaded successfully', phone_id=phone_id)
         except Exception as db_error:
-            print(f"Database error (continuing anyway): {db_error}")
+            print(f"Database error: {db_error}")
+            count_error('upload_db')
+            return jsonify({'error': 'Upload could not be recorded'}), 500
         
         return jsonify({
             'status': 'success',
@@ -361,6 +1007,7 @@ def upload_audio_endpoint():
         
     except Exception as e:
         print(f"Upload error: {e}")
+        count_error('upload')
         return jsonify({'error': str(e)}), 500
 
 
@@ -370,18 +1017,19 @@ def upload_audio_endpoint():
 def start_listening(user_id):
     """Start listening session for a user"""
     try:
-        # For now, just acknowledge the start request
-        # In a full implementation, you'd update user status in database
+        session, created = open_listening_session(user_id)
         return jsonify({
             'status': 'success',
-            'message': f'Started listening for user {user_id}',
+            'message': f'Started listening for user {user_id}' if created else f'User {user_id} is already listening',
             'user_id': user_id,
-            'session_id': f'session_{user_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}',
+            'session_id': session['session_id'],
+            'session_start': session['started_at'].isoformat(),
             'timestamp': datetime.now().isoformat()
         }), 200
         
     except Exception as e:
         print(f"Start listening error: {e}")
+        count_error('listening')
         return jsonify({'error': str(e)}), 500
 
 
@@ -389,15 +1037,19 @@ def start_listening(user_id):
 def stop_listening(user_id):
     """Stop listening session for a user"""
     try:
-        # For now, just acknowledge the stop request
-        # In a full implementation, you'd update user status in database
+        session = close_listening_session(user_id)
         return jsonify({
             'status': 'success',
             'message': f'Stopped listening for user {user_id}',
             'user_id': user_id,
+            'session_id': session.id,
+            'duration_seconds': (session.stopped_at - session.started_at).total_seconds(),
             'timestamp': datetime.now().isoformat()
         }), 200
         
+    except NotListening:
+        return jsonify({'error': f'User {user_id} is not listening'}), 409
     except Exception as e:
         print(f"Stop listening error: {e}")
+        count_error('listening')
         return jsonify({'error': str(e)}), 500
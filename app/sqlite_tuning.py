@@ -0,0 +1,32 @@
+"""
+Per-connection SQLite settings.
+
+Gunicorn workers and Celery workers all write to the same uploads.db. With
+the default rollback journal a writer blocks every reader, and a busy
+database fails immediately with "database is locked". WAL lets readers
+proceed alongside one writer, and busy_timeout makes a second writer wait
+for the lock instead of erroring out.
+"""
+from sqlalchemy import event
+
+
+def configure_sqlite(engine, config):
+    """Apply the SQLITE_* settings from `config` to every new connection of `engine`."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = [
+        f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA cache_size={-int(config['SQLITE_CACHE_SIZE_KB'])}",  # negative = KiB
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+        "PRAGMA foreign_keys=ON",
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
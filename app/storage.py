@@ -0,0 +1,147 @@
+"""
+Where recordings live on disk.
+
+Every write path asks the storage backend for a location and records the
+returned relative path on the Upload row (storage_path). Reads go through
+resolve(), so /api/uploads/<filename> keeps working whatever the layout:
+the database maps the public filename to its place under UPLOAD_FOLDER.
+Uploaded recordings are stored by content (blob_relative_path, see
+dedupe.py); prepare() still places older flat files (migrate_storage.py).
+"""
+import os
+from datetime import datetime
+from flask import current_app
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+
+
+class FlatStorage:
+    """Every file directly in UPLOAD_FOLDER (the original layout)."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def relative_path(self, device_id, filename, when=None):
+        return filename
+
+    def path(self, relative):
+        """Absolute path for a stored relative path, refusing anything outside root."""
+        full = os.path.abspath(os.path.join(self.root, relative))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise ValueError(f"Path escapes storage root: {relative}")
+        return full
+
+    def blob_relative_path(self, digest, extension=''):
+        """Where content with this sha256 is stored (see dedupe.py), whatever the layout."""
+        return os.path.join('blobs', digest[:2], digest[2:4], f"{digest}{extension}")
+
+    def prepare(self, device_id, filename, when=None):
+        """Pick a location for a new file and make sure its directory exists.
+
+        Returns (relative_path, absolute_path).
+        """
+        relative = self.relative_path(device_id, filename, when)
+        full = self.path(relative)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        return relative, full
+
+
+class ShardedStorage(FlatStorage):
+    """device/YYYY/MM/DD/filename, so no directory grows without bound."""
+
+    def relative_path(self, device_id, filename, when=None):
+        when = when or datetime.utcnow()
+        device_dir = secure_filename(device_id or '') or 'unknown'
+        return os.path.join(device_dir, when.strftime('%Y'), when.strftime('%m'), when.strftime('%d'), filename)
+
+
+def upload_filename(device_id, name, when=None):
+    """Public filename for a new recording (or sidecar) of a device.
+
+    Microseconds keep two files with the same name from the same device
+    apart; the unique index on Upload.filename would reject the second.
+    """
+    when = when or datetime.now()
+    return f"{device_id}_{when.strftime('%Y%m%d_%H%M%S_%f')}_{name}"
+
+
+BACKENDS = {
+    'flat': FlatStorage,
+    'sharded': ShardedStorage,
+}
+
+
+def get_storage(app=None):
+    app = app or current_app
+    return BACKENDS[app.config['STORAGE_BACKEND']](app.config['UPLOAD_FOLDER'])
+
+
+def resolve(filename):
+    """Absolute path of a public upload filename (audio or metadata sidecar), or None."""
+    from .models import Upload
+
+    storage = get_storage()
+    upload = Upload.query.filter_by(filename=filename).first()
+    if upload and upload.storage_path:
+        return storage.path(upload.storage_path)
+
+    upload = Upload.query.filter_by(metadata_file=filename).first()
+    if upload and upload.metadata_path:
+        return storage.path(upload.metadata_path)
+    # Sidecars written before metadata_path sit next to their recording
+    if upload and upload.storage_path:
+        return storage.path(os.path.join(os.path.dirname(upload.storage_path), filename))
+
+    # Files written before storage_path existed are still in the flat root
+    legacy = safe_join(storage.root, filename)
+    return legacy if legacy and os.path.isfile(legacy) else None
+
+
+def migrate_storage(batch_size=500, dry_run=False):
+    """Move flat-layout files into the configured layout and record storage_path.
+
+    Works through Upload rows that have no storage_path yet, committing
+    once per batch so it can be interrupted and re-run. Moves are renames
+    within UPLOAD_FOLDER, so no data is copied. Returns (moved, missing).
+    """
+    from . import db
+    from .models import Upload
+
+    storage = get_storage()
+    moved = missing = 0
+    last_id = 0
+
+    while True:
+        batch = (
+            Upload.query
+            .filter(Upload.storage_path.is_(None), Upload.id > last_id)
+            .order_by(Upload.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        for upload in batch:
+            last_id = upload.id
+            source = safe_join(storage.root, upload.filename)
+            if not source or not os.path.isfile(source):
+                missing += 1
+                continue
+
+            relative = storage.relative_path(upload.device_id, upload.filename, upload.timestamp)
+            if not dry_run:
+                relative, target = storage.prepare(upload.device_id, upload.filename, upload.timestamp)
+                os.replace(source, target)
+                sidecar = safe_join(storage.root, upload.metadata_file) if upload.metadata_file else None
+                if sidecar and os.path.isfile(sidecar):
+                    upload.metadata_path = os.path.join(os.path.dirname(relative), upload.metadata_file)
+                    os.replace(sidecar, storage.path(upload.metadata_path))
+                upload.storage_path = relative
+            print(f"{upload.filename} -> {relative}")
+            moved += 1
+
+        if not dry_run:
+            db.session.commit()
+
+    return moved, missing
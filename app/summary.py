@@ -0,0 +1,91 @@
+from datetime import datetime
+from sqlalchemy import case, func, update
+from . import db
+from .models import Upload, DeviceSummary
+from .http_cache import bump_data_version
+from .devices import ensure_device, touch_device
+from .listening import current_session_id
+
+
+def record_upload(upload):
+    """Fold a new Upload into its device's summary row.
+
+    Runs in the caller's session, so the summary is committed (or rolled
+    back) together with the Upload row itself.
+    """
+    if upload.timestamp is None:
+        upload.timestamp = datetime.utcnow()
+    ts = upload.timestamp
+    ensure_device(upload.device_id)
+    if upload.session_id is None:
+        upload.session_id = current_session_id(upload.device_id)
+    touch_device(upload.device_id, ts, upload.latitude, upload.longitude)
+    is_newer = DeviceSummary.last_seen <= ts
+
+    values = {
+        'upload_count': DeviceSummary.upload_count + 1,
+        'latest_filename': case((is_newer, upload.filename), else_=DeviceSummary.latest_filename),
+        'last_seen': case((is_newer, ts), else_=DeviceSummary.last_seen),
+    }
+
+    # ORM-enabled update so pending summaries in this session are flushed first
+    result = db.session.execute(
+        update(DeviceSummary)
+        .where(DeviceSummary.device_id == upload.device_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.add(DeviceSummary(
+            device_id=upload.device_id,
+            latest_filename=upload.filename,
+            last_seen=ts,
+            upload_count=1
+        ))
+    bump_data_version()
+
+
+def record_location(upload):
+    """Move the device's position to a location attached to an existing Upload.
+
+    Only applies if nothing newer has reported a position since.
+    """
+    # Metadata changed even if the position does not
+    bump_data_version()
+    if upload.latitude is None or upload.longitude is None:
+        return
+    touch_device(upload.device_id, upload.timestamp, upload.latitude, upload.longitude)
+
+
+def rebuild_summaries():
+    """Recompute every DeviceSummary row from the upload table."""
+    DeviceSummary.query.delete()
+
+    counts = (
+        db.session.query(Upload.device_id, func.count(Upload.id))
+        .group_by(Upload.device_id)
+        .all()
+    )
+    for device_id, count in counts:
+        latest = (
+            Upload.query
+            .filter_by(device_id=device_id)
+            .order_by(Upload.timestamp.desc())
+            .first()
+        )
+        db.session.add(DeviceSummary(
+            device_id=device_id,
+            latest_filename=latest.filename,
+            last_seen=latest.timestamp,
+            upload_count=count
+        ))
+
+    bump_data_version()
+    db.session.commit()
+    return len(counts)
+
+
+def ensure_summaries():
+    """Seed the summary table on first start against an existing uploads.db."""
+    if DeviceSummary.query.first() is None and Upload.query.first() is not None:
+        rebuild_summaries()
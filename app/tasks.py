@@ -1,44 +1,249 @@
+from celery import shared_task
+from celery.signals import worker_process_shutdown
 from flask import current_app
 from .models import db, Upload
+from .summary import record_upload, record_location
+from .batching import BatchWriter
+from .resumable import expire_stale_sessions
+from .storage import get_storage, resolve
+from .events import publish_upload, publish_location
+from .media import process_upload, processed_duplicate, copy_processed
+from .dedupe import discard_unreferenced
+from .http_cache import bump_data_version
 import json
 import os
 
+_metadata_batcher = None
+
+
 def get_celery():
     from .celery_app import celery
     if celery is None:
         raise RuntimeError("Celery not initialized")
     return celery
 
-def save_upload_task(file_data, metadata):
-    celery = get_celery()
 
-    @celery.task()
-    def save_upload(file_data, metadata):
+def _apply_metadata(file_data, metadata, written, stale):
+    """Write the metadata sidecar and stage the Upload row (caller commits).
+
+    The sidecar belongs to the upload, not to the stored content (which
+    other uploads may share, and media.py may swap for a transcode), so it
+    is placed by the storage layout and its path kept in metadata_path. A
+    sidecar file this call created is appended to `written`, for the
+    caller to remove if the commit fails; one it replaced is appended to
+    `stale`, to remove after the commit. Returns (upload, created).
+    """
+    # The audio file was written by the upload route; only the
+    # metadata sidecar is new here
+    filepath = resolve(file_data['filename'])
+    if not filepath or not os.path.exists(filepath):
+        raise FileNotFoundError(file_data['filename'])
+
+    # The audio route usually created the row already; attach metadata to it
+    entry = Upload.query.filter_by(filename=file_data['filename']).first()
+    storage = get_storage()
+    device_id = entry.device_id if entry is not None else metadata.get("device_id")
+    metadata_path, full = storage.prepare(device_id, file_data['metadata_filename'])
+    if not os.path.exists(full):
+        written.append(full)
+    with open(full, 'w') as f:
+        json.dump(metadata, f)
+
+    if entry is None:
+        entry = Upload(
+            device_id=metadata.get("device_id"),
+            filename=file_data['filename'],
+            storage_path=os.path.relpath(filepath, storage.root),
+            metadata_file=file_data['metadata_filename'],
+            metadata_path=metadata_path,
+            start_time=metadata.get("start_timestamp"),
+            end_time=metadata.get("end_timestamp"),
+            latitude=metadata.get("latitude"),
+            longitude=metadata.get("longitude")
+        )
+        db.session.add(entry)
+        record_upload(entry)
+        return entry, True
+    else:
+        previous = resolve(entry.metadata_file) if entry.metadata_file else None
+        if previous and os.path.abspath(previous) != os.path.abspath(full):
+            stale.append(previous)
+        entry.metadata_file = file_data['metadata_filename']
+        entry.metadata_path = metadata_path
+        entry.start_time = metadata.get("start_timestamp")
+        entry.end_time = metadata.get("end_timestamp")
+        entry.latitude = metadata.get("latitude")
+        entry.longitude = metadata.get("longitude")
+        record_location(entry)
+        return entry, False
+
+
+def _remove_sidecars(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _publish_applied(applied):
+    """Announce committed metadata to live dashboards."""
+    for entry, created in applied:
+        if created:
+            publish_upload(entry)
+            process_media_task(entry.id)
+        else:
+            publish_location(entry)
+
+
+def _flush_metadata(records):
+    """Commit a batch of (file_data, metadata) records in one transaction.
+
+    If the batch fails as a whole, fall back to one commit per record so a
+    single bad record does not take the rest of the batch with it. Returns
+    {index: exception} for the records that could not be committed, so
+    their tasks fail (and are retried) instead of being acknowledged.
+    """
+    written, stale = [], []
+    try:
+        applied = [_apply_metadata(file_data, metadata, written, stale) for file_data, metadata in records]
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _remove_sidecars(written)
+        current_app.logger.warning(f"Metadata batch of {len(records)} failed, retrying singly: {e}")
+    else:
+        _remove_sidecars(stale)
+        _publish_applied(applied)
+        return {}
+
+    failed = {}
+    for index, (file_data, metadata) in enumerate(records):
+        written, stale = [], []
         try:
-            upload_folder = current_app.config['UPLOAD_FOLDER']
-
-            filepath = os.path.join(upload_folder, file_data['filename'])
-            # Save file data (optional if already saved)
-            with open(filepath, 'wb') as f:
-                f.write(file_data['data'])
-
-            metadata_path = os.path.join(upload_folder, file_data['metadata_filename'])
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f)
-
-            entry = Upload(
-                device_id=metadata.get("device_id"),
-                filename=file_data['filename'],
-                metadata_file=file_data['metadata_filename'],
-                start_time=metadata.get("start_timestamp"),
-                end_time=metadata.get("end_timestamp"),
-                latitude=metadata.get("latitude"),
-                longitude=metadata.get("longitude")
-            )
-            db.session.add(entry)
+            applied = _apply_metadata(file_data, metadata, written, stale)
             db.session.commit()
         except Exception as e:
-            current_app.logger.error(f"Failed to process upload: {e}")
-            raise
+            db.session.rollback()
+            _remove_sidecars(written)
+            current_app.logger.error(f"Failed to process upload {file_data.get('filename')}: {e}")
+            failed[index] = e
+            continue
+        _remove_sidecars(stale)
+        _publish_applied([applied])
+    return failed
+
+
+def get_metadata_batcher():
+    """Per-process BatchWriter feeding _flush_metadata."""
+    global _metadata_batcher
+    if _metadata_batcher is None:
+        app = current_app._get_current_object()
+        _metadata_batcher = BatchWriter(
+            app,
+            _flush_metadata,
+            flush_size=app.config['METADATA_BATCH_SIZE'],
+            flush_interval=app.config['METADATA_FLUSH_INTERVAL'],
+            name='metadata-batcher'
+        )
+    return _metadata_batcher
+
 
+@shared_task(name='app.tasks.save_upload')
+def save_upload(file_data, metadata):
+    written, stale = [], []
+    try:
+        applied = _apply_metadata(file_data, metadata, written, stale)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _remove_sidecars(written)
+        current_app.logger.error(f"Failed to process upload: {e}")
+        raise
+    _remove_sidecars(stale)
+    _publish_applied([applied])
+
+
+@shared_task(name='app.tasks.ingest_metadata', acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def ingest_metadata(file_data, metadata):
+    """Batched metadata write; acked only once its batch is committed.
+
+    Tasks running at the same time share a batch, so run this on a thread
+    pool (-P threads); under prefork each record waits out
+    METADATA_FLUSH_INTERVAL alone. A record that was not committed, with
+    its batch or on its own, fails its task, which is retried with
+    backoff. A redelivered record is applied again, which _apply_metadata
+    handles like any repeated post.
+    """
+    get_metadata_batcher().add((file_data, metadata), wait=True)
+
+
+@shared_task(name='app.tasks.expire_upload_sessions')
+def expire_upload_sessions():
+    """Garbage-collect idle resumable uploads (schedule with celery beat)"""
+    return expire_stale_sessions()
+
+
+@shared_task(name='app.tasks.process_upload_media', queue='media', acks_late=True)
+def process_upload_media(upload_id):
+    """Transcode, preview and measure one recording (run a dedicated worker: -Q media)"""
+    upload = Upload.query.filter_by(id=upload_id).first()
+    if upload is None or upload.processed_at is not None:
+        return
+    done = processed_duplicate(upload)
+    source = resolve(upload.filename)
+    if done is None and (not source or not os.path.exists(source)):
+        current_app.logger.error(f"Media processing skipped, file missing: {upload.filename}")
+        return
+
+    created, released = [], None
+    try:
+        if done is not None:
+            copy_processed(upload, done)
+        else:
+            released = process_upload(upload, source, created)
+        bump_data_version()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Media processing failed for {upload.filename}: {e}")
+        for digest, relative in created:
+            discard_unreferenced(digest, relative)
+        raise
+    if released is None:
+        return
+    digest, relative = released
+    if digest:
+        discard_unreferenced(digest, relative)
+    else:
+        # Stored before content addressing: the file was this upload's alone
+        path = get_storage().path(relative)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@worker_process_shutdown.connect
+def _flush_on_shutdown(**kwargs):
+    if _metadata_batcher is not None:
+        _metadata_batcher.flush()
+
+
+def save_upload_task(file_data, metadata):
+    get_celery()
     return save_upload.delay(file_data, metadata)
+
+
+def ingest_metadata_task(file_data, metadata):
+    """Queue metadata for the batched writer instead of a per-row commit."""
+    get_celery()
+    return ingest_metadata.delay(file_data, metadata)
+
+
+def process_media_task(upload_id):
+    """Queue post-upload processing; uploads never fail because it could not be queued."""
+    if not current_app.config['MEDIA_PROCESSING']:
+        return None
+    try:
+        get_celery()
+        return process_upload_media.delay(upload_id)
+    except Exception as e:
+        current_app.logger.warning(f"Media processing not queued for upload {upload_id}: {e}")
@@ -0,0 +1,95 @@
+"""
+Bulk submission of location fixes and telemetry events.
+
+A device that was offline replays its backlog in one request to
+/api/telemetry/bulk instead of one /api/location POST per fix. The body is
+either JSON (a list of records, or {"phone_id": ..., "records": [...]}) or
+newline-delimited JSON, one record per line, which is parsed as it streams
+in. Every record is validated in a single pass; valid ones are inserted in
+one transaction and invalid ones are reported back by index.
+
+Records look like:
+    {"type": "location", "latitude": 6.5, "longitude": 3.3, "timestamp": ..., "accuracy": 12}
+    {"type": "event", "event": "battery_low", "timestamp": ..., "data": {...}}
+"phone_id" may be set per record or once for the whole request.
+"""
+import json
+from sqlalchemy import insert
+from . import db
+from .models import DeviceEvent
+from .locations import validate_fix, parse_fix_time, stage_fixes, fixes_committed
+
+
+class TooManyRecords(Exception):
+    pass
+
+
+def iter_ndjson(stream):
+    """Yield one decoded record per non-blank line; undecodable lines yield a ValueError."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+
+
+def validate_event(device_id, event_type, timestamp=None, data=None):
+    """Check one telemetry event and return it as a device_event row dict; raises ValueError."""
+    if not device_id:
+        raise ValueError('phone_id is required')
+    if not isinstance(event_type, str) or not event_type or len(event_type) > 50:
+        raise ValueError('event must be a non-empty string of at most 50 characters')
+    return {
+        'device_id': device_id,
+        'recorded_at': parse_fix_time(timestamp),
+        'event_type': event_type,
+        'data': json.dumps(data) if data is not None else None,
+    }
+
+
+def split_records(records, default_device=None, max_records=None):
+    """Validate records in one pass.
+
+    Returns (fixes, events, rejected) where rejected is a list of
+    {'index', 'error'} for records that were skipped.
+    """
+    fixes, events, rejected = [], [], []
+    for index, record in enumerate(records):
+        if max_records is not None and index >= max_records:
+            raise TooManyRecords(f"At most {max_records} records per request")
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            if not isinstance(record, dict):
+                raise ValueError('Record must be an object')
+            device_id = record.get('phone_id') or default_device
+            kind = record.get('type', 'location')
+            if kind == 'location':
+                fixes.append(validate_fix(device_id, record.get('latitude'), record.get('longitude'),
+                                          record.get('timestamp'), record.get('accuracy')))
+            elif kind == 'event':
+                events.append(validate_event(device_id, record.get('event'),
+                                             record.get('timestamp'), record.get('data')))
+            else:
+                raise ValueError(f"Unknown record type: {kind}")
+        except ValueError as e:
+            rejected.append({'index': index, 'error': str(e)})
+    return fixes, events, rejected
+
+
+def store_records(fixes, events):
+    """Insert fixes and events in one transaction."""
+    try:
+        if fixes:
+            stage_fixes(fixes)
+        if events:
+            db.session.execute(insert(DeviceEvent), events)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if fixes:
+        fixes_committed(fixes)
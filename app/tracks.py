@@ -0,0 +1,148 @@
+"""
+Per-device tracks with server-side simplification.
+
+A track merges the device's location_fix rows with the positions recorded
+on its uploads. Long windows are reduced in two steps so the response never
+exceeds max_points, however many fixes the window holds:
+
+1. Time bucketing: rows are streamed from the database and averaged into
+   at most BUCKETS_PER_POINT * max_points equal time buckets, so memory is
+   bounded even for weeks of 1 Hz GPS.
+2. Douglas-Peucker by rank: starting from the two endpoints, repeatedly
+   keep the point farthest from the current simplified line until
+   max_points are kept. This preserves turns and drops straight runs.
+"""
+import heapq
+import math
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from . import db
+from .models import LocationFix, Upload
+
+BUCKETS_PER_POINT = 4
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _epoch(dt):
+    return (dt - _EPOCH).total_seconds()
+
+
+def _fix_rows(device_id, start, end):
+    return (
+        select(LocationFix.recorded_at, LocationFix.latitude, LocationFix.longitude)
+        .where(LocationFix.device_id == device_id,
+               LocationFix.recorded_at >= start, LocationFix.recorded_at <= end)
+        .order_by(LocationFix.recorded_at)
+    )
+
+
+def _upload_points(device_id, start, end):
+    rows = db.session.execute(
+        select(Upload.timestamp, Upload.latitude, Upload.longitude)
+        .where(Upload.device_id == device_id,
+               Upload.timestamp >= start, Upload.timestamp <= end,
+               Upload.latitude.isnot(None), Upload.longitude.isnot(None))
+        .order_by(Upload.timestamp)
+    )
+    return [(_epoch(ts), lat, lng) for ts, lat, lng in rows]
+
+
+def _merge(fixes, uploads):
+    """Merge two time-ordered (t, lat, lng) iterables."""
+    return heapq.merge(fixes, uploads, key=lambda p: p[0])
+
+
+def bucket_points(points, start, end, buckets):
+    """Average (t, lat, lng) points into at most `buckets` equal time buckets."""
+    t0 = _epoch(start)
+    width = max((_epoch(end) - t0) / buckets, 1e-6)
+    result = []
+    current = None
+    sums = [0.0, 0.0, 0.0, 0]
+    for t, lat, lng in points:
+        index = min(int((t - t0) / width), buckets - 1)
+        if index != current and sums[3]:
+            n = sums[3]
+            result.append((sums[0] / n, sums[1] / n, sums[2] / n))
+            sums = [0.0, 0.0, 0.0, 0]
+        current = index
+        sums[0] += t
+        sums[1] += lat
+        sums[2] += lng
+        sums[3] += 1
+    if sums[3]:
+        n = sums[3]
+        result.append((sums[0] / n, sums[1] / n, sums[2] / n))
+    return result
+
+
+def simplify(points, max_points):
+    """Keep at most max_points of (t, lat, lng) points, Douglas-Peucker style."""
+    n = len(points)
+    if n <= max_points or n <= 2:
+        return list(points)
+
+    # Equirectangular projection is accurate enough to rank deviations
+    scale = math.cos(math.radians(sum(p[1] for p in points) / n))
+    xs = [p[2] * scale for p in points]
+    ys = [p[1] for p in points]
+
+    def farthest(first, last):
+        ax, ay, bx, by = xs[first], ys[first], xs[last], ys[last]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        best, best_index = -1.0, None
+        for i in range(first + 1, last):
+            if length:
+                d = abs(dy * (xs[i] - ax) - dx * (ys[i] - ay)) / length
+            else:
+                d = math.hypot(xs[i] - ax, ys[i] - ay)
+            if d > best:
+                best, best_index = d, i
+        return best, best_index
+
+    keep = {0, n - 1}
+    heap = []
+    d, i = farthest(0, n - 1)
+    if i is not None:
+        heap.append((-d, i, 0, n - 1))
+    while heap and len(keep) < max_points:
+        _, i, first, last = heapq.heappop(heap)
+        keep.add(i)
+        for a, b in ((first, i), (i, last)):
+            if b - a > 1:
+                d, j = farthest(a, b)
+                heapq.heappush(heap, (-d, j, a, b))
+    return [points[i] for i in sorted(keep)]
+
+
+def device_track(device_id, start, end, max_points):
+    """(points, raw_count) for a device between start and end, at most max_points long."""
+    raw_count = db.session.scalar(
+        select(func.count()).select_from(LocationFix)
+        .where(LocationFix.device_id == device_id,
+               LocationFix.recorded_at >= start, LocationFix.recorded_at <= end)
+    )
+    uploads = _upload_points(device_id, start, end)
+    raw_count += len(uploads)
+
+    fixes = (
+        (_epoch(ts), lat, lng)
+        for ts, lat, lng in db.session.execute(_fix_rows(device_id, start, end).execution_options(yield_per=10000))
+    )
+    points = _merge(fixes, uploads)
+    if raw_count > max_points * BUCKETS_PER_POINT:
+        points = bucket_points(points, start, end, max_points * BUCKETS_PER_POINT)
+    else:
+        points = list(points)
+
+    return simplify(points, max_points), raw_count
+
+
+def serialize_point(point):
+    t, lat, lng = point
+    return {
+        'lat': round(lat, 6),
+        'lng': round(lng, 6),
+        'timestamp': (_EPOCH + timedelta(seconds=t)).isoformat()
+    }
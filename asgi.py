@@ -0,0 +1,42 @@
+"""
+ASGI entry point (see app/asgi.py).
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+One uvicorn process holds thousands of slow uploads, downloads and
+dashboard streams on its event loop; Flask views run in ASGI_THREADS
+threads. Downloads are handed to the bridge with X-Sendfile unless
+FILE_SERVE_MODE says otherwise (behind nginx, 'x-accel' is still best).
+"""
+import os
+
+from app import create_app
+from app.asgi import AsgiBridge
+
+try:
+    from app.celery_app import make_celery
+
+    CELERY_AVAILABLE = True
+except ImportError:
+    CELERY_AVAILABLE = False
+
+threads = int(os.environ.get('ASGI_THREADS', '32'))
+
+flask_app = create_app({
+    'ASGI_THREADS': threads,
+    'FILE_SERVE_MODE': os.environ.get('FILE_SERVE_MODE', 'x-sendfile'),
+    # One connection per view thread, so no view waits on the pool
+    'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': threads, 'max_overflow': 4},
+})
+
+if CELERY_AVAILABLE:
+    try:
+        celery = make_celery(flask_app)
+    except Exception as e:
+        print(f"Warning: Celery initialization failed: {e}")
+        print("Continuing without Celery...")
+        celery = None
+else:
+    celery = None
+
+app = AsgiBridge(flask_app)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Sync gunicorn vs asgi.py under many slow connections.
+
+Starts each deployment as a subprocess on a throwaway database and
+UPLOAD_FOLDER, then opens, all at once:
+
+    --uploaders   phones streaming a recording to /api/upload/stream at
+                  --upload-kbps (a weak mobile uplink)
+    --listeners   players reading Range segments of a recording at
+                  --download-kbps
+    --dashboards  browsers holding /api/dashboard/stream open
+
+While they run, a probe requests /api/health and /api/dashboard-data
+every --probe-interval seconds and records how long a quick request takes
+to be answered. Under sync workers every slow connection owns a worker,
+so the probe waits for (or times out behind) the phones; under asgi.py
+the slow parts stay on the event loop. Both servers are hit directly,
+without nginx buffering request bodies in front of them.
+
+    python benchmarks/asgi_serving.py --uploaders 50 --listeners 20 --dashboards 20
+
+Needs gunicorn and uvicorn on PATH.
+"""
+
+import argparse
+import base64
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTH = 'Basic ' + base64.b64encode(b'admin:supersecret').decode()
+RECORDING = 'bench_recording.wav'
+
+DEPLOYMENTS = {
+    # Plain sync workers, overriding gunicorn.conf.py
+    'gunicorn': lambda port, args: ['gunicorn', '-w', str(args.workers), '-k', 'sync', '--threads', '1',
+                                    '-b', f"127.0.0.1:{port}", '--timeout', '120', 'server:app'],
+    'asgi': lambda port, args: ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                                '--log-level', 'warning'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def tree_rss_mb(pid):
+    """RSS of a process and its children (gunicorn workers), in MB."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def throttled_send(sock, total, rate, stop):
+    chunk = os.urandom(8 * 1024)
+    sent = 0
+    started = time.perf_counter()
+    while sent < total and not stop.is_set():
+        piece = chunk[:min(len(chunk), total - sent)]
+        sock.sendall(piece)
+        sent += len(piece)
+        ahead = sent / rate - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+    return sent
+
+
+def uploader(port, index, args, results, stop):
+    """One phone: a --upload-kb recording at --upload-kbps."""
+    size = args.upload_kb * 1024
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=args.client_timeout) as sock:
+            sock.sendall((f"POST /api/upload/stream/bench-{index}?filename=rec{index}.wav HTTP/1.1\r\n"
+                          f"Host: localhost\r\nAuthorization: {AUTH}\r\n"
+                          f"Content-Type: application/octet-stream\r\nContent-Length: {size}\r\n"
+                          f"Connection: close\r\n\r\n").encode())
+            throttled_send(sock, size, args.upload_kbps * 1024, stop)
+            response = b''
+            while b'\r\n' not in response:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+        results.append('ok' if response.startswith(b'HTTP/1.1 201') or response.startswith(b'HTTP/1.1 200')
+                       else 'failed')
+    except OSError:
+        results.append('failed')
+
+
+def listener(port, size, args, stop):
+    """One player: Range segments read at --download-kbps until the run ends."""
+    rate = args.download_kbps * 1024
+    segment = 512 * 1024
+    while not stop.is_set():
+        offset = random.randrange(0, max(1, size - segment))
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=args.client_timeout) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+                sock.sendall((f"GET /api/uploads/{RECORDING} HTTP/1.1\r\nHost: localhost\r\n"
+                              f"Range: bytes={offset}-{offset + segment - 1}\r\nConnection: close\r\n\r\n").encode())
+                got = 0
+                started = time.perf_counter()
+                while got < segment and not stop.is_set():
+                    data = sock.recv(16 * 1024)
+                    if not data:
+                        break
+                    got += len(data)
+                    ahead = got / rate - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            time.sleep(0.5)
+
+
+def dashboard(port, args, stop):
+    while not stop.is_set():
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=args.client_timeout) as sock:
+                sock.sendall(b"GET /api/dashboard/stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                while not stop.is_set() and sock.recv(16 * 1024):
+                    pass
+        except OSError:
+            time.sleep(0.5)
+
+
+def probe(port, args, latencies, timeouts, stop):
+    session = requests.Session()
+    session.headers['Authorization'] = AUTH
+    paths = ['/api/health', '/api/dashboard-data']
+    i = 0
+    while not stop.is_set():
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            session.get(f"http://127.0.0.1:{port}{path}", timeout=args.probe_timeout).raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except requests.RequestException:
+            timeouts.append(path)
+        stop.wait(args.probe_interval)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+
+def run(name, folder, args):
+    workdir = os.path.join(folder, name)
+    uploads = os.path.join(workdir, 'uploads')
+    os.makedirs(uploads)
+    with open(os.path.join(uploads, RECORDING), 'wb') as f:
+        f.write(os.urandom(8 * 1024 * 1024))
+    size = os.path.getsize(os.path.join(uploads, RECORDING))
+
+    port = free_port()
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               UPLOAD_FOLDER=uploads,
+               MEDIA_PROCESSING='0',
+               FILE_SERVE_MODE='flask' if name == 'gunicorn' else 'x-sendfile',
+               ASGI_THREADS=str(args.threads))
+    server = subprocess.Popen(DEPLOYMENTS[name](port, args), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                requests.get(f"http://127.0.0.1:{port}/api/health", timeout=1).raise_for_status()
+                break
+            except requests.RequestException:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    print(f"{name}: server did not start")
+                    return
+                time.sleep(0.5)
+        idle_rss = tree_rss_mb(server.pid)
+
+        stop = threading.Event()
+        uploads_done, latencies, timeouts = [], [], []
+        threads = [threading.Thread(target=probe, args=(port, args, latencies, timeouts, stop))]
+        threads += [threading.Thread(target=uploader, args=(port, i, args, uploads_done, stop))
+                    for i in range(args.uploaders)]
+        threads += [threading.Thread(target=listener, args=(port, size, args, stop))
+                    for _ in range(args.listeners)]
+        threads += [threading.Thread(target=dashboard, args=(port, args, stop))
+                    for _ in range(args.dashboards)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        peak_rss = idle_rss
+        started = time.monotonic()
+        while time.monotonic() - started < args.duration:
+            time.sleep(1)
+            peak_rss = max(peak_rss, tree_rss_mb(server.pid))
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=args.client_timeout)
+
+        print(f"{name}:")
+        print(f"  uploads completed: {uploads_done.count('ok')}/{args.uploaders} "
+              f"({uploads_done.count('failed')} failed)")
+        if latencies:
+            print(f"  probe latency: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+                  f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms "
+                  f"({len(latencies)} answered, {len(timeouts)} timed out)")
+        else:
+            print(f"  probe latency: no probe answered ({len(timeouts)} timed out)")
+        print(f"  server RSS: {idle_rss:.0f} MB idle, {peak_rss:.0f} MB peak\n")
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(server.pid, signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploaders', type=int, default=50)
+    parser.add_argument('--listeners', type=int, default=20)
+    parser.add_argument('--dashboards', type=int, default=20)
+    parser.add_argument('--upload-kb', type=int, default=512, help='Size of each uploaded recording')
+    parser.add_argument('--upload-kbps', type=int, default=32, help='Upload rate of each phone, KB/s')
+    parser.add_argument('--download-kbps', type=int, default=64, help='Read rate of each player, KB/s')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run each deployment')
+    parser.add_argument('--probe-interval', type=float, default=0.25)
+    parser.add_argument('--probe-timeout', type=float, default=5)
+    parser.add_argument('--client-timeout', type=float, default=60)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--threads', type=int, default=32, help='ASGI_THREADS for asgi.py')
+    parser.add_argument('--deployments', default='gunicorn,asgi')
+    args = parser.parse_args()
+
+    print(f"{args.uploaders} uploaders at {args.upload_kbps} KB/s, {args.listeners} listeners at "
+          f"{args.download_kbps} KB/s, {args.dashboards} dashboards, {args.duration:.0f} s each\n")
+    with tempfile.TemporaryDirectory() as folder:
+        for name in args.deployments.split(','):
+            run(name, folder, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
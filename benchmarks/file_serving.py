@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Worker occupancy of /api/uploads/<filename> under concurrent playback.
+
+Starts the app on a local threaded server with a throwaway UPLOAD_FOLDER
+and one large recording, then runs --clients simulated players at once.
+Each player seeks a few times: it sends a Range request from a random
+offset, reads --segment-kb at --rate-kbps (a browser buffering ahead) and
+drops the connection, as a media element does when the user seeks.
+
+A WSGI middleware records how long every request holds its worker, from
+the call into Flask until the response is closed. That is what a sync
+gunicorn worker is unavailable for. Run once per FILE_SERVE_MODE:
+
+    flask     the worker streams every byte, so it is held for the whole
+              segment and the pool must be as large as the audience
+    x-accel   the worker returns headers only; nginx streams the bytes
+              (not started here, so players receive an empty body)
+
+    python benchmarks/file_serving.py --clients 32
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+
+FILENAME = 'bench_recording.m4a'
+
+
+class Occupancy:
+    """WSGI middleware tracking busy workers and how long each request held one."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.peak = 0
+        self.held = []
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        with self.lock:
+            self.busy += 1
+            self.peak = max(self.peak, self.busy)
+
+        def done():
+            with self.lock:
+                self.busy -= 1
+                self.held.append(time.perf_counter() - started)
+
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            done()
+            raise
+        return ClosingIterator(result, [done])
+
+
+def play(port, size, args, received):
+    """One listener: a few seeks, each a Range request read at a throttled rate."""
+    rate = args.rate_kbps * 1024
+    segment = args.segment_kb * 1024
+    for _ in range(args.seeks):
+        offset = random.randrange(0, max(1, size - segment))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A small receive window so the kernel doesn't absorb the whole segment
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+        sock.connect(('127.0.0.1', port))
+        sock.sendall((f"GET /api/uploads/{FILENAME} HTTP/1.1\r\nHost: localhost\r\n"
+                      f"Range: bytes={offset}-\r\nConnection: close\r\n\r\n").encode())
+        got = 0
+        started = time.perf_counter()
+        try:
+            while got < segment:
+                data = sock.recv(16 * 1024)
+                if not data:
+                    break
+                got += len(data)
+                ahead = got / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        finally:
+            sock.close()
+        received.append(got)
+
+
+def run(mode, folder, args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(folder, 'bench.db')}",
+            'UPLOAD_FOLDER': folder,
+            'FILE_SERVE_MODE': mode,
+        })
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    occupancy = Occupancy(app.wsgi_app)
+    app.wsgi_app = occupancy
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    size = os.path.getsize(os.path.join(folder, FILENAME))
+    received = []
+    started = time.perf_counter()
+    players = [threading.Thread(target=play, args=(server.port, size, args, received))
+               for _ in range(args.clients)]
+    for player in players:
+        player.start()
+    for player in players:
+        player.join()
+    elapsed = time.perf_counter() - started
+
+    # Let aborted responses notice the closed sockets
+    deadline = time.monotonic() + 10
+    while occupancy.busy and time.monotonic() < deadline:
+        time.sleep(0.05)
+    server.shutdown()
+
+    held = sorted(occupancy.held)
+    print(f"FILE_SERVE_MODE={mode}:")
+    print(f"  {len(held)} requests in {elapsed:.1f} s, "
+          f"{sum(received) / 1024 / 1024:.1f} MB through the worker")
+    print(f"  worker held per request: median {statistics.median(held) * 1000:.1f} ms, "
+          f"max {held[-1] * 1000:.1f} ms")
+    print(f"  worker-seconds: {sum(held):.2f} "
+          f"(average {sum(held) / elapsed:.2f} busy, peak {occupancy.peak} busy)\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seeks', type=int, default=3, help='Range requests per player')
+    parser.add_argument('--size-mb', type=int, default=32, help='Size of the recording')
+    parser.add_argument('--segment-kb', type=int, default=512, help='Bytes read after each seek')
+    parser.add_argument('--rate-kbps', type=int, default=256, help='Read rate of each player, KB/s')
+    parser.add_argument('--modes', default='flask,x-accel')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, FILENAME), 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        print(f"{args.clients} players x {args.seeks} seeks, {args.segment_kb} KB each "
+              f"at {args.rate_kbps} KB/s\n")
+        for mode in args.modes.split(','):
+            run(mode, folder, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Spatial query latency with and without the R*Tree index.
+
+Seeds a throwaway database (created through create_app, so the R*Tree
+tables and triggers are in place) with location fixes scattered over a
+metro-sized area, then times random bounding-box and radius queries
+through app.geo, once using the index and once as plain range scans.
+
+    python benchmarks/geo_queries.py --points 1000000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+from app.geo import devices_in_bbox, devices_in_radius
+
+# Roughly greater Lagos
+CENTER_LAT, CENTER_LNG, SPREAD = 6.5244, 3.3792, 0.5
+
+
+def seed(points, devices):
+    start = datetime(2025, 1, 1)
+    batch = []
+    for i in range(points):
+        batch.append({
+            'device_id': f"device{random.randrange(devices):04d}",
+            'recorded_at': (start + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S.000000'),
+            'latitude': CENTER_LAT + random.uniform(-SPREAD, SPREAD),
+            'longitude': CENTER_LNG + random.uniform(-SPREAD, SPREAD),
+        })
+        if len(batch) == 50000:
+            _insert(batch)
+            batch = []
+    if batch:
+        _insert(batch)
+    db.session.commit()
+
+
+def _insert(batch):
+    db.session.execute(text(
+        "INSERT INTO location_fix (device_id, recorded_at, latitude, longitude) "
+        "VALUES (:device_id, :recorded_at, :latitude, :longitude)"
+    ), batch)
+
+
+def time_queries(name, run, repeat):
+    timings = []
+    results = 0
+    for _ in range(repeat):
+        lat = CENTER_LAT + random.uniform(-SPREAD, SPREAD)
+        lng = CENTER_LNG + random.uniform(-SPREAD, SPREAD)
+        started = time.perf_counter()
+        results += len(run(lat, lng))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"  {name}: median {statistics.median(timings):.2f} ms, p95 {p95:.2f} ms, "
+          f"max {timings[-1]:.2f} ms ({results / repeat:.1f} devices per query)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--box-m', type=float, default=1000, help='Side of the bounding boxes, in metres')
+    parser.add_argument('--radius-m', type=float, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--scan-repeat', type=int, default=5, help='Repeats for the unindexed comparison')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                'UPLOAD_FOLDER': os.path.join(tmp, 'uploads')
+            })
+        if not app.extensions['spatial_index']:
+            print("This SQLite build has no R*Tree module; nothing to compare")
+            return
+
+        with app.app_context():
+            started = time.perf_counter()
+            seed(args.points, args.devices)
+            elapsed = time.perf_counter() - started
+            print(f"Seeded {args.points} fixes across {args.devices} devices in {elapsed:.1f} s "
+                  f"({args.points / elapsed:.0f} rows/s including index triggers)\n")
+
+            half = args.box_m / 2 / 111320.0
+
+            def bbox(use_index):
+                return lambda lat, lng: devices_in_bbox(lat - half, lng - half, lat + half, lng + half,
+                                                        use_index=use_index)
+
+            def radius(use_index):
+                return lambda lat, lng: devices_in_radius(lat, lng, args.radius_m, use_index=use_index)
+
+            print("R*Tree index:")
+            time_queries(f"bbox {args.box_m:.0f} m", bbox(True), args.repeat)
+            time_queries(f"radius {args.radius_m:.0f} m", radius(True), args.repeat)
+
+            print("\nRange scan (no spatial index):")
+            time_queries(f"bbox {args.box_m:.0f} m", bbox(False), args.scan_repeat)
+            time_queries(f"radius {args.radius_m:.0f} m", radius(False), args.scan_repeat)
+
+
+if __name__ == "__main__":
+    main()
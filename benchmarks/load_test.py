@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Load test for ingest, dashboard and download latency.
+
+test_system.py checks that the app works; this measures how fast. For
+each --rows scale (10k, 100k, 1M, ...) a fresh throwaway database is
+seeded with synthetic Upload rows spread over --devices devices, plus
+--audio-files real WAV recordings on disk. The app is then started on a
+local threaded server, and --concurrency clients drive one endpoint at a
+time for --duration seconds:
+
+    upload      POST /api/upload/audio/<device>     (multipart WAV)
+    metadata    POST /api/upload/metadata/<device>  (Celery task run eagerly)
+    dashboard   GET  /api/dashboard-data             (polls with If-None-Match)
+    download    GET  /api/uploads/<filename>
+
+A final 'mixed' phase runs all four together, weighted like a busy
+deployment. For every phase it reports p50/p95/p99 latency, throughput,
+errors and the process's peak RSS. The clients share the process with
+the server, so RSS includes them. Media processing is switched off, so
+ffmpeg is not needed.
+
+Each scale runs in its own process, so module-level state such as the
+metadata batch writer starts fresh. Results can be saved as a JSON
+baseline, and a later run can be compared against it. With --compare,
+the exit status is 1 when p95 or throughput regresses by more than
+--tolerance.
+
+    python benchmarks/load_test.py --rows 10000,100000,1000000 --save baseline.json
+    python benchmarks/load_test.py --rows 10000 --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from array import array
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy import text
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db
+
+AUTH = ('admin', 'supersecret')
+PHASES = ('upload', 'metadata', 'dashboard', 'download', 'mixed')
+MIX = {'upload': 2, 'metadata': 2, 'dashboard': 5, 'download': 1}
+MIN_COMPARE_REQUESTS = 30  # Fewer samples than this make p95 meaningless
+
+
+def make_wav(seconds, rate=8000):
+    """A mono 16-bit sine tone as WAV bytes."""
+    samples = array('h', (int(8000 * math.sin(2 * math.pi * 440 * i / rate)) for i in range(int(seconds * rate))))
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(samples.tobytes())
+    return out.getvalue()
+
+
+# ----------------------------------------------------------------- seeding
+
+def seed(rows, devices, audio_files, audio):
+    """Insert synthetic uploads (the newest audio_files of them backed by real files)."""
+    from app.storage import get_storage
+    from app.summary import rebuild_summaries
+
+    now = datetime.utcnow()
+    device_ids = [f"load{i:04d}" for i in range(devices)]
+    db.session.execute(text(
+        "INSERT INTO device (device_id, registered_at, status) VALUES (:device_id, :registered_at, 'idle')"
+    ), [{'device_id': d, 'registered_at': now.strftime('%Y-%m-%d %H:%M:%S.%f')} for d in device_ids])
+
+    start = now - timedelta(seconds=rows + audio_files)
+    batch = []
+    for i in range(rows - audio_files):
+        device = device_ids[i % devices]
+        batch.append({
+            'device_id': device,
+            'filename': f"{device}_synthetic_{i:07d}.wav",
+            'timestamp': (start + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'latitude': 6.5 + random.uniform(-0.5, 0.5),
+            'longitude': 3.4 + random.uniform(-0.5, 0.5),
+            'storage_path': None,
+        })
+        if len(batch) == 50000:
+            _insert(batch)
+            batch = []
+
+    storage = get_storage()
+    files = []
+    for i in range(audio_files):
+        device = device_ids[i % devices]
+        filename = f"{device}_recording_{i:05d}.wav"
+        storage_path, filepath = storage.prepare(device, filename)
+        with open(filepath, 'wb') as f:
+            f.write(audio)
+        files.append((device, filename))
+        batch.append({
+            'device_id': device,
+            'filename': filename,
+            'timestamp': (now - timedelta(seconds=audio_files - i)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'latitude': 6.5 + random.uniform(-0.5, 0.5),
+            'longitude': 3.4 + random.uniform(-0.5, 0.5),
+            'storage_path': storage_path,
+        })
+    if batch:
+        _insert(batch)
+    db.session.commit()
+    rebuild_summaries()
+    return device_ids, files
+
+
+def _insert(batch):
+    db.session.execute(text(
+        "INSERT INTO upload (device_id, filename, timestamp, latitude, longitude, storage_path) "
+        "VALUES (:device_id, :filename, :timestamp, :latitude, :longitude, :storage_path)"
+    ), batch)
+
+
+# ---------------------------------------------------------------- requests
+
+class Client:
+    """One simulated client: a keep-alive session plus the dashboard ETag it last saw."""
+
+    def __init__(self, base_url, device_ids, files, audio):
+        self.base_url = base_url
+        self.device_ids = device_ids
+        self.files = files
+        self.audio = audio
+        self.session = requests.Session()
+        self.etag = None
+
+    def upload(self):
+        device = random.choice(self.device_ids)
+        return self.session.post(
+            f"{self.base_url}/api/upload/audio/{device}",
+            files={'file': (f"load_{uuid.uuid4().hex}.wav", self.audio, 'audio/wav')}
+        )
+
+    def metadata(self):
+        device, filename = random.choice(self.files)
+        started = int(time.time() * 1000)
+        return self.session.post(f"{self.base_url}/api/upload/metadata/{device}", json={
+            'filename': filename,
+            'start_timestamp': started - 5000,
+            'end_timestamp': started,
+            'latitude': 6.5 + random.uniform(-0.5, 0.5),
+            'longitude': 3.4 + random.uniform(-0.5, 0.5),
+        })
+
+    def dashboard(self):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = self.session.get(f"{self.base_url}/api/dashboard-data", auth=AUTH, headers=headers)
+        self.etag = response.headers.get('ETag', self.etag)
+        return response
+
+    def download(self):
+        _, filename = random.choice(self.files)
+        return self.session.get(f"{self.base_url}/api/uploads/{filename}")
+
+
+class RssSampler:
+    """Polls the resident set size so each phase can report its own peak."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # No /proc: the lifetime peak is the best available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(latencies, errors, elapsed, peak_rss):
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': round(len(ordered) / elapsed, 1),
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+    }
+
+
+def run_phase(phase, make_client, concurrency, duration):
+    """Drive one phase; returns {endpoint: summary}."""
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = make_client()
+        names, weights = zip(*MIX.items())
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0] if phase == 'mixed' else phase
+            started = time.perf_counter()
+            try:
+                failed = getattr(client, name)().status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.setdefault(name, []).append(elapsed)
+                errors[name] = errors.get(name, 0) + failed
+
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        (name if phase != 'mixed' else f"mixed:{name}"): summarize(latencies[name], errors[name], elapsed, rss.peak)
+        for name in sorted(latencies)
+    }
+
+
+def run_scale(rows, args, results):
+    """Seed one scale and run every phase against it (in a child process)."""
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    audio = make_wav(args.audio_seconds)
+    phases = args.phases.split(',')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'uploads.db')}",
+                'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'),
+                'MEDIA_PROCESSING': False,
+                # Metadata goes through the real task and batch writer, without a broker
+                'task_always_eager': True,
+            })
+            from app.celery_app import make_celery
+            # The current Celery app is per thread; request threads need it as the default
+            make_celery(app).set_default()
+
+        with app.app_context():
+            started = time.perf_counter()
+            device_ids, files = seed(rows, args.devices, min(args.audio_files, rows), audio)
+            print(f"[{rows} rows] seeded in {time.perf_counter() - started:.1f} s", flush=True)
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.port}"
+        make_client = lambda: Client(base_url, device_ids, files, audio)
+
+        scale = {}
+        # Output from the routes' own print() calls would drown the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            for phase in phases:
+                scale.update(run_phase(phase, make_client, args.concurrency, args.duration))
+        server.shutdown()
+        with app.app_context():
+            from app.tasks import get_metadata_batcher
+            get_metadata_batcher().flush()
+        results.put(scale)
+
+
+# ----------------------------------------------------------------- reports
+
+def print_scale(rows, scale):
+    print(f"\n{rows} uploads")
+    print(f"  {'endpoint':<20} {'reqs':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>8}")
+    for name, s in scale.items():
+        print(f"  {name:<20} {s['requests']:>7} {s['errors']:>5} {s['throughput']:>8} "
+              f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['peak_rss_mb']:>8}")
+
+
+def compare(baseline, results, tolerance):
+    """Print changes against a saved baseline; returns the number of regressions."""
+    regressions = 0
+    print(f"\nAgainst baseline from {baseline['meta']['created_at']} (tolerance {tolerance:.0%}):")
+    for rows, scale in results.items():
+        old_scale = baseline['results'].get(rows)
+        if old_scale is None:
+            print(f"  {rows} uploads: not in baseline")
+            continue
+        for name, new in scale.items():
+            old = old_scale.get(name)
+            if old is None or not old['p95_ms'] or not new['p95_ms']:
+                continue
+            if min(old['requests'], new['requests']) < MIN_COMPARE_REQUESTS:
+                print(f"  {'skipped':<9} {rows:>8} {name:<20} too few requests to compare")
+                continue
+            p95_change = new['p95_ms'] / old['p95_ms'] - 1
+            rate_change = new['throughput'] / old['throughput'] - 1 if old['throughput'] else 0
+            # Sub-millisecond p95 differences are noise, whatever the ratio
+            slower = p95_change > tolerance and new['p95_ms'] - old['p95_ms'] > 1
+            regressed = slower or rate_change < -tolerance
+            regressions += regressed
+            print(f"  {'REGRESSED' if regressed else 'ok':<9} {rows:>8} {name:<20} "
+                  f"p95 {old['p95_ms']} -> {new['p95_ms']} ms ({p95_change:+.0%}), "
+                  f"{old['throughput']} -> {new['throughput']} req/s ({rate_change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10000,100000,1000000', help='Comma-separated upload counts to seed')
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--audio-files', type=int, default=200, help='Seeded uploads backed by real WAV files')
+    parser.add_argument('--audio-seconds', type=float, default=5, help='Length of every synthetic recording')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per phase')
+    parser.add_argument('--phases', default=','.join(PHASES))
+    parser.add_argument('--save', metavar='PATH', help='Write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='Compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p95/throughput change')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for rows in [int(r) for r in args.rows.split(',')]:
+        queue = context.Queue()
+        child = context.Process(target=run_scale, args=(rows, args, queue))
+        child.start()
+        scale = None
+        while scale is None:
+            try:
+                scale = queue.get(timeout=1)
+            except Empty:
+                if not child.is_alive():
+                    sys.exit(f"Run at {rows} rows failed")
+        child.join()
+        results[str(rows)] = scale
+        print_scale(rows, scale)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'meta': {
+                    'created_at': datetime.utcnow().isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'args': vars(args),
+                },
+                'results': results,
+            }, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
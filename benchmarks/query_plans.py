@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Upload query plans before and after the index migration.
+
+Seeds a throwaway SQLite database with the original (index-less) upload
+schema, prints EXPLAIN QUERY PLAN and timings for the hot queries, then
+upgrades it the way create_app does (create_all for the missing tables,
+then app.migrations) and prints them again.
+
+    python benchmarks/query_plans.py --rows 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.migrations import run_migrations
+from app.models import db
+
+ORIGINAL_SCHEMA = """
+CREATE TABLE upload (
+    id INTEGER NOT NULL,
+    device_id VARCHAR(100) NOT NULL,
+    filename VARCHAR(200) NOT NULL,
+    metadata_file VARCHAR(200),
+    start_time BIGINT,
+    end_time BIGINT,
+    latitude FLOAT,
+    longitude FLOAT,
+    timestamp DATETIME,
+    PRIMARY KEY (id)
+)
+"""
+
+QUERIES = {
+    'latest_audio': (
+        "SELECT * FROM upload WHERE device_id = :device ORDER BY timestamp DESC LIMIT 1"
+    ),
+    'device_uploads_page': (
+        "SELECT * FROM upload WHERE device_id = :device ORDER BY timestamp DESC, id DESC LIMIT 51"
+    ),
+    'dashboard_data_page': (
+        "SELECT * FROM upload ORDER BY timestamp DESC, id DESC LIMIT 51"
+    ),
+    'filename_lookup': (
+        "SELECT * FROM upload WHERE filename = :filename"
+    ),
+}
+
+
+def seed(conn, rows, devices):
+    start = datetime(2025, 1, 1)
+    batch = []
+    for i in range(rows):
+        device = f"device{random.randrange(devices):04d}"
+        ts = start + timedelta(seconds=i * 7)
+        batch.append({
+            'device_id': device,
+            'filename': f"{device}_{ts.strftime('%Y%m%d_%H%M%S')}_{i}.mp3",
+            'timestamp': ts.strftime('%Y-%m-%d %H:%M:%S.000000'),
+        })
+        if len(batch) == 10000:
+            conn.execute(text(
+                "INSERT INTO upload (device_id, filename, timestamp) VALUES (:device_id, :filename, :timestamp)"
+            ), batch)
+            batch = []
+    if batch:
+        conn.execute(text(
+            "INSERT INTO upload (device_id, filename, timestamp) VALUES (:device_id, :filename, :timestamp)"
+        ), batch)
+
+
+def report(engine, params, repeat):
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params).fetchall()
+            started = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params).fetchall()
+            elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+            print(f"  {name}: {elapsed_ms:.3f} ms")
+            for row in plan:
+                print(f"      {row[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        with engine.begin() as conn:
+            conn.execute(text(ORIGINAL_SCHEMA))
+            seed(conn, args.rows, args.devices)
+            sample = conn.execute(text("SELECT device_id, filename FROM upload WHERE id = :id"),
+                                  {'id': args.rows // 2}).fetchone()
+            conn.execute(text("ANALYZE"))
+
+        params = {'device': sample[0], 'filename': sample[1]}
+        print(f"Seeded {args.rows} uploads across {args.devices} devices\n")
+
+        print("BEFORE migrations:")
+        report(engine, params, args.repeat)
+
+        print()
+        # Startup order: tables added since the original schema exist before any step runs
+        db.metadata.create_all(engine)
+        run_migrations(engine)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+
+        print("\nAFTER migrations:")
+        report(engine, params, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,50 @@ const AudioPlayer = ({ audio, onClose }) => {
   const [currentTime, setCurrentTime] = useState(0);
   const [duration, setDuration] = useState(0);
   const [volume, setVolume] = useState(0.7);
+  const [peaks, setPeaks] = useState(null);
+  const canvasRef = useRef(null);
+
+  // Waveform from precomputed peaks: a few KB instead of the whole recording
+  useEffect(() => {
+    let cancelled = false;
+    setPeaks(null);
+    fetch(`${audio.url}/peaks`)
+      .then(response => (response.ok ? response.arrayBuffer() : null))
+      .then(buffer => {
+        if (!cancelled && buffer) {
+          setPeaks(new Int8Array(buffer));
+        }
+      })
+      .catch(() => {});
+    return () => {
+      cancelled = true;
+    };
+  }, [audio.url]);
+
+  useEffect(() => {
+    const canvas = canvasRef.current;
+    if (!canvas || !peaks || peaks.length < 2) return;
+
+    const width = canvas.width = canvas.clientWidth;
+    const height = canvas.height = canvas.clientHeight;
+    const context = canvas.getContext('2d');
+    const count = peaks.length / 2;
+    context.clearRect(0, 0, width, height);
+    context.fillStyle = 'rgba(255, 255, 255, 0.35)';
+    for (let x = 0; x < width; x++) {
+      const first = Math.floor((x / width) * count);
+      const last = Math.max(first + 1, Math.floor(((x + 1) / width) * count));
+      let low = 127;
+      let high = -128;
+      for (let i = first; i < last && i < count; i++) {
+        low = Math.min(low, peaks[i * 2]);
+        high = Math.max(high, peaks[i * 2 + 1]);
+      }
+      const top = height / 2 - (high / 128) * (height / 2);
+      const bottom = height / 2 - (low / 128) * (height / 2);
+      context.fillRect(x, top, 1, Math.max(1, bottom - top));
+    }
+  }, [peaks]);
 
   useEffect(() => {
     const audioElement = audioRef.current;
@@ -128,9 +172,10 @@ const AudioPlayer = ({ audio, onClose }) => {
             </span>
             
             <div 
-              className="progress-bar"
+              className={peaks ? 'progress-bar has-waveform' : 'progress-bar'}
               onClick={handleSeek}
             >
+              {peaks && <canvas ref={canvasRef} className="waveform-canvas" />}
               <div 
                 className="progress-fill"
                 style={{ width: `${progressPercentage}%` }}
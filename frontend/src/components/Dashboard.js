@@ -6,6 +6,59 @@ import ConnectionStatus from './ConnectionStatus';
 import ApiService from '../services/api';
 import './Dashboard.css';
 
+// Matches DASHBOARD_RECENT_UPLOADS on the backend
+const RECENT_UPLOADS = 5;
+
+// Fold one live-feed event into the current dashboard payload
+const applyDashboardEvent = (data, type, payload) => {
+  if (!data) return data;
+
+  const users = [...(data.users || [])];
+  let index = users.findIndex(u => u.user_id === payload.device_id);
+  let stats = data.stats;
+
+  if (index === -1) {
+    if (type !== 'upload') return data;
+    users.unshift({
+      user_id: payload.device_id,
+      status: 'idle',
+      location: { lat: 6.5244, lng: 3.3792 },
+      session_start: null,
+      current_session_id: null,
+      upload_count: 0,
+      uploads: []
+    });
+    index = 0;
+  }
+
+  const user = { ...users[index] };
+  if (type === 'upload') {
+    user.latest_audio = payload.upload.url;
+    user.upload_count = (user.upload_count || 0) + 1;
+    user.uploads = [payload.upload, ...(user.uploads || [])].slice(0, RECENT_UPLOADS);
+    stats = { ...stats, total_recordings: (stats?.total_recordings || 0) + 1 };
+  } else if (type === 'device_seen') {
+    user.last_seen = payload.last_seen;
+  } else if (type === 'location') {
+    user.location = { lat: payload.lat, lng: payload.lng };
+  } else if (type === 'session') {
+    user.status = payload.status;
+    user.session_start = payload.session_start;
+    user.current_session_id = payload.status === 'listening' ? payload.session_id : null;
+  }
+  users[index] = user;
+  const activeSessions = users.filter(u => u.status === 'listening').length;
+
+  return {
+    ...data,
+    users,
+    total_users: users.length,
+    active_sessions_count: activeSessions,
+    stats: { ...stats, total_users: users.length, active_sessions: activeSessions },
+    last_updated: new Date().toISOString()
+  };
+};
+
 const Dashboard = () => {
   // State Management
   const [dashboardData, setDashboardData] = useState(null);
@@ -41,19 +94,52 @@ const Dashboard = () => {
     }
   };
 
-  // Real-time Polling with 2-second intervals
+  // Live updates: server-pushed events, falling back to 2-second polling
   useEffect(() => {
     let pollInterval;
-    
-    if (isPolling) {
+    let stream;
+
+    const startPolling = () => {
+      if (pollInterval) return;
       // Initial fetch
       fetchDashboardData();
       
       // Set up polling
       pollInterval = setInterval(fetchDashboardData, 2000);
+    };
+
+    if (isPolling) {
+      stream = ApiService.openDashboardStream({
+        onSnapshot: (data) => {
+          setDashboardData(data);
+          setConnectionStatus(data.connection_status || 'connected');
+          setLastUpdated(new Date());
+          setError(null);
+          setLoading(false);
+        },
+        onEvent: (type, payload) => {
+          setDashboardData(current => applyDashboardEvent(current, type, payload));
+          setLastUpdated(new Date());
+        },
+        onError: () => {
+          console.warn('Live dashboard stream unavailable, falling back to polling');
+          if (stream) {
+            stream.close();
+            stream = null;
+          }
+          startPolling();
+        }
+      });
+
+      if (!stream) {
+        startPolling();
+      }
     }
     
     return () => {
+      if (stream) {
+        stream.close();
+      }
       if (pollInterval) {
         clearInterval(pollInterval);
       }
@@ -164,7 +164,7 @@ const UserList = ({
                 <div className="user-stats">
                   <div className="stat-item">
                     <span className="stat-label">Recordings:</span>
-                    <span className="stat-value">{user.uploads?.length || 0}</span>
+                    <span className="stat-value">{user.upload_count ?? user.uploads?.length ?? 0}</span>
                   </div>
                   <div className="stat-item">
                     <span className="stat-label">Last Seen:</span>
@@ -225,9 +225,9 @@ const UserList = ({
                         </span>
                       </div>
                     ))}
-                    {user.uploads.length > 3 && (
+                    {(user.upload_count ?? user.uploads.length) > 3 && (
                       <p className="more-uploads">
-                        +{user.uploads.length - 3} more recordings...
+                        +{(user.upload_count ?? user.uploads.length) - 3} more recordings...
                       </p>
                     )}
                   </div>
@@ -11,7 +11,13 @@ const getApiUrl = () => {
 const API_BASE_URL = getApiUrl();
 const AUTH_USERNAME = process.env.REACT_APP_AUTH_USERNAME || 'admin';
 const AUTH_PASSWORD = process.env.REACT_APP_AUTH_PASSWORD || 'supersecret';
-const AUTH_HEADER = 'Basic ' + btoa(`${AUTH_USERNAME}:${AUTH_PASSWORD}`);
+// An operator token (python manage_auth.py issue-token operator <name>) avoids sending the password
+const API_TOKEN = process.env.REACT_APP_API_TOKEN;
+// Consecutive stream errors before the dashboard gives up and polls instead
+const STREAM_MAX_FAILURES = 3;
+const AUTH_HEADER = API_TOKEN
+  ? `Bearer ${API_TOKEN}`
+  : 'Basic ' + btoa(`${AUTH_USERNAME}:${AUTH_PASSWORD}`);
 
 class ApiService {
   constructor(baseURL = API_BASE_URL) {
@@ -89,6 +95,46 @@ class ApiService {
   async getLatestAudio(deviceId) {
     return this.request(`/api/audio/${deviceId}/latest`);
   }
+
+  // Live dashboard feed (Server-Sent Events): a snapshot, then deltas
+  openDashboardStream({ onSnapshot, onEvent, onError }) {
+    if (typeof EventSource === 'undefined') {
+      return null;
+    }
+
+    // EventSource can't send headers; a token can go in the query string instead
+    const query = API_TOKEN ? `?access_token=${encodeURIComponent(API_TOKEN)}` : '';
+    const source = new EventSource(`${this.baseURL}/api/dashboard/stream${query}`);
+    source.addEventListener('snapshot', (e) => onSnapshot(JSON.parse(e.data)));
+    ['upload', 'device_seen', 'location', 'session'].forEach((type) => {
+      source.addEventListener(type, (e) => onEvent(type, JSON.parse(e.data)));
+    });
+    // EventSource reconnects by itself after a dropped connection. Only give
+    // up after repeated failures, or when the browser already has (a 503
+    // from a server with no free stream slots, a 401)
+    let failures = 0;
+    source.onopen = () => {
+      failures = 0;
+    };
+    source.onerror = (err) => {
+      failures += 1;
+      if (source.readyState === EventSource.CLOSED || failures >= STREAM_MAX_FAILURES) {
+        source.close();
+        if (onError) {
+          onError(err);
+        }
+      }
+    };
+    return source;
+  }
+
+  async getDeviceUploads(deviceId, after = null, limit = 50) {
+    const params = new URLSearchParams({ limit });
+    if (after) {
+      params.set('after', after);
+    }
+    return this.request(`/api/devices/${deviceId}/uploads?${params}`);
+  }
 }
 
 export default new ApiService();
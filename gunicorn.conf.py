@@ -0,0 +1,33 @@
+"""
+gunicorn settings, read automatically when gunicorn starts in this folder:
+
+    gunicorn server:app
+
+Threaded (gthread) workers, because some requests stay open: a dashboard
+holds /api/dashboard/stream for as long as it is on screen, and a phone on
+a weak link takes minutes to upload. Under sync workers each of those
+owns a whole worker process (and the stream is killed at --timeout);
+here it owns one thread, and EVENT_MAX_STREAMS (default 8) keeps streams
+from taking more than part of each worker's GUNICORN_THREADS. For
+thousands of open connections, use asgi.py instead.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')  # nginx.conf proxies here
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+timeout = 120  # Worker heartbeat under gthread, not a per-request limit
+keepalive = 5
+# Create the app (tables, migrations, the first operator) once in the master,
+# not racing in every worker against a fresh database
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Connections opened during startup belong to the master; each worker opens its own
+    from app import db
+    from server import app
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,53 @@
+"""
+Manage operators and API tokens.
+
+    python manage_auth.py set-password <username>          (prompts for the password)
+    python manage_auth.py issue-token device <device_id> [--name NAME] [--expires-in SECONDS]
+    python manage_auth.py issue-token operator <username>
+    python manage_auth.py list-tokens
+    python manage_auth.py revoke-token <token_id>
+"""
+import argparse
+import getpass
+import sys
+
+from app import create_app
+from app.auth import set_password, issue_token, revoke_token, serialize_token
+from app.models import ApiToken
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+commands = parser.add_subparsers(dest='command', required=True)
+password_cmd = commands.add_parser('set-password')
+password_cmd.add_argument('username')
+issue_cmd = commands.add_parser('issue-token')
+issue_cmd.add_argument('kind', choices=('device', 'operator'))
+issue_cmd.add_argument('subject', help='device_id or operator username')
+issue_cmd.add_argument('--name')
+issue_cmd.add_argument('--expires-in', type=int, help='Seconds until the token expires')
+commands.add_parser('list-tokens')
+revoke_cmd = commands.add_parser('revoke-token')
+revoke_cmd.add_argument('token_id')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    if args.command == 'set-password':
+        password = getpass.getpass(f"New password for {args.username}: ")
+        if password != getpass.getpass("Repeat: "):
+            sys.exit("Passwords don't match")
+        set_password(args.username, password)
+        print(f"Password set for {args.username}.")
+    elif args.command == 'issue-token':
+        token, row = issue_token(args.kind, args.subject, name=args.name, expires_in=args.expires_in)
+        print(f"Token {row.id} for {row.kind} {row.subject} (shown once, store it now):")
+        print(token)
+    elif args.command == 'list-tokens':
+        for row in ApiToken.query.order_by(ApiToken.created_at.desc()):
+            t = serialize_token(row)
+            state = f"revoked {t['revoked_at']}" if t['revoked_at'] else f"expires {t['expires_at'] or 'never'}"
+            print(f"{t['id']}  {t['kind']:<8} {t['subject']:<24} {t['name'] or '':<20} {state}")
+    elif args.command == 'revoke-token':
+        if not revoke_token(args.token_id):
+            sys.exit(f"No active token {args.token_id}")
+        print(f"Token {args.token_id} revoked.")
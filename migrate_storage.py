@@ -0,0 +1,13 @@
+import sys
+from app import create_app
+from app.storage import migrate_storage
+
+app = create_app()
+
+with app.app_context():
+    dry_run = '--dry-run' in sys.argv
+    moved, missing = migrate_storage(dry_run=dry_run)
+    action = "Would move" if dry_run else "Moved"
+    print(f"{action} {moved} recordings into the {app.config['STORAGE_BACKEND']} layout.")
+    if missing:
+        print(f"{missing} upload rows have no file in the flat upload folder (left unchanged).")
@@ -0,0 +1,8 @@
+from app import create_app
+from app.summary import rebuild_summaries
+
+app = create_app()
+
+with app.app_context():
+    devices = rebuild_summaries()
+    print(f"Device summaries rebuilt for {devices} devices.")